@@ -1,183 +1,1598 @@
+import argparse
+import bisect
+import contextlib
+import contextvars
 import requests
-import sys
-from flask import Flask, request, jsonify, Response
+from flask import Flask, g, request, jsonify, Response
+from werkzeug.serving import make_server
 import hashlib
+import io
+import json
+import os
 import socket
+import struct
+import sys
+import itertools
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeout, as_completed, wait
+
+from admission import AdmissionControl
+from cache import LocationCache, SingleFlight, ValueCache, ValueReaders
+from errors import (DeadlineExceeded, InvalidDeadline, LookupFailed, NotResponsible, Overloaded, QuorumNotReached,
+                    ValueTooLarge)
+from metrics import HOP_BUCKETS, LATENCY_BUCKETS, Registry
+import rpc
+from peers import PeerPool
+from ring import M, RING_SIZE, Ring, Routing, in_interval, in_open_interval
+from storage import (DEFAULT_CONTENT_TYPE, CompactStore, LogStore, ShardedStore, memory_stats, pack_value, stored_bytes,
+                     unpack_value, value_version)
+from tracing import HOPS_HEADER, TRACE_HEADER, TraceFilter, hop_count, pass_trace, trace_id
+from workers import WORKER_HEADER, WorkerGroup
 
 app = Flask(__name__)
 
+# request path messages are logged at debug level, off unless --log-level debug
+log = logging.getLogger('chord.node')
+
+# set on requests sent straight to the node resolved as the owner
+DIRECT_HEADER = 'X-Chord-Direct'
+# set by the owner on responses, "<address> <range start> <range end>" so earlier hops learn it
+OWNER_HEADER = 'X-Chord-Owner'
+# set on every request a node passes on to another node
+FORWARDED_HEADER = 'X-Chord-Forwarded'
+# address of the ingress node caching the value, the owner pushes invalidations to it
+CACHE_NODE_HEADER = 'X-Chord-Cache-Node'
+
+# set on copies of a value the owner sends to its replicas, and on reads of those copies
+REPLICA_HEADER = 'X-Chord-Replica'
+# milliseconds left to answer a request, every hop passes on what remains of it
+DEADLINE_HEADER = 'X-Chord-Deadline'
+
+# headers of one connection, not passed on when a request is handed to another worker
+HOP_BY_HOP_HEADERS = {'host', 'connection', 'keep-alive', 'transfer-encoding', 'date', 'server'}
+
+# values are read and relayed in chunks of this size, smaller bodies are handled whole
+STREAM_CHUNK = 64 * 1024
+
+# latest version of the holder when a range copy started, later copies only ask for newer writes
+VERSION_HEADER = 'X-Chord-Version'
+# key ranges are handed over as a stream of records: key digest, value length, then the stored value
+RANGE_RECORD = struct.Struct('>20sI')
+
+# number of locks that writes of different keys are spread over
+KEY_LOCK_STRIPES = 64
+
+# the closest preceding node is skipped for one of the next few when it is this many times slower
+ROUTE_CHOICES = 3
+SLOW_PEER_FACTOR = 2.0
+
 # hash function
 def hash_value(value):
-    print(f"Hashing value: {value}", flush=True)
+    log.debug("Hashing value: %s", value)
     return int(hashlib.sha1(value.encode()).hexdigest(), 16)
 
 
+# the reason a key of a batch failed, reported for that key alone
+def batch_error(error):
+    return f"{type(error).__name__}: {error}"
+
+
+# names hashed into the virtual node IDs of an address, the first is the address itself
+def vnode_names(address, count):
+    return [address] + [f"{address}#{i}" for i in range(1, count)]
+
+
+# text of a (body, content_type) value for JSON replies, None stays None
+def decode_value(value):
+    if value is None:
+        return None
+    body, _ = value
+    return (body if isinstance(body, bytes) else b''.join(body)).decode('utf-8', errors='replace')
+
+
+# stream (key_hash, stored value) pairs as range records, in chunks of about STREAM_CHUNK bytes
+def pack_records(records):
+    buffer = bytearray()
+    for key_hash, blob in records:
+        buffer += RANGE_RECORD.pack(key_hash.to_bytes(20, 'big'), len(blob))
+        buffer += blob
+        if len(buffer) >= STREAM_CHUNK:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+# parse the range records of a stream back into (key_hash, stored value) pairs
+def read_records(stream):
+    while True:
+        header = read_exact(stream, RANGE_RECORD.size)
+        if not header:
+            return
+        if len(header) < RANGE_RECORD.size:
+            raise EOFError("Truncated range record")
+        digest, length = RANGE_RECORD.unpack(header)
+        blob = read_exact(stream, length)
+        if len(blob) < length:
+            raise EOFError("Truncated range record")
+        yield int.from_bytes(digest, 'big'), blob
+
+
+# read size bytes from a stream, fewer only at its end
+def read_exact(stream, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+
+# closes the reply of a hedged request that lost the race
+def close_reply(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+# records of a range transfer streamed by another worker, its connection is returned to the pool at the end
+def worker_records(response):
+    try:
+        yield from read_records(response.raw)
+    finally:
+        response.close()
+
+
+# a peer that sheds a request answers 429 or 503 with a Retry-After header
+def raise_if_shed(response):
+    if response.status_code in (429, 503) and 'Retry-After' in response.headers:
+        message = response.text
+        response.close()
+        raise Overloaded(message, retry_after=int(response.headers['Retry-After']))
+
+
+# chunks of a value relayed from another node; its connection, and whatever else release frees, are returned once
+# the chunks are used up or the relay is closed, even if it was never read
+class Relay:
+
+    def __init__(self, response, release=None):
+        self.response = response
+        self.chunks = response.iter_content(STREAM_CHUNK)
+        self.release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.chunks)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        self.response.close()
+        release, self.release = self.release, None
+        if release is not None:
+            release()
+
+
 # represents a node in the DHT
 class Node:
     
     # initializing a node
-    def __init__(self, address):
+    def __init__(self, address, lookup_mode='recursive', peers=None, batch_workers=16, location_cache_size=1024,
+                 value_cache_bytes=0, value_cache_ttl=5.0, value_cache_mode='ttl', data_store=None,
+                 max_value_size=64 * 2**20, replicas=1, write_quorum=1, read_quorum=1, read_policy='owner',
+                 vnodes=1, stabilize_interval=1.0, rpc_client=None, coalesce=True, request_timeout=5.0,
+                 hedge_percentile=95.0, hedge_delay=0.05, hedge_workers=64, admission=None, workers=None):
         self.node_id = hash_value(address)
         self.address = address
-        self.successor = None
-        self.predecessor = None
-        self.data_store = {}
-        self.finger_table = []
-        self.node_hashes = {}
+
+        # this node joins the ring at vnodes IDs, the first one is node_id
+        self.vnodes = vnodes
+        # a plain dict, or a store with the same interface such as CompactStore or LogStore, values are bytes
+        self.data_store = data_store if data_store is not None else {}
+        self.max_value_size = max_value_size
+
+        # every value is kept on the responsible node and its next replicas - 1 successors
+        self.replicas = replicas
+        self.write_quorum = write_quorum
+        self.read_quorum = read_quorum
+        self.read_policy = read_policy  # 'owner', 'round-robin' or 'latency'
+        self.read_counter = itertools.count()
+        self.version_lock = threading.Lock()
+        self.last_version = 0
+
+        # writes of a key hash are serialized on one of these stripes, readers take no lock
+        self.key_locks = [threading.Lock() for _ in range(KEY_LOCK_STRIPES)]
+
+        # 'recursive' forwards requests hop by hop, 'iterative' resolves the owner first
+        self.lookup_mode = lookup_mode
+
+        # keep-alive connections to the other nodes
+        self.peers = peers or PeerPool()
+        # node-to-node requests use the binary protocol instead of HTTP when a client is given
+        self.rpc = rpc_client
+
+        # threads for batch lookups and sub-batches sent in parallel
+        self.executor = ThreadPoolExecutor(max_workers=batch_workers)
+
+        # learned key ranges -> owner, cleared whenever the ring membership changes
+        self.locations = LocationCache(location_cache_size)
+
+        # optional read cache of hot values; in 'invalidate' mode owners also push invalidations
+        self.values = ValueCache(value_cache_bytes, value_cache_ttl) if value_cache_bytes > 0 else None
+        self.value_cache_mode = value_cache_mode if self.values is not None else None
+        self.value_readers = ValueReaders()  # key_hash -> addresses of nodes caching its value
+
+        # concurrent forwarded GETs of the same key share one upstream request
+        self.flights = SingleFlight() if coalesce else None
+
+        # requests without a deadline header have request_timeout seconds, across all their hops
+        self.request_timeout = request_timeout
+
+        # a forwarded GET that takes longer than the hedge_percentile response time of its peer is also sent to an
+        # alternate next hop, peers without measured response times get hedge_delay seconds; 0 disables hedging
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.hedges = ThreadPoolExecutor(max_workers=hedge_workers) if hedge_percentile > 0 else None
+        self.hedge_lock = threading.Lock()
+        self.hedge_counts = {'sent': 0, 'won': 0}
+
+        # optional AdmissionControl bounding the PUTs and GETs in progress, excess ones queue or are shed
+        self.admission = admission
+
+        # the WorkerGroup when this node runs as several processes, this one holds the keys of its stripe;
+        # membership changes are published to the other workers, membership_epoch is the last one adopted
+        self.workers = workers
+        self.membership_epoch = 0
+
+        # request counters and latencies and hop count distributions, exported at /metrics with the other statistics
+        self.metrics = Registry()
+        self.requests_served = self.metrics.counter(
+            'chord_requests_total', "Requests answered, by route, method and status", ('route', 'method', 'status'))
+        self.request_latency = self.metrics.histogram(
+            'chord_request_duration_seconds', "Time to answer a request, by route and method", LATENCY_BUCKETS,
+            ('route', 'method'))
+        self.forward_hops = self.metrics.histogram(
+            'chord_forward_hops', "Forwards a client PUT or GET took to reach the node that answered it", HOP_BUCKETS,
+            ('method',))
+        self.lookup_hops = self.metrics.histogram(
+            'chord_lookup_hops', "Routing steps of iterative lookups", HOP_BUCKETS)
+        self.metrics.collector(self.collect_metrics)
+
+        # cache of virtual node name -> ID, so each member is only hashed once
+        self.node_hashes = {name: hash_value(name) for name in vnode_names(address, vnodes)[1:]}
+        self.node_hashes[address] = self.node_id
+        self.node_ids = sorted(self.node_hashes.values())  # IDs of this node's virtual nodes
+
+        # routing state, replaced as a whole whenever the membership changes, never modified in place
+        ring = Ring((node_id, self.address) for node_id in self.node_ids)
+        self.routing = Routing(0, {self.address: vnodes}, ring, {}, None, None, None, None)
+
+        # members are learned and dropped by the background stabilization, one at a time;
+        # the lock only orders membership changes, readers use the published routing state without it
+        self.membership_lock = threading.Lock()
+        self.stabilize_interval = stabilize_interval
+        self.next_finger = 0
+        self.departed = threading.Event()  # set once this node left the ring
         
         # log the current node's initialization
-        print(f"Initializing node with address {self.address} and ID hash {self.node_id}", flush=True)
+        log.info("Initializing node with address %s and ID hash %s", self.address, self.node_id)
 
-    def update_successor_predecessor(self, node_list):
-        """Update successor and predecessor based on the sorted node list, then drop the node list."""
-        
-        # cache node hashes to avoid redundant hashing
-        for node in node_list:
-            if node not in self.node_hashes:
-                self.node_hashes[node] = hash_value(node)
-                print(f"Hashed and added node {node} with hash {self.node_hashes[node]}", flush=True)
+    def update_successor_predecessor(self, node_list, vnode_counts=None):
+        """
+        Rebuild the ring index from the node list and update successor and predecessor.
+        vnode_counts maps addresses to their number of virtual nodes, unlisted members have as many as this node.
+        """
 
         # ensure the current node's address is part of the known nodes
         if self.address not in node_list:
-            print(f"Adding current node {self.address} to the known nodes list.", flush=True)
+            log.info("Adding current node %s to the known nodes list.", self.address)
             node_list.append(self.address)
-            self.node_hashes[self.address] = self.node_id
 
-        # sort based on hash values and update successor/predecessor
-        sorted_nodes = sorted(node_list, key=lambda node: hash_value(node))
-        self_hash = self.node_id
+        vnode_counts = vnode_counts or {}
+        members = {node: vnode_counts.get(node, self.vnodes) for node in node_list}
+        members[self.address] = self.vnodes
+        with self.membership_lock:
+            self.rebuild_ring(members)
 
-        index = sorted_nodes.index(self.address)
-        self.successor = sorted_nodes[(index + 1) % len(sorted_nodes)]
-        self.predecessor = sorted_nodes[(index - 1) % len(sorted_nodes)]
+    def rebuild_ring(self, members, share=True):
+        """
+        Build the routing state of members, address -> number of virtual nodes, and publish it in one assignment.
+        Called with the membership lock held; members must not be modified afterwards. Unless share is False,
+        the other workers of this node rebuild from the same members.
+        """
+        # reuse cached node hashes, only new virtual nodes are hashed
+        node_hashes = {}
+        entries = []
+        for node, count in members.items():
+            for name in vnode_names(node, count):
+                node_id = self.node_hashes.get(name)
+                if node_id is None:
+                    node_id = hash_value(name)
+                    log.debug("Hashed and added node %s with hash %s", name, node_id)
+                node_hashes[name] = node_id
+                entries.append((node_id, node))
 
-        # after setting successor and predecessor, drop the full node list
-        print(f"Dropping known nodes list after setting up the ring.", flush=True)
+        ring = Ring(entries)
 
-        # update finger table after setting successor and predecessor
-        self.update_finger_table()
+        # entry i of the finger table of virtual node n is the successor of (n + 2^i) mod 2^m
+        finger_tables = {vnode_id: [ring.finger((vnode_id + 2**i) % RING_SIZE) for i in range(M)]
+                         for vnode_id in self.node_ids}
 
-        # clear known_nodes to make sure it is not used after the setup
-        self.node_hashes = {}
+        # successor and predecessor are the neighbouring physical nodes, ordered by their first ID
+        neighbours = Ring((node_hashes[node], node) for node in members)
+        (successor, successor_id), (predecessor, predecessor_id) = neighbours.neighbours(self.node_id)
 
-    def get_address_by_hash(self, node_hash):
-        """Helper function to get the address corresponding to a node hash."""
-        for node, hashed_value in self.node_hashes.items():
-            if hashed_value == node_hash:
-                return node
-        return None
+        # the cache only keeps current members, departed nodes are dropped
+        self.node_hashes = node_hashes
+        self.routing = Routing(self.routing.epoch + 1, members, ring, finger_tables,
+                               successor, successor_id, predecessor, predecessor_id)
 
+        # a new ring epoch, learned owners may be stale
+        self.locations.clear()
+        if share and self.workers is not None:
+            self.membership_epoch = self.workers.membership.publish(members)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Finger table for node %s updated: %s", self.address, self.finger_addresses())
 
-    def update_finger_table(self):
-        """Updates the finger table for a node."""
-        m = 160  # number of finger entries due to SHA-1 hashing
-        
-        self.finger_table = []
-        
-        # populate the finger table
-        for i in range(m):
-            start = (self.node_id + 2**i) % (2**m)
-            successor = self.find_successor(start)
-            
-            if successor and successor not in self.finger_table:
-                self.finger_table.append(successor)
-        print(f"Finger table for node {self.address} updated: {self.finger_table}", flush=True)
+    def sync_membership(self):
+        """Adopt a membership another worker of this node published since, called before handling a request."""
+        if self.workers is None or self.workers.membership.epoch.value == self.membership_epoch:
+            return
+        with self.membership_lock:
+            epoch, members = self.workers.membership.read()
+            if epoch != self.membership_epoch:
+                self.rebuild_ring(members, share=False)
+                self.membership_epoch = epoch
+
+    def each_worker(self, method, path, **kwargs):
+        """Send a request to every other worker of this node, returns their responses."""
+        headers = dict(kwargs.pop('headers', {}), **{WORKER_HEADER: '1'})
+        return [self.peers.request(method, address, path, headers=headers, **kwargs)
+                for address in self.workers.others()]
+
+    def change_members(self, change):
+        """
+        Rebuild the ring from change(members) of the current members, unless it returns None; returns True if the
+        ring changed. With several workers the change applies to the members they share, under their lock, so changes
+        made by two workers at once both take effect. Called with the membership lock held.
+        """
+        if self.workers is None:
+            members = change(dict(self.routing.members))
+            if members is not None:
+                self.rebuild_ring(members)
+            return members is not None
+        epoch, members, changed = self.workers.membership.update(change, self.routing.members)
+        if epoch != self.membership_epoch:
+            self.rebuild_ring(members, share=False)
+            self.membership_epoch = epoch
+        return changed
+
+    def learn_members(self, members):
+        """Add members announced as {'address', 'vnodes'} to the ring, returns True if the ring changed."""
+        def learn(known):
+            changed = False
+            for member in members:
+                if known.get(member['address']) != member['vnodes'] and member['address'] != self.address:
+                    known[member['address']] = member['vnodes']
+                    log.info("Learned member %s with %s virtual nodes", member['address'], member['vnodes'])
+                    changed = True
+            return known if changed else None
+
+        with self.membership_lock:
+            return self.change_members(learn)
+
+    def forget_member(self, node):
+        """Drop a member that left or stopped answering."""
+        def forget(known):
+            if node == self.address or node not in known:
+                return None
+            log.info("Dropped member %s", node)
+            return {member: count for member, count in known.items() if member != node}
+
+        with self.membership_lock:
+            self.change_members(forget)
+
+    def member_info(self):
+        return {'address': self.address, 'vnodes': self.vnodes}
+
+    def neighbour_members(self):
+        """This node and the predecessors of its virtual nodes, announced to the nodes that stabilize with it."""
+        routing = self.routing
+        nodes = {self.address} | {routing.ring.predecessor(node_id) for node_id in self.node_ids}
+        return [{'address': node, 'vnodes': routing.members.get(node, self.vnodes)} for node in nodes]
+
+    def owns(self, key_hash):
+        """Check if the key hash lies in (predecessor, vnode] of one of this node's virtual nodes."""
+        return self.routing.ring.successor(key_hash) == self.address
+
+    def holds(self, key_hash):
+        """Check if this node owns the key hash and, with several workers, this worker keeps it."""
+        return self.owns(key_hash) and (self.workers is None or self.workers.holds(key_hash))
+
+    def owner_range(self, key_hash):
+        """Key hash range (start, end] of the virtual node responsible for key_hash."""
+        return self.routing.ring.arc(key_hash)
+
+    def location_header(self, key_hash):
+        """Advertise the range of the key to the nodes that forwarded a request here."""
+        start, end = self.owner_range(key_hash)
+        return f"{self.address} {start:040x} {end:040x}"
+
+    def learn_location(self, response, response_headers=None):
+        """Remember the owner advertised on a forwarded response and pass it back to our caller."""
+        header = response.headers.get(OWNER_HEADER)
+        if not header:
+            return
+        owner, start, end = header.split()
+        self.locations.add(int(start, 16), int(end, 16), owner)
+        if response_headers is not None:
+            response_headers[OWNER_HEADER] = header
+
+    def finger_addresses(self, routing=None):
+        """Distinct addresses in the finger tables, in finger order."""
+        finger_tables = (routing or self.routing).finger_tables
+        return list(dict.fromkeys(finger.address for vnode_id in self.node_ids
+                                  for finger in finger_tables.get(vnode_id, ())))
+
+    def neighbour_addresses(self):
+        """Successor, predecessor and fingers of this node, the other nodes a crawl of the ring visits from here."""
+        routing = self.routing
+        nodes = [routing.successor, routing.predecessor] + self.finger_addresses(routing)
+        return list(dict.fromkeys(node for node in nodes if node is not None and node != self.address))
+
+    def topology(self):
+        """Successor, predecessor and finger summary of this node."""
+        routing = self.routing
+        fingers = self.finger_addresses(routing)
+        return {
+            'address': self.address,
+            'node_id': f"{self.node_id:040x}",
+            'vnodes': self.vnodes,
+            'epoch': routing.epoch,
+            'members': len(routing.members),
+            'successor': routing.successor,
+            'successor_id': None if routing.successor_id is None else f"{routing.successor_id:040x}",
+            'predecessor': routing.predecessor,
+            'predecessor_id': None if routing.predecessor_id is None else f"{routing.predecessor_id:040x}",
+            'fingers': {'distinct': len(fingers), 'addresses': fingers},
+        }
+
+    def finger_table_detail(self):
+        """Every finger of every virtual node with its start, the ID it points to and its address."""
+        finger_tables = self.routing.finger_tables
+        return [{'vnode': f"{vnode_id:040x}", 'i': i, 'start': f"{finger.start:040x}", 'id': f"{finger.node_id:040x}",
+                 'address': finger.address}
+                for vnode_id in self.node_ids for i, finger in enumerate(finger_tables.get(vnode_id, ()))]
+
+    def closest_vnode(self, key_hash):
+        """ID of this node's virtual node that most closely precedes the key hash."""
+        return self.node_ids[bisect.bisect_left(self.node_ids, key_hash) - 1]
 
     def find_successor(self, key_hash):
-        """Find the successor of the given key hash using finger table and neighbors."""
-        if self.predecessor and self.predecessor not in self.node_hashes:
-            self.node_hashes[self.predecessor] = hash_value(self.predecessor)
-
-        # If the key is between this node and its successor, return the successor
-        if self.predecessor is None or (self.node_hashes[self.predecessor] < key_hash <= self.node_id):
-            return self.address
-
-        # Use finger table to find the closest node to the key
-        find_closest_node = self.find_closest_node(key_hash)
-        if find_closest_node:
-            return find_closest_node
-
-        # Fallback to successor if no closer node is found
-        return self.successor if self.successor != self.address else None
-
-    def find_closest_node(self, key_hash):
-        """ Find the closest preceding node in the finger table for a given key hash. """
-        for i in reversed(range(len(self.finger_table))):
-            finger_node_hash = hash_value(self.finger_table[i])
-            if self.node_id < finger_node_hash < key_hash:
-                return self.finger_table[i]
-        return self.successor
+        """Find the node to hand the key hash to, returns (node, True) when that node is responsible for it."""
+        # one snapshot for the whole decision, a concurrent ring update cannot mix two rings
+        routing = self.routing
+
+        # If the key is between the predecessor and one of this node's virtual nodes, this node is the successor
+        if routing.ring.successor(key_hash) == self.address:
+            return self.address, True
+
+        # If the key is between the closest preceding virtual node and its successor, the successor is responsible
+        vnode_id = self.closest_vnode(key_hash)
+        successor = routing.ring.finger((vnode_id + 1) % RING_SIZE)
+        if in_interval(key_hash, vnode_id, successor.node_id):
+            return successor.address, True
+
+        # Otherwise route through a preceding finger of that virtual node, the closest one unless it is slow
+        nodes = self.preceding_nodes(key_hash, vnode_id, routing)
+        return (self.pick_hop(nodes) if nodes else routing.successor), False
+
+    def preceding_nodes(self, key_hash, vnode_id, routing):
+        """Distinct fingers of a virtual node that precede the key hash, closest first, then the successor."""
+        nodes = [finger.address for finger in reversed(routing.finger_tables.get(vnode_id, ()))
+                 if in_open_interval(finger.node_id, vnode_id, key_hash)]
+        nodes.append(routing.successor)
+        return list(dict.fromkeys(node for node in nodes if node is not None and node != self.address))
+
+    def pick_hop(self, nodes):
+        """
+        The first of the candidate next hops, unless it is SLOW_PEER_FACTOR times slower than the fastest of the
+        first ROUTE_CHOICES, which are at most a few hops behind it. Peers not measured yet count as fast.
+        """
+        choices = nodes[:ROUTE_CHOICES]
+        latencies = [self.peers.latency(node) or 0.0 for node in choices]
+        fastest = min(range(len(choices)), key=latencies.__getitem__)
+        if latencies[0] > SLOW_PEER_FACTOR * latencies[fastest]:
+            return choices[fastest]
+        return choices[0]
+
+    def alternate_hop(self, key_hash, node):
+        """Another next hop towards the owner of the key hash than node, or None if there is none."""
+        routing = self.routing
+        vnode_id = self.closest_vnode(key_hash)
+        nodes = [candidate for candidate in self.preceding_nodes(key_hash, vnode_id, routing) if candidate != node]
+        return self.pick_hop(nodes) if nodes else None
+
+    def find_closest_node(self, key_hash, vnode_id=None, routing=None):
+        """ Find the closest preceding node in the finger table of a virtual node for a given key hash. """
+        routing = routing or self.routing
+        vnode_id = self.node_id if vnode_id is None else vnode_id
+        for finger in reversed(routing.finger_tables.get(vnode_id, ())):
+            if in_open_interval(finger.node_id, vnode_id, key_hash):
+                return finger.address
+        return routing.successor
+
+    def lookup(self, key_hash, start_node=None, deadline=None):
+        """
+        Resolve the responsible node iteratively through /find_successor, returns (owner, hops).
+        The lookup starts at this node, or at start_node while this node does not know the ring yet.
+        """
+        if start_node is None:
+            node, done = self.find_successor(key_hash)
+        else:
+            node, done = start_node, False
+        start, end = self.owner_range(key_hash) if done else (None, None)
+        hops = 0
+        while not done:
+            # a lookup never needs more hops than there are fingers
+            if hops > M:
+                raise LookupFailed(f"Lookup for {key_hash:040x} did not converge")
+            reply = self.find_successor_at(node, key_hash, deadline)
+            node, done = reply['node'], reply['done']
+            if done:
+                start, end = int(reply['start'], 16), int(reply['end'], 16)
+            hops += 1
+        self.locations.add(start, end, node)
+        self.lookup_hops.observe(hops)
+        log.debug("Resolved %040x to %s in %s hops", key_hash, node, hops)
+        return node, hops
+
+    def find_successor_at(self, node, key_hash, deadline=None):
+        """One routing step of a lookup at another node, returns the reply of its /find_successor."""
+        timeout = self.peer_timeout(deadline)
+        if self.rpc is not None:
+            return self.rpc.lookup(node, key_hash, timeout[1])
+        response = self.peers.get(node, f"/find_successor/{key_hash:040x}", timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def send_storage(self, method, node, key, body=None, headers=None, deadline=None):
+        """
+        Send a PUT or GET of a key to another node. Whole values go over the binary protocol when it is enabled,
+        streamed PUT bodies and every request without it over HTTP.
+        """
+        timeout = self.peer_timeout(deadline)
+        if self.rpc is not None and (method == 'GET' or isinstance(body, bytes)):
+            return self.rpc.storage(method, node, key, None if body is None else self.read_body(body), headers,
+                                    timeout[1])
+        if method == 'PUT':
+            data = self.read_body(body) if isinstance(body, bytes) else self.stream_body(body)
+            return self.peers.put(node, f"/storage/{key}", data=data, headers=headers, timeout=timeout)
+        return self.peers.get(node, f"/storage/{key}", stream=True, headers=headers, timeout=timeout)
+
+    def deadline(self, headers):
+        """Monotonic time by which a request has to be answered, from its deadline header or the request timeout."""
+        budget = headers.get(DEADLINE_HEADER)
+        if not budget:
+            return time.monotonic() + self.request_timeout
+        try:
+            budget = int(budget)
+        except ValueError:
+            budget = -1
+        if budget < 0:
+            raise InvalidDeadline(f"{DEADLINE_HEADER} is not a number of milliseconds: {headers[DEADLINE_HEADER]}")
+        return time.monotonic() + budget / 1000
+
+    def remaining(self, deadline):
+        """Seconds left until the deadline, raises DeadlineExceeded once it passed."""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Deadline exceeded by {-remaining * 1000:.0f} ms")
+        return remaining
+
+    def peer_timeout(self, deadline):
+        """(connect, read) timeout of a request to a peer, no longer than what is left until the deadline."""
+        if deadline is None:
+            return self.peers.timeout
+        remaining = self.remaining(deadline)
+        return min(self.peers.timeout[0], remaining), remaining
+
+    def admitted(self, headers, deadline, weight=1):
+        """Hold the admission slots of a request of weight keys in its traffic class while the block runs."""
+        if self.admission is None:
+            return contextlib.nullcontext()
+        return self.admission.slot(FORWARDED_HEADER in headers, deadline, weight)
+
+    def route(self, key_hash, deadline=None):
+        """Pick where to send a request for the key hash, returns (node, direct)."""
+        # a learned owner is contacted directly, in one hop
+        owner = self.locations.get(key_hash)
+        if owner is not None:
+            return owner, True
+        if self.lookup_mode == 'iterative':
+            try:
+                owner, _ = self.lookup(key_hash, deadline=deadline)
+                return owner, True
+            except LookupFailed as e:
+                # forwarding hop by hop still reaches the owner once the ring settles
+                log.warning("%s, forwarding hop by hop", e)
+                self.locations.invalidate(key_hash)
+        node, _ = self.find_successor(key_hash)
+        return node, False
+
+    def forward_headers(self, headers, direct, deadline=None):
+        """Headers for a request passed on to the next node."""
+        forward = {FORWARDED_HEADER: '1', HOPS_HEADER: str(hop_count(headers) + 1), TRACE_HEADER: trace_id.get()}
+        if direct:
+            forward[DIRECT_HEADER] = '1'
+        if deadline is not None:
+            forward[DEADLINE_HEADER] = str(int(self.remaining(deadline) * 1000))
+        # the ingress node asks the owner to push invalidations of values it caches
+        cache_node = headers.get(CACHE_NODE_HEADER)
+        if cache_node is None and FORWARDED_HEADER not in headers and self.value_cache_mode == 'invalidate':
+            cache_node = self.address
+        if cache_node:
+            forward[CACHE_NODE_HEADER] = cache_node
+        return forward
+
+    def invalidate_readers(self, key_hash, readers=None):
+        """Push an invalidation to the nodes caching the value of key_hash."""
+        for reader in readers if readers is not None else self.value_readers.pop(key_hash):
+            self.executor.submit(self._send_invalidation, reader, key_hash)
+
+    def add_value_reader(self, key_hash, reader):
+        """Remember a node caching the value of key_hash, readers evicted to make room are invalidated at once."""
+        for evicted, readers in self.value_readers.add(key_hash, reader):
+            self.invalidate_readers(evicted, readers)
+
+    def _send_invalidation(self, reader, key_hash):
+        try:
+            self.peers.post(reader, "/cache/invalidate", json={'keys': [f"{key_hash:040x}"]})
+        except requests.exceptions.RequestException as e:
+            log.warning("Error invalidating %040x at %s: %s", key_hash, reader, e)
+
+    def read_body(self, body):
+        """Read a whole value, either bytes already or a stream, enforcing the maximum value size."""
+        if isinstance(body, bytes):
+            if len(body) > self.max_value_size:
+                raise ValueTooLarge(len(body))
+            return body
+        data = bytearray()
+        for chunk in self.stream_body(body):
+            data += chunk
+        return bytes(data)
+
+    def stream_body(self, body):
+        """Pass a value on chunk by chunk, enforcing the maximum value size."""
+        if isinstance(body, bytes):
+            yield self.read_body(body)
+            return
+        size = 0
+        while True:
+            chunk = body.read(STREAM_CHUNK)
+            if not chunk:
+                return
+            size += len(chunk)
+            if size > self.max_value_size:
+                raise ValueTooLarge(size)
+            yield chunk
+
+    def relay(self, response):
+        """Stream an upstream response body chunk by chunk, returning its connection to the pool at the end."""
+        return Relay(response)
+
+    def new_version(self):
+        """Version for a write accepted by this node, increasing even if the clock does not."""
+        with self.version_lock:
+            self.last_version = max(time.time_ns(), self.last_version + 1)
+            return self.last_version
+
+    def key_lock(self, key_hash):
+        """Lock stripe of a key hash, held while its stored value is read and replaced."""
+        return self.key_locks[key_hash % KEY_LOCK_STRIPES]
+
+    def store_owned(self, key, key_hash, data, content_type, deadline=None):
+        """Store a value this node is responsible for and copy it to the replicas."""
+        with self.key_lock(key_hash):
+            blob = pack_value(data, content_type, self.new_version())
+            self.data_store[key_hash] = blob
+        self.invalidate_readers(key_hash)
+        self.replicate(key, key_hash, blob, deadline)
+
+    def store_replica(self, key_hash, blob):
+        """Store a copy sent by the owner, unless a newer version is already stored."""
+        with self.key_lock(key_hash):
+            current = self.data_store.get(key_hash)
+            if current is None or value_version(current) < value_version(blob):
+                self.data_store[key_hash] = blob
+
+    def replicate(self, key, key_hash, blob, deadline=None):
+        """
+        Copy a value to the next successors, waiting until the write quorum has acknowledged it or the request
+        deadline has passed.
+        """
+        if self.replicas <= 1:
+            return
+        replicas = self.routing.ring.replicas(key_hash, self.replicas)
+        futures = [self.executor.submit(contextvars.copy_context().run, self._send_replica, node, key, blob)
+                   for node in replicas if node != self.address]
+
+        # this node counts towards the quorum, the remaining copies complete in the background
+        needed = min(self.write_quorum, len(replicas)) - 1
+        if needed <= 0:
+            return
+        acks = 0
+        timeout = self.peers.timeout[1] if deadline is None else max(deadline - time.monotonic(), 0)
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                if future.result():
+                    acks += 1
+                    if acks >= needed:
+                        return
+        except FutureTimeout:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise DeadlineExceeded(f"Deadline passed with {acks + 1} of {needed + 1} copies stored")
+        raise QuorumNotReached(f"Write quorum not reached, {acks + 1} of {needed + 1} copies stored")
+
+    def _send_replica(self, node, key, blob):
+        try:
+            response = self.send_storage('PUT', node, key, blob, headers={
+                REPLICA_HEADER: '1', FORWARDED_HEADER: '1', TRACE_HEADER: trace_id.get(),
+                'Content-Type': 'application/octet-stream'})
+            return response.status_code == 200
+        except requests.exceptions.RequestException as e:
+            log.warning("Error replicating to %s: %s", node, e)
+            return False
+
+    def pick_replicas(self, replicas, count):
+        """Choose which replicas to read from according to the read policy."""
+        if self.read_policy == 'round-robin':
+            start = next(self.read_counter) % len(replicas)
+            replicas = replicas[start:] + replicas[:start]
+        elif self.read_policy == 'latency':
+            # this node answers instantly, peers not measured yet are tried first
+            replicas = sorted(replicas, key=lambda node: 0 if node == self.address else (self.peers.latency(node) or 0))
+        return replicas[:count]
+
+    def replica_get(self, key, key_hash):
+        """
+        Read from read-quorum replicas and return the newest value as (data, content_type), or None. Replicas that
+        do not answer are replaced by the remaining ones, QuorumNotReached is raised if fewer than the quorum answer.
+        """
+        replicas = self.routing.ring.replicas(key_hash, self.replicas)
+        needed = min(self.read_quorum, len(replicas))
+        candidates = self.pick_replicas(replicas, len(replicas))
+        blobs, answers = [], 0
+        while answers < needed and candidates:
+            chosen, candidates = candidates[:needed - answers], candidates[needed - answers:]
+            for answered, blob in self.executor.map(lambda node: self._fetch_replica(node, key, key_hash), chosen):
+                answers += answered
+                if blob is not None:
+                    blobs.append(blob)
+        if answers < needed:
+            raise QuorumNotReached(f"Read quorum not reached, {answers} of {needed} replicas answered")
+        if not blobs:
+            return None
+        return unpack_value(max(blobs, key=value_version))
+
+    def _fetch_replica(self, node, key, key_hash):
+        """Read the copy of a replica, returns (answered, stored value or None)."""
+        if node == self.address:
+            return True, self.data_store.get(key_hash)
+        try:
+            response = self.send_storage('GET', node, key, headers={REPLICA_HEADER: '1', FORWARDED_HEADER: '1'})
+        except requests.exceptions.RequestException as e:
+            log.warning("Error reading replica from %s: %s", node, e)
+            return False, None
+        if response.status_code == 200:
+            return True, response.content
+        response.close()
+        return response.status_code == 404, None
+
+    def stores_locally(self, key_hash, headers):
+        """Check if a PUT is stored here rather than forwarded: a replica copy, or a key this node owns."""
+        return REPLICA_HEADER in headers or self.owns(key_hash)
+
+    def put_locally(self, key, key_hash, body, headers, response_headers=None, deadline=None):
+        """Store a value this node is responsible for, returns None if the PUT has to be forwarded."""
+        # A copy sent by the owner, stored as is unless this node already has a newer version
+        if REPLICA_HEADER in headers:
+            self.store_replica(key_hash, self.read_body(body))
+            return "Stored replica"
+
+        # Check if the current node is responsible for storing the key
+        if self.owns(key_hash):
+            content_type = headers.get('Content-Type') or DEFAULT_CONTENT_TYPE
+            self.store_owned(key, key_hash, self.read_body(body), content_type, deadline)
+            log.debug("Data stored locally at %s for key_hash: %s", self.address, key_hash)
+            if response_headers is not None:
+                response_headers[OWNER_HEADER] = self.location_header(key_hash)
+            return "Stored locally"
+
+        # The sender resolved this node as the owner, but it is not
+        if DIRECT_HEADER in headers:
+            raise NotResponsible(key_hash)
+
+        # our own cached copy is stale after this write
+        if self.values is not None:
+            self.values.invalidate(key_hash)
+        return None
 
     # function to store a key-value pair in the node
-    def put(self, key, value):
+    def put(self, key, body, headers=None, response_headers=None):
+        """Store a value, body is bytes or a stream that is passed on to the next hop without buffering."""
+        headers = headers or {}
+        content_type = headers.get('Content-Type') or DEFAULT_CONTENT_TYPE
         # hashing the key
         key_hash = hash_value(key)
-        print(f"Storing key: {key}, hash: {key_hash} at node {self.address}", flush=True)
+        deadline = self.deadline(headers)
+        with self.admitted(headers, deadline):
+            log.debug("Storing key: %s, hash: %s at node %s", key, key_hash, self.address)
 
-        # Check if the current node is responsible for storing the key
-        if (self.predecessor is None or 
-            (hash_value(self.predecessor) < key_hash <= self.node_id) or 
-            (self.node_id < hash_value(self.predecessor) and (key_hash > hash_value(self.predecessor) or key_hash <= self.node_id))):
-            self.data_store[key_hash] = value
-            print(f"Data stored locally at {self.address} for key_hash: {key_hash}", flush=True)
-            return "Stored locally"
+            stored = self.put_locally(key, key_hash, body, headers, response_headers, deadline)
+            if stored is not None:
+                return stored
 
-        # Find the closest preceding node using the finger table
-        closest_node = self.find_closest_node(key_hash)
+            closest_node = None
+            try:
+                # Find the owner (iterative) or the next hop (recursive)
+                closest_node, forward_direct = self.route(key_hash, deadline)
 
-        # If the closest node is this node itself, store locally
-        if closest_node == self.address:
-            self.data_store[key_hash] = value
-            print(f"Data stored locally at {self.address} as closest node.", flush=True)
-            return "Stored locally"
+                # Forward the PUT request to the node found, streaming bodies are relayed chunk by chunk
+                log.debug("Forwarding PUT request to %s for key %s", closest_node, key)
+                forward = self.forward_headers(headers, forward_direct, deadline)
+                forward['Content-Type'] = content_type
+                response = self.send_storage('PUT', closest_node, key, body, headers=forward, deadline=deadline)
+                if response.status_code == 421:
+                    self.locations.invalidate(key_hash)
+                    # the owner changed since the lookup, fall back to recursive routing if the body can be resent
+                    if isinstance(body, bytes):
+                        closest_node, _ = self.find_successor(key_hash)
+                        forward = self.forward_headers(headers, False, deadline)
+                        forward['Content-Type'] = content_type
+                        response = self.send_storage('PUT', closest_node, key, body, headers=forward, deadline=deadline)
+                # a streamed body is used up, the client resends it
+                if response.status_code == 421:
+                    raise NotResponsible(key_hash)
+                if response.status_code == 413:
+                    raise ValueTooLarge(response.text)
+                raise_if_shed(response)
+                if response.status_code == 503:
+                    raise QuorumNotReached(response.text)
+                if response.status_code == 504:
+                    raise DeadlineExceeded(response.text)
+                self.learn_location(response, response_headers)
+                pass_trace(response, headers, response_headers)
+                log.debug("Response from closest node %s: %s", closest_node, response.text)
+                return response.text
+            except (ValueTooLarge, QuorumNotReached, DeadlineExceeded, Overloaded, NotResponsible):
+                raise
+            except requests.exceptions.ReadTimeout:
+                # the read timeout is what was left of the deadline
+                raise DeadlineExceeded(f"No reply from {closest_node} within the deadline")
+            except Exception as e:
+                log.warning("Error forwarding to %s: %s", closest_node, e)
+                self.locations.invalidate(key_hash)
+                return str(e)
 
-        try:
-            # Forward the PUT request to the closest node found
-            print(f"Forwarding PUT request to {closest_node} for key {key}", flush=True)
-            response = requests.put(f"http://{closest_node}/storage/{key}", data=value)
-            print(f"Response from closest node {closest_node}: {response.text}", flush=True)
-            return response.text
-        except Exception as e:
-            print(f"Error forwarding to {closest_node}: {e}", flush=True)
-            return str(e)
 
+    def get_locally(self, key, key_hash, headers, response_headers=None):
+        """Answer a GET from the replicas, the local store or the value cache, returns (answered, value)."""
+        # The ingress node reads from the replicas when reads are spread or need a quorum
+        ingress = FORWARDED_HEADER not in headers
+        if ingress and self.replicas > 1 and (self.read_policy != 'owner' or self.read_quorum > 1):
+            value = self.replica_get(key, key_hash)
+            if value is not None:
+                return True, value
+
+        # remember who caches the value before reading it, a write stored after the read then invalidates the copy
+        cache_node = headers.get(CACHE_NODE_HEADER)
+        if cache_node and REPLICA_HEADER not in headers and self.owns(key_hash):
+            self.add_value_reader(key_hash, cache_node)
+
+        # Check if the key is stored locally
+        blob = self.data_store.get(key_hash)
+        if REPLICA_HEADER in headers:
+            # replica reads are answered from the local copy only, as stored
+            return True, (None if blob is None else (blob, 'application/octet-stream'))
+        if blob is not None:
+            log.debug("Found key %s in node %s", key, self.address)
+            if self.owns(key_hash):
+                if response_headers is not None:
+                    response_headers[OWNER_HEADER] = self.location_header(key_hash)
+            return True, unpack_value(blob)
+
+        # If this node is responsible, the key does not exist
+        if self.owns(key_hash):
+            log.debug("Key %s not found in node %s", key, self.address)
+            if response_headers is not None:
+                response_headers[OWNER_HEADER] = self.location_header(key_hash)
+            return True, None
+
+        # The sender resolved this node as the owner, but it is not
+        if DIRECT_HEADER in headers:
+            raise NotResponsible(key_hash)
+
+        # Hot values are served from the read cache of the ingress node
+        if ingress and self.values is not None:
+            blob = self.values.get(key_hash)
+            if blob is not None:
+                log.debug("Found key %s in value cache of node %s", key, self.address)
+                return True, unpack_value(blob)
+
+        # Otherwise the request is forwarded
+        return False, None
 
     # function to get a value based on a given key
-    def get(self, key):
+    def get(self, key, headers=None, response_headers=None):
+        """Retrieve a value as (body, content_type), body is bytes or an iterator relaying a large upstream value."""
+        headers = headers or {}
         # hashing the key
         key_hash = hash_value(key)
-        
-        print(f"Retrieving key: {key}, hash: {key_hash} from node {self.address}", flush=True)
+        deadline = self.deadline(headers)
+        with contextlib.ExitStack() as slot:
+            slot.enter_context(self.admitted(headers, deadline))
+            log.debug("Retrieving key: %s, hash: %s from node %s", key, key_hash, self.address)
 
-        # Check if the key is stored locally
-        if key_hash in self.data_store:
-            print(f"Found key {key} in node {self.address}", flush=True)
-            return self.data_store[key_hash]
+            answered, value = self.get_locally(key, key_hash, headers, response_headers)
+            if answered:
+                return value
 
-        # Find the closest preceding node using the finger table
-        closest_node = self.find_closest_node(key_hash)
+            # concurrent GETs of the key share one upstream request, a relayed stream is not shared; callers share
+            # the value and the owner learned with it, the trace and hops are passed back to the leader only
+            if self.flights is None:
+                value, location = self.forward_get(key, key_hash, headers, deadline, response_headers)
+            else:
+                flight = (key_hash, headers.get(CACHE_NODE_HEADER))
+                value, location = self.flights.do(
+                    flight, lambda: self.forward_get(key, key_hash, headers, deadline, response_headers),
+                    shareable=lambda result: result[0] is None or isinstance(result[0][0], bytes), deadline=deadline)
+            if response_headers is not None:
+                response_headers.update(location)
+            # a relayed value holds its admission slot until the last chunk is sent
+            if value is not None and isinstance(value[0], Relay):
+                value[0].release = slot.pop_all().close
+            return value
 
-        # If the closest node is this node itself, the key isn't found locally
-        if closest_node == self.address:
-            print(f"Key {key} not found in node {self.address}", flush=True)
-            return None
+    def forward_get(self, key, key_hash, headers, deadline, response_headers=None):
+        """
+        Forward a GET towards the owner, returns (value, owner headers learned from the reply). The trace and hops
+        of the reply are passed to response_headers.
+        """
+        ingress = FORWARDED_HEADER not in headers
+        location = {}
+        # a fill is tagged before the request, so an invalidation arriving meanwhile drops it
+        fill_version = self.values.fill_version() if ingress and self.values is not None else None
 
+        closest_node = None
         try:
-            # Forward the GET request to the closest node found
-            print(f"Forwarding GET request to {closest_node} for key {key}", flush=True)
-            response = requests.get(f"http://{closest_node}/storage/{key}", timeout=5)
-            # print(f"Forwarding GET request to {closest_node} for key {key} With flask", flush=True)
-            # response = get_value()
-            
+            # Find the owner (iterative) or the next hop (recursive)
+            closest_node, forward_direct = self.route(key_hash, deadline)
+
+            # Forward the GET request to the node found
+            log.debug("Forwarding GET request to %s for key %s", closest_node, key)
+            response = self.hedged_get(key, key_hash, closest_node, forward_direct, headers, deadline)
+            if response.status_code == 421:
+                # the owner changed since the lookup, fall back to recursive routing
+                response.close()
+                self.locations.invalidate(key_hash)
+                closest_node, _ = self.find_successor(key_hash)
+                response = self.hedged_get(key, key_hash, closest_node, False, headers, deadline)
+            self.learn_location(response, location)
+            pass_trace(response, headers, response_headers)
+
+            if response.status_code != 200:
+                response.close()
+            if response.status_code == 504:
+                raise DeadlineExceeded(response.text)
             response.raise_for_status()
-            return response.text
+            content_type = response.headers.get('Content-Type', DEFAULT_CONTENT_TYPE)
+
+            # small values are read whole and may be cached, large ones are relayed as they arrive
+            length = response.headers.get('Content-Length')
+            if length is None or int(length) > STREAM_CHUNK:
+                return (self.relay(response), content_type), location
+            data = response.content
+            if fill_version is not None:
+                self.values.put(key_hash, pack_value(data, content_type), fill_version)
+            return (data, content_type), location
+        except requests.exceptions.ReadTimeout:
+            # the read timeout is what was left of the deadline
+            self.locations.invalidate(key_hash)
+            raise DeadlineExceeded(f"No reply from {closest_node} within the deadline")
         except requests.exceptions.Timeout:
-            print(f"Request to {closest_node} timed out.", flush=True)
-            return None
+            log.warning("Request to %s timed out.", closest_node)
+            self.locations.invalidate(key_hash)
+            return None, location
         except requests.exceptions.RequestException as e:
-            print(f"Error during GET request to {closest_node}: {e}", flush=True)
+            log.warning("Error during GET request to %s: %s", closest_node, e)
+            if e.response is None:
+                self.locations.invalidate(key_hash)
+            return None, location
+
+    def hedged_get(self, key, key_hash, node, direct, headers, deadline):
+        """
+        Send a GET to node. If it has not answered within its hedge delay, or failed, the GET is also sent to an
+        alternate next hop; the first reply is returned and the other one is closed once it arrives.
+        """
+        def send(target, target_direct):
+            forward = self.forward_headers(headers, target_direct, deadline)
+            response = self.send_storage('GET', target, key, headers=forward, deadline=deadline)
+            # a hop that sheds the request counts as failed, with hedging the alternate is tried at once
+            raise_if_shed(response)
+            return response
+
+        # only the ingress hop hedges, so hedge traffic does not multiply with the length of the path
+        if self.hedges is None or FORWARDED_HEADER in headers:
+            return send(node, direct)
+        futures = {self.hedges.submit(contextvars.copy_context().run, send, node, direct): node}
+        delay = self.peers.latency_percentile(node, self.hedge_percentile)
+        done, _ = wait(futures, timeout=min(self.hedge_delay if delay is None else delay, self.remaining(deadline)))
+        if not done or next(iter(done)).exception() is not None:
+            alternate = self.alternate_hop(key_hash, node)
+            if alternate is not None:
+                log.debug("Hedging GET request for key %s to %s", key, alternate)
+                self._count_hedge('sent')
+                futures[self.hedges.submit(contextvars.copy_context().run, send, alternate, False)] = alternate
+
+        # replies that lose the race are closed once they arrive
+        error = None
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=self.remaining(deadline), return_when=FIRST_COMPLETED)
+                if not done:
+                    raise DeadlineExceeded(f"No reply from {', '.join(futures.values())} within the deadline")
+                for future in done:
+                    if future.exception() is not None:
+                        error = future.exception()
+                        continue
+                    if futures[future] != node:
+                        self._count_hedge('won')
+                    return future.result()
+        finally:
+            for future in pending:
+                future.add_done_callback(close_reply)
+        raise error
+
+    def _count_hedge(self, counter):
+        with self.hedge_lock:
+            self.hedge_counts[counter] += 1
+
+
+    # function to store and retrieve many keys at once
+    def batch(self, puts, gets, headers=None):
+        """Handle a batch of PUTs and GETs, sending one sub-batch to each responsible node in parallel.
+
+        Batches travel as JSON, so their values are text, they are stored as UTF-8 bytes. Keys that failed are
+        listed under 'errors' with the reason, the other keys of the batch are answered as usual.
+        """
+        headers = headers or {}
+        deadline = self.deadline(headers)
+        results = {'put': {}, 'get': {}, 'errors': {}}
+
+        # keys and values that are not text, such as numbers or null, fail on their own
+        for key, value in puts.items():
+            if not isinstance(value, str):
+                results['put'][key] = results['errors'][key] = batch_error(TypeError("Value is not a string"))
+        for key in gets:
+            if not isinstance(key, str):
+                results['errors'].setdefault(json.dumps(key), batch_error(TypeError("Key is not a string")))
+        puts = {key: value for key, value in puts.items() if key not in results['errors']}
+        gets = [key for key in gets if isinstance(key, str)]
+        key_hashes = {key: hash_value(key) for key in set(puts) | set(gets)}
+        log.debug("Batch of %s PUTs and %s GETs at node %s", len(puts), len(gets), self.address)
+
+        # the sender resolved this node as the owner, the stragglers are routed one by one below
+        route_stragglers = DIRECT_HEADER in headers and self.workers is None
+
+        # the batch is admitted like single requests, taking a slot per key
+        with self.admitted(headers, deadline, weight=len(key_hashes)):
+            # keys owned by this node are handled locally, those of other workers are sent to them like to other owners
+            for key, value in puts.items():
+                if self.holds(key_hashes[key]):
+                    try:
+                        self.store_owned(key, key_hashes[key], value.encode('utf-8'), DEFAULT_CONTENT_TYPE, deadline)
+                        results['put'][key] = "Stored locally"
+                    except (QuorumNotReached, DeadlineExceeded) as e:
+                        results['put'][key] = results['errors'][key] = batch_error(e)
+            for key in gets:
+                if self.holds(key_hashes[key]):
+                    blob = self.data_store.get(key_hashes[key])
+                    results['get'][key] = None if blob is None else decode_value(unpack_value(blob))
+
+            remote = [key for key, key_hash in key_hashes.items() if not self.holds(key_hash)]
+            if remote and not route_stragglers:
+                self._send_sub_batches(remote, puts, gets, key_hashes, results, headers, deadline)
+
+        # each straggler is admitted as a single request by put and get
+        if remote and route_stragglers:
+            for key in remote:
+                try:
+                    if key in puts:
+                        results['put'][key] = self.put(key, puts[key].encode('utf-8'), headers={FORWARDED_HEADER: '1'})
+                    if key in gets:
+                        results['get'][key] = decode_value(self.get(key, headers={FORWARDED_HEADER: '1'}))
+                except (QuorumNotReached, DeadlineExceeded, Overloaded, ValueTooLarge, NotResponsible) as e:
+                    results['errors'][key] = batch_error(e)
+                    if key in puts:
+                        results['put'].setdefault(key, results['errors'][key])
+                    if key in gets:
+                        results['get'].setdefault(key, None)
+        return results
+
+    def _send_sub_batches(self, remote, puts, gets, key_hashes, results, headers, deadline):
+        """Resolve the owner of every remote key and send each owner its keys as one sub-batch, in parallel."""
+        groups = {}
+        owners = self.executor.map(self._resolve_owner, [key_hashes[key] for key in remote])
+        for key, owner in zip(remote, owners):
+            if owner is None:
+                results['errors'][key] = "Lookup failed"
+                if key in puts:
+                    results['put'][key] = "Lookup failed"
+                if key in gets:
+                    results['get'][key] = None
+                continue
+            group = groups.setdefault(owner, {'put': {}, 'get': []})
+            if key in puts:
+                group['put'][key] = puts[key]
+            if key in gets:
+                group['get'].append(key)
+
+        forward = self.forward_headers(headers, True, deadline)
+        replies = self.executor.map(lambda owner, group: self._send_batch(owner, group, forward, deadline),
+                                    groups.keys(), groups.values())
+        for (owner, group), reply in zip(groups.items(), replies):
+            if reply is None:
+                results['put'].update({key: f"Error forwarding to {owner}" for key in group['put']})
+                results['get'].update({key: None for key in group['get']})
+                results['errors'].update({key: f"Error forwarding to {owner}"
+                                          for key in [*group['put'], *group['get']]})
+                continue
+            results['put'].update(reply['put'])
+            results['get'].update(reply['get'])
+            results['errors'].update(reply.get('errors', {}))
+
+    def _resolve_owner(self, key_hash):
+        """Owner of the key hash, or None if the lookup failed; the worker keeping it for keys this node owns."""
+        if self.workers is not None and self.owns(key_hash):
+            return self.workers.address(key_hash)
+        owner = self.locations.get(key_hash)
+        if owner is not None:
+            return owner
+        try:
+            owner, _ = self.lookup(key_hash)
+            return owner
+        except (requests.exceptions.RequestException, RuntimeError) as e:
+            log.warning("Lookup of %040x failed: %s", key_hash, e)
+            return None
+
+    def _send_batch(self, owner, group, forward, deadline):
+        """Send a sub-batch straight to its owner with the forward headers, returns the reply or None on failure."""
+        try:
+            response = self.peers.post(owner, "/storage/_batch", json=group, headers=forward,
+                                       timeout=self.peer_timeout(deadline))
+            response.raise_for_status()
+            return response.json()
+        except (requests.exceptions.RequestException, DeadlineExceeded) as e:
+            log.warning("Error sending batch to %s: %s", owner, e)
             return None
 
+    def keyspace_stats(self):
+        """Keyspace fraction of every known member, with this node's virtual nodes and stored keys."""
+        routing = self.routing
+        ownership = routing.ring.ownership()
+        members = {node: {'vnodes': count, 'fraction': ownership.get(node, 0.0)}
+                   for node, count in routing.members.items()}
+        return {'address': self.address, 'vnodes': self.vnodes, 'fraction': ownership.get(self.address, 0.0),
+                'keys': len(self.data_store), 'members': members}
+
+    def cache_stats(self):
+        stats = {'locations': self.locations.stats()}
+        if self.values is not None:
+            stats['values'] = dict(self.values.stats(), mode=self.value_cache_mode)
+        if self.flights is not None:
+            stats['coalescing'] = self.flights.stats()
+        return stats
+
+    def pool_stats(self):
+        stats = self.peers.stats()
+        if self.hedges is not None:
+            with self.hedge_lock:
+                stats['hedging'] = dict(self.hedge_counts, percentile=self.hedge_percentile)
+        return stats
+
+    def observe_request(self, route, method, status, elapsed, hops=None):
+        """Count a request answered in elapsed seconds, hops is given for client PUTs and GETs of keys."""
+        self.requests_served.inc(route, method, status)
+        self.request_latency.observe(elapsed, route, method)
+        if hops is not None:
+            self.forward_hops.observe(hops, method)
+
+    def collect_metrics(self):
+        """Values read at every /metrics scrape: peer request outcomes, hedging, admission and storage."""
+        peers = self.peers.stats()['peers']
+        outcomes = [({'peer': peer, 'outcome': outcome}, counters.get(outcome, 0))
+                    for peer, counters in sorted(peers.items()) for outcome in ('requests', 'errors', 'timeouts')]
+        yield 'chord_peer_requests_total', 'counter', "Requests sent to each peer, by outcome", outcomes
+        yield 'chord_peer_latency_seconds', 'gauge', "Smoothed response time of each peer", \
+            [({'peer': peer}, counters['latency_ewma']) for peer, counters in sorted(peers.items())
+             if 'latency_ewma' in counters]
+        if self.hedges is not None:
+            with self.hedge_lock:
+                hedges = [({'outcome': outcome}, count) for outcome, count in self.hedge_counts.items()]
+            yield 'chord_hedged_requests_total', 'counter', "Hedged GETs sent and won by the alternate", hedges
+        if self.admission is not None:
+            admission = self.admission.stats()
+            classes = [name for name in admission if isinstance(admission[name], dict)]
+            yield 'chord_admission_queue_depth', 'gauge', "Requests waiting for an admission slot", \
+                [({'traffic': name}, admission[name]['queue_depth']) for name in classes]
+            yield 'chord_admission_in_flight', 'gauge', "Requests holding an admission slot", \
+                [({'traffic': name}, admission[name]['in_flight']) for name in classes]
+            yield 'chord_admission_rejected_total', 'counter', "Requests shed with a full admission queue", \
+                [({'traffic': name}, admission[name]['rejected']) for name in classes]
+            yield 'chord_admission_expired_total', 'counter', "Requests whose deadline passed while queued", \
+                [({'traffic': name}, admission[name]['expired']) for name in classes]
+        yield 'chord_stored_keys', 'gauge', "Keys in the data store", [({}, len(self.data_store))]
+        size = stored_bytes(self.data_store)
+        if size is not None:
+            yield 'chord_stored_bytes', 'gauge', "Bytes held by the data store", [({}, size)]
+
+    def admission_stats(self):
+        return self.admission.stats() if self.admission is not None else {}
+
+    def storage_stats(self):
+        return self.data_store.stats() if hasattr(self.data_store, 'stats') else {'keys': len(self.data_store)}
+
+    def start_maintenance(self):
+        """Run stabilize and fix_fingers in the background every stabilize_interval seconds."""
+        threading.Thread(target=self._maintenance_loop, daemon=True).start()
+
+    def _maintenance_loop(self):
+        while not self.departed.wait(self.stabilize_interval):
+            try:
+                self.sync_membership()
+                self.stabilize()
+                self.fix_fingers()
+            except Exception as e:
+                log.warning("Error during stabilization: %s", e)
+
+    def stabilize(self):
+        """Notify the successors of this node's virtual nodes and check its predecessors, learning their neighbours."""
+        ring = self.routing.ring
+        successors = {ring.finger((node_id + 1) % RING_SIZE).address for node_id in self.node_ids}
+        predecessors = {ring.predecessor(node_id) for node_id in self.node_ids}
+        for node in (successors | predecessors) - {self.address}:
+            try:
+                if node in successors:
+                    response = self.peers.post(node, "/chord/notify", json=self.member_info())
+                else:
+                    response = self.peers.get(node, "/chord/info")
+            except requests.exceptions.ConnectionError:
+                self.forget_member(node)
+                continue
+            except requests.exceptions.RequestException as e:
+                log.warning("Error stabilizing with %s: %s", node, e)
+                continue
+            if response.status_code == 410:
+                self.forget_member(node)
+            elif response.status_code == 200:
+                self.learn_members(response.json()['members'])
+
+    def fix_fingers(self):
+        """Refresh the next finger with a lookup through the ring, learning the node it points to if it is new."""
+        routing = self.routing
+        fingers = M * len(self.node_ids)
+        for _ in range(fingers):
+            node_id = self.node_ids[self.next_finger // M]
+            start = (node_id + 2 ** (self.next_finger % M)) % RING_SIZE
+            self.next_finger = (self.next_finger + 1) % fingers
+            # fingers up to the successor are kept right by stabilize
+            if not in_interval(start, node_id, routing.ring.finger((node_id + 1) % RING_SIZE).node_id):
+                break
+        else:
+            return
+        owner, _ = self.lookup(start)
+        if owner not in self.routing.members:
+            response = self.peers.get(owner, "/chord/info")
+            response.raise_for_status()
+            self.learn_members(response.json()['members'])
+
+    def join(self, bootstrap):
+        """
+        Join the ring through a known member. The current holders of this node's key ranges are found with
+        lookups, the keys are copied from them, then they are notified and release the keys they no longer hold.
+        """
+        holders = {self.lookup(node_id, start_node=bootstrap)[0] for node_id in self.node_ids} - {self.address}
+        for holder in holders:
+            response = self.peers.get(holder, "/chord/info")
+            response.raise_for_status()
+            self.learn_members(response.json()['members'])
+
+        for holder in holders:
+            # copy first, the keys stay reachable at the holder until it learns about this node
+            copied, since = self.pull_range(holder)
+            response = self.peers.post(holder, "/chord/notify", json=self.member_info())
+            response.raise_for_status()
+            self.learn_members(response.json()['members'])
+            # then the writes the holder accepted while the first copy was running
+            copied += self.pull_range(holder, since)[0]
+            response = self.peers.post(holder, "/chord/release", json=self.member_info())
+            response.raise_for_status()
+            log.info("Took over %s keys from %s, it released %s", copied, holder, response.json()['released'])
+
+    def pull_range(self, holder, since=0):
+        """Copy the keys this node takes over from a holder, returns (copied, holder version at the start)."""
+        if self.rpc is not None:
+            records, headers = self.rpc.range(holder, self.address, self.vnodes, since)
+            return self.store_records(read_records(io.BytesIO(records))), int(headers[VERSION_HEADER])
+        response = self.peers.get(holder, "/chord/transfer", stream=True,
+                                  params={'node': self.address, 'vnodes': self.vnodes, 'since': since})
+        try:
+            response.raise_for_status()
+            copied = self.store_records(read_records(response.raw))
+        finally:
+            response.close()
+        return copied, int(response.headers[VERSION_HEADER])
+
+    def store_records(self, records):
+        """Store transferred (key hash, blob) records, those of other workers are sent to them; returns the count."""
+        stored = 0
+        others = {}
+        for key_hash, blob in records:
+            if self.workers is None or self.workers.holds(key_hash):
+                self.store_replica(key_hash, blob)
+            else:
+                others.setdefault(self.workers.address(key_hash), []).append((key_hash, blob))
+            stored += 1
+        for address, group in others.items():
+            response = self.peers.post(address, "/chord/transfer", data=b''.join(pack_records(group)),
+                                       headers={WORKER_HEADER: '1'})
+            response.raise_for_status()
+        return stored
+
+    def transfer_records(self, node, vnodes, since=0):
+        """
+        (version, records) of the keys node takes over, version is where a later copy continues from.
+        With several workers the records of all of them are returned, from the oldest version any of them is at.
+        """
+        if self.workers is None:
+            return self.last_version, self.range_records(node, vnodes, since)
+        responses = self.each_worker('GET', "/chord/transfer", stream=True,
+                                     params={'node': node, 'vnodes': vnodes, 'since': since})
+        for response in responses:
+            response.raise_for_status()
+        version = min([self.last_version] + [int(response.headers[VERSION_HEADER]) for response in responses])
+        return version, itertools.chain(self.range_records(node, vnodes, since),
+                                        *(worker_records(response) for response in responses))
+
+    def serve_rpc(self, op, body):
+        """Handle a request frame of the binary protocol, returns (status, reply headers, reply data)."""
+        start_time = time.monotonic()
+        trace_id.set('-')
+        status, headers, data = self._serve_rpc(op, body)
+        self.observe_request('rpc', rpc.OP_NAMES.get(op, str(op)), status, time.monotonic() - start_time)
+        return status, headers, data
+
+    def _serve_rpc(self, op, body):
+        if op == rpc.LOOKUP:
+            key_hash = int.from_bytes(body, 'big')
+            node, done = self.find_successor(key_hash)
+            start, end = self.owner_range(key_hash) if done else (0, 0)
+            reply = rpc.LOOKUP_REPLY.pack(done, start.to_bytes(20, 'big'), end.to_bytes(20, 'big'))
+            return 200, {}, reply + node.encode()
+        if op == rpc.RANGE:
+            node, offset = rpc.unpack_key(body)
+            vnodes, since = rpc.RANGE_REQUEST.unpack_from(body, offset)
+            version, records = self.transfer_records(node, vnodes, since)
+            return 200, {VERSION_HEADER: version}, b''.join(pack_records(records))
+
+        key, offset = rpc.unpack_key(body)
+        headers, offset = rpc.unpack_headers(body, offset)
+        trace_id.set(headers.get(TRACE_HEADER, '-'))
+        response_headers = {}
+        try:
+            if op == rpc.PUT:
+                text = self.put(key, bytes(body[offset:]), headers=headers, response_headers=response_headers)
+                return 200, response_headers, text.encode()
+            value = self.get(key, headers=headers, response_headers=response_headers)
+        except InvalidDeadline as e:
+            return 400, {}, str(e).encode()
+        except NotResponsible:
+            return 421, {}, b"Not responsible for key"
+        except ValueTooLarge:
+            return 413, {}, b"Value too large"
+        except QuorumNotReached as e:
+            return 503, {}, str(e).encode()
+        except DeadlineExceeded as e:
+            return 504, {}, str(e).encode()
+        except Overloaded as e:
+            return e.status, {'Retry-After': e.retry_after}, str(e).encode()
+        if value is None:
+            return 404, response_headers, b"Key not found"
+        data, content_type = value
+        if not isinstance(data, bytes):
+            data = b''.join(data)
+        return 200, dict(response_headers, **{'Content-Type': content_type}), data
+
+    def ring_with(self, node, vnodes):
+        """The ring with node at vnodes virtual nodes, or without it when vnodes is 0."""
+        ring = self.routing.ring
+        entries = [(node_id, address) for node_id, address in zip(ring.ids, ring.addresses) if address != node]
+        if vnodes:
+            entries += [(self.node_hashes.get(name) or hash_value(name), node) for name in vnode_names(node, vnodes)]
+        return Ring(entries)
+
+    def range_records(self, node, vnodes, since=0):
+        """Stored keys that node holds once it joined with vnodes virtual nodes, written at version since or later."""
+        ring = self.ring_with(node, vnodes)
+        for key_hash in list(self.data_store):
+            blob = self.data_store.get(key_hash)
+            if blob is not None and value_version(blob) >= since and node in ring.replicas(key_hash, self.replicas):
+                yield key_hash, blob
+
+    def release_range(self, node, vnodes):
+        """Delete the keys this node no longer holds now that node joined, returns how many were deleted."""
+        ring = self.ring_with(node, vnodes)
+        released = [key_hash for key_hash in list(self.data_store)
+                    if self.address not in ring.replicas(key_hash, self.replicas)]
+        for key_hash in released:
+            self.data_store.pop(key_hash, None)
+        return len(released)
+
+    def leave(self, announce=True):
+        """
+        Hand the stored keys to the nodes that hold them once this node is gone, then tell the known members.
+        With several workers, the others hand over their keys first with announce False, the last one announces.
+        """
+        self.departed.set()
+        routing = self.routing
+        members = [node for node in routing.members if node != self.address]
+        ring, remaining = routing.ring, self.ring_with(self.address, 0)
+
+        # only nodes that do not already hold a copy are sent the key
+        handoff = {}
+        for key_hash in list(self.data_store) if members else ():
+            holders = ring.replicas(key_hash, self.replicas)
+            for node in remaining.replicas(key_hash, self.replicas):
+                if node not in holders:
+                    handoff.setdefault(node, []).append(key_hash)
+        for node, key_hashes in handoff.items():
+            records = ((key_hash, self.data_store[key_hash]) for key_hash in key_hashes)
+            response = self.peers.post(node, "/chord/transfer", data=pack_records(records))
+            response.raise_for_status()
+            log.info("Handed %s keys to %s", len(key_hashes), node)
+
+        for node in members if announce else ():
+            try:
+                self.peers.post(node, "/chord/forget", json=self.member_info())
+            except requests.exceptions.RequestException as e:
+                log.warning("Error leaving through %s: %s", node, e)
+        with self.membership_lock:
+            self.rebuild_ring({self.address: self.vnodes}, share=announce)
+        return sum(len(key_hashes) for key_hashes in handoff.values())
+
+
+
+# joins once this node answers requests, the holders of its ranges contact it during the join
+def join_when_serving(node, bootstrap):
+    while True:
+        try:
+            node.peers.get(node.address, "/helloworld")
+            break
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    node.join(bootstrap)
+
+
+# the node of this process as configured on the command line, with several workers the part of it one worker runs
+def create_node(args, node_address, workers=None):
+    peers = PeerPool(pool_size=args.pool_size, connect_timeout=args.connect_timeout,
+                     read_timeout=args.read_timeout, retries=args.retries)
+    rpc_client = None
+    if args.rpc_offset:
+        rpc_client = rpc.RpcClient(args.rpc_offset, peers=peers, connect_timeout=args.connect_timeout,
+                                   read_timeout=args.read_timeout)
+    data_store = None
+    data_dir = args.data_dir or f"data_{args.port}"
+    if workers is not None:
+        data_dir = f"{data_dir}_{workers.index}"
+    if args.storage == 'log':
+        data_store = LogStore(data_dir, sync=args.sync)
+    elif args.storage == 'compact' and args.storage_shards > 1:
+        data_store = ShardedStore(lambda: CompactStore(compress_threshold=args.compress_threshold),
+                                  shards=args.storage_shards)
+    elif args.storage == 'compact':
+        data_store = CompactStore(compress_threshold=args.compress_threshold)
+    elif args.storage_shards > 1:
+        data_store = ShardedStore(dict, shards=args.storage_shards)
+    admission = None
+    if args.max_client_requests > 0:
+        admission = AdmissionControl(client_limit=args.max_client_requests,
+                                     forwarded_limit=args.max_forwarded_requests, queue_size=args.admission_queue)
+    return Node(address=node_address, lookup_mode=args.lookup, peers=peers, batch_workers=args.batch_workers,
+                location_cache_size=args.location_cache, value_cache_bytes=args.value_cache,
+                value_cache_ttl=args.value_cache_ttl, value_cache_mode=args.value_cache_mode,
+                data_store=data_store, max_value_size=args.max_value_size, replicas=args.replicas,
+                write_quorum=args.write_quorum, read_quorum=args.read_quorum, read_policy=args.read_policy,
+                vnodes=args.vnodes, stabilize_interval=args.stabilize_interval, rpc_client=rpc_client,
+                coalesce=args.coalesce, request_timeout=args.request_timeout,
+                hedge_percentile=args.hedge_percentile, hedge_delay=args.hedge_delay, admission=admission,
+                workers=workers)
+
+
+# one worker of a node: it builds its own part of the node, holding the keys of its stripe, and serves both the
+# shared socket and its private one; the first worker also runs stabilization and the join
+def serve_worker(args, node_address, workers, index):
+    global node1
+    workers.index = index
+    node1 = create_node(args, node_address, workers)
+    log.info("Worker %s of node %s serving at %s", index, node_address, workers.addresses[index])
+    if index == 0 and args.stabilize_interval > 0:
+        node1.start_maintenance()
+    if index == 0 and args.join:
+        threading.Thread(target=join_when_serving, args=(node1, args.join), daemon=True).start()
+    private = make_server("127.0.0.1", 0, app, threaded=True, fd=workers.private[index].fileno())
+    threading.Thread(target=private.serve_forever, daemon=True).start()
+    make_server("0.0.0.0", args.port, app, threaded=True, fd=workers.listener.fileno()).serve_forever()
+
+
+# every request continues the trace it was sent with or starts one, and is counted once answered
+@app.before_request
+def start_request():
+    g.start_time = time.monotonic()
+    trace_id.set(request.headers.get(TRACE_HEADER) or os.urandom(8).hex())
+    if node1.workers is not None:
+        node1.sync_membership()
+        return dispatch_to_worker()
+
+
+# with several workers, a PUT or GET of a key is passed to the worker holding it, which answers it as if it had
+# accepted the connection itself
+def dispatch_to_worker():
+    if request.url_rule is None or request.url_rule.rule != '/storage/<key>' or WORKER_HEADER in request.headers:
+        return None
+    key = request.view_args['key']
+    key_hash = hash_value(key)
+    if node1.workers.holds(key_hash):
+        return None
+    # the length of the body is that of the data passed on, small bodies are read whole like by put_value
+    headers = {name: value for name, value in request.headers.items()
+               if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != 'content-length'}
+    headers[WORKER_HEADER] = '1'
+    data = None
+    if request.method == 'PUT':
+        length = request.content_length
+        data = request.get_data() if length is not None and length <= STREAM_CHUNK else node1.stream_body(request.stream)
+    try:
+        upstream = node1.peers.request(request.method, node1.workers.address(key_hash), f"/storage/{key}",
+                                       data=data, headers=headers, stream=True)
+    except requests.exceptions.RequestException as e:
+        log.warning("Error passing %s of %s to its worker: %s", request.method, key, e)
+        return Response(f"Worker unavailable: {e}", content_type='text/plain'), 503
+    reply_headers = {name: value for name, value in upstream.headers.items()
+                     if name.lower() not in HOP_BY_HOP_HEADERS}
+    return Response(node1.relay(upstream), status=upstream.status_code, headers=reply_headers)
+
+
+@app.after_request
+def finish_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    hops = None
+    if route == '/storage/<key>' and FORWARDED_HEADER not in request.headers:
+        hops = int(response.headers.get(HOPS_HEADER, 0))
+    node1.observe_request(route, request.method, response.status_code, time.monotonic() - g.start_time, hops)
+    # a forwarded request is answered with the trace ID of the node that answered it
+    response.headers.setdefault(TRACE_HEADER, trace_id.get())
+    return response
 
 
 # Flask Routes
@@ -185,43 +1600,221 @@ class Node:
 def network_update():
     node_list = request.json['nodes']
     if node1.address not in node_list:
-        print(f"Adding current node {node1.address} to node_list.", flush=True)
+        log.info("Adding current node %s to node_list.", node1.address)
         node_list.append(node1.address)
     
-    node1.update_successor_predecessor(node_list)
+    node1.update_successor_predecessor(node_list, request.json.get('vnodes'))
     
     return jsonify({'message': 'Updated network'}), 200
 
 
+@app.route('/network', methods=['GET'])
+def get_neighbours():
+    return jsonify(node1.neighbour_addresses()), 200
+
+
+@app.route('/topology', methods=['GET'])
+def get_topology():
+    return jsonify(node1.topology()), 200
+
+
+@app.route('/find_successor/<key_hash>', methods=['GET'])
+def find_successor(key_hash):
+    node, done = node1.find_successor(int(key_hash, 16))
+    reply = {'node': node, 'done': done}
+    if done:
+        start, end = node1.owner_range(int(key_hash, 16))
+        reply.update({'start': f"{start:040x}", 'end': f"{end:040x}"})
+    return jsonify(reply), 200
+
+
+@app.route('/chord/info', methods=['GET'])
+def chord_info():
+    if node1.departed.is_set():
+        return jsonify({'message': 'Left the ring'}), 410
+    return jsonify({'members': node1.neighbour_members()}), 200
+
+
+@app.route('/chord/notify', methods=['POST'])
+def chord_notify():
+    if node1.departed.is_set():
+        return jsonify({'message': 'Left the ring'}), 410
+    node1.learn_members([request.json])
+    return jsonify({'members': node1.neighbour_members()}), 200
+
+
+@app.route('/chord/forget', methods=['POST'])
+def chord_forget():
+    node1.forget_member(request.json['address'])
+    return jsonify({'message': 'Forgot member'}), 200
+
+
+@app.route('/chord/transfer', methods=['GET'])
+def get_range():
+    node, vnodes = request.args['node'], int(request.args['vnodes'])
+    since = int(request.args.get('since', 0))
+    if WORKER_HEADER in request.headers:
+        version, records = node1.last_version, node1.range_records(node, vnodes, since)
+    else:
+        version, records = node1.transfer_records(node, vnodes, since)
+    headers = {VERSION_HEADER: str(version)}
+    return Response(pack_records(records), content_type='application/octet-stream', headers=headers), 200
+
+
+@app.route('/chord/transfer', methods=['POST'])
+def put_range():
+    stored = node1.store_records(read_records(request.stream))
+    return jsonify({'stored': stored}), 200
+
+
+@app.route('/chord/release', methods=['POST'])
+def release_range():
+    released = node1.release_range(request.json['address'], request.json['vnodes'])
+    if node1.workers is not None and WORKER_HEADER not in request.headers:
+        released += sum(response.json()['released']
+                        for response in node1.each_worker('POST', "/chord/release", json=request.json))
+    return jsonify({'released': released}), 200
+
+
+@app.route('/chord/join', methods=['POST'])
+def chord_join():
+    try:
+        node1.join(request.json['node'])
+    except requests.exceptions.RequestException as e:
+        return jsonify({'message': f"Join failed: {e}"}), 502
+    return jsonify({'message': 'Joined'}), 200
+
+
+@app.route('/chord/leave', methods=['POST'])
+def chord_leave():
+    try:
+        if WORKER_HEADER in request.headers:
+            handed = node1.leave(announce=False)
+        else:
+            handed = 0
+            if node1.workers is not None:
+                handed = sum(response.json()['handed_over'] for response in node1.each_worker('POST', "/chord/leave"))
+            handed += node1.leave()
+    except requests.exceptions.RequestException as e:
+        return jsonify({'message': f"Leave failed: {e}"}), 502
+    return jsonify({'message': 'Left the ring', 'handed_over': handed}), 200
+
+
+@app.route('/storage/_batch', methods=['POST'])
+def batch_values():
+    body = request.json
+    try:
+        results = node1.batch(body.get('put', {}), body.get('get', []), headers=request.headers)
+    except InvalidDeadline as e:
+        return Response(str(e), content_type='text/plain'), 400
+    except DeadlineExceeded as e:
+        return Response(str(e), content_type='text/plain'), 504
+    except Overloaded as e:
+        return Response(str(e), content_type='text/plain', headers={'Retry-After': str(e.retry_after)}), e.status
+    return jsonify(results), 200
+
+
 @app.route('/storage/<key>', methods=['PUT'])
 def put_value(key):
-    value = request.data.decode('utf-8')
-    response = node1.put(key, value)
-    return Response(response, content_type='text/plain'), 200  
+    length = request.content_length
+    if length is not None and length > node1.max_value_size:
+        return Response("Value too large", content_type='text/plain'), 413
+    # small bodies are read whole, larger ones are streamed on to the next hop
+    body = request.get_data() if length is not None and length <= STREAM_CHUNK else request.stream
+    headers = {}
+    try:
+        response = node1.put(key, body, headers=request.headers, response_headers=headers)
+    except InvalidDeadline as e:
+        return Response(str(e), content_type='text/plain'), 400
+    except NotResponsible:
+        return Response("Not responsible for key", content_type='text/plain'), 421
+    except ValueTooLarge:
+        return Response("Value too large", content_type='text/plain'), 413
+    except QuorumNotReached as e:
+        return Response(str(e), content_type='text/plain'), 503
+    except DeadlineExceeded as e:
+        return Response(str(e), content_type='text/plain'), 504
+    except Overloaded as e:
+        return Response(str(e), content_type='text/plain', headers={'Retry-After': str(e.retry_after)}), e.status
+    return Response(response, content_type='text/plain', headers=headers), 200  
 
 
 @app.route('/storage/<key>', methods=['GET'])
 def get_value(key):
-    value = node1.get(key)
+    headers = {}
+    try:
+        value = node1.get(key, headers=request.headers, response_headers=headers)
+    except InvalidDeadline as e:
+        return Response(str(e), content_type='text/plain'), 400
+    except NotResponsible:
+        return Response("Not responsible for key", content_type='text/plain'), 421
+    except QuorumNotReached as e:
+        return Response(str(e), content_type='text/plain'), 503
+    except DeadlineExceeded as e:
+        return Response(str(e), content_type='text/plain'), 504
+    except Overloaded as e:
+        return Response(str(e), content_type='text/plain', headers={'Retry-After': str(e.retry_after)}), e.status
     if value is not None:
-        return Response(value, content_type='text/plain'), 200
+        body, content_type = value
+        return Response(body, content_type=content_type, headers=headers), 200
     else:
-        return Response("Key not found", content_type='text/plain'), 404
+        return Response("Key not found", content_type='text/plain', headers=headers), 404
 
 
 
 # ! Helper endpoints
 @app.route('/successor', methods=['GET'])
 def get_successor():
-    return jsonify({'successor': node1.successor}), 200
+    return jsonify({'successor': node1.routing.successor}), 200
 
 @app.route('/predecessor', methods=['GET'])
 def get_predecessor():
-    return jsonify({'predecessor': node1.predecessor}), 200
+    return jsonify({'predecessor': node1.routing.predecessor}), 200
 
 @app.route('/fingertable', methods=['GET'])
 def get_finger_table():
-    return jsonify({'fingertable': node1.finger_table}), 200
+    return jsonify({'fingertable': node1.finger_addresses()}), 200
+
+@app.route('/fingertable/detail', methods=['GET'])
+def get_finger_table_detail():
+    return jsonify({'fingertable': node1.finger_table_detail()}), 200
+
+@app.route('/stats/keyspace', methods=['GET'])
+def get_keyspace_stats():
+    return jsonify(node1.keyspace_stats()), 200
+
+@app.route('/stats/pool', methods=['GET'])
+def get_pool_stats():
+    return jsonify(node1.pool_stats()), 200
+
+@app.route('/stats/cache', methods=['GET'])
+def get_cache_stats():
+    return jsonify(node1.cache_stats()), 200
+
+@app.route('/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    if node1.values is not None:
+        for key_hash in request.json['keys']:
+            node1.values.invalidate(int(key_hash, 16))
+        if node1.workers is not None and WORKER_HEADER not in request.headers:
+            node1.each_worker('POST', "/cache/invalidate", json=request.json)
+    return jsonify({'message': 'Invalidated'}), 200
+
+@app.route('/stats/storage', methods=['GET'])
+def get_storage_stats():
+    return jsonify(node1.storage_stats()), 200
+
+@app.route('/stats/admission', methods=['GET'])
+def get_admission_stats():
+    return jsonify(node1.admission_stats()), 200
+
+@app.route('/stats/memory', methods=['GET'])
+def get_memory_stats():
+    return jsonify(memory_stats(node1.data_store)), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(node1.metrics.render(), content_type='text/plain; version=0.0.4'), 200
 
 @app.route('/helloworld', methods=['GET'])
 def helloworld():
@@ -229,9 +1822,107 @@ def helloworld():
 
 
 if __name__ == '__main__':
-    port = int(sys.argv[1])
-    hostname = socket.gethostname().split('.')[0]  
+    parser = argparse.ArgumentParser(description="Chord DHT node")
+    parser.add_argument("port", type=int, help="port to listen on")
+    parser.add_argument("--host", help="host name other nodes and clients reach this node at, defaults to the short hostname")
+    parser.add_argument("--runtime", choices=['flask', 'asyncio'], default='flask',
+                        help="serve with the threaded Flask server, or on an asyncio loop with non-blocking forwards")
+    parser.add_argument("--connections", type=int, default=1000,
+                        help="pooled peer connections of the asyncio runtime, shared by all concurrent forwards")
+    parser.add_argument("--lookup", choices=['recursive', 'iterative'], default='recursive',
+                        help="forward requests hop by hop, or resolve the owner first and contact it directly")
+    parser.add_argument("--vnodes", type=int, default=1,
+                        help="virtual nodes this node joins the ring with, more take a larger share of the keys")
+    parser.add_argument("--join", metavar="ADDRESS", help="join the ring through this member once the node is up")
+    parser.add_argument("--stabilize-interval", type=float, default=1.0,
+                        help="seconds between stabilize and fix_fingers rounds, 0 disables them")
+    parser.add_argument("--coalesce", action=argparse.BooleanOptionalAction, default=True,
+                        help="let concurrent GETs of the same key share one upstream request")
+    parser.add_argument("--request-timeout", type=float, default=5.0,
+                        help="seconds to answer a request without a deadline header, across all its hops")
+    parser.add_argument("--hedge-percentile", type=float, default=95.0,
+                        help="resend a forwarded GET to an alternate next hop once it took longer than this percentile "
+                             "of the peer's response times, 0 disables hedging")
+    parser.add_argument("--hedge-delay", type=float, default=0.05,
+                        help="seconds before hedging a GET to a peer whose response times are not known yet")
+    parser.add_argument("--max-client-requests", type=int, default=64,
+                        help="client PUTs and GETs in progress at once, more wait in the queue, 0 disables admission control")
+    parser.add_argument("--max-forwarded-requests", type=int, default=128,
+                        help="PUTs and GETs forwarded by other nodes in progress at once, budgeted apart from clients")
+    parser.add_argument("--admission-queue", type=int, default=256,
+                        help="requests of each kind waiting for a slot, earliest deadline first, more are shed with 429/503")
+    parser.add_argument("--batch-workers", type=int, default=16, help="threads for parallel batch lookups and sub-batches")
+    parser.add_argument("--location-cache", type=int, default=1024, help="learned key ranges to keep, 0 disables")
+    parser.add_argument("--value-cache", type=int, default=0, help="bytes of hot values to cache, 0 disables")
+    parser.add_argument("--value-cache-ttl", type=float, default=5.0, help="seconds a cached value is served, 0 for no expiry")
+    parser.add_argument("--value-cache-mode", choices=['ttl', 'invalidate'], default='ttl',
+                        help="rely on the ttl only, or also have owners push invalidations on overwrite")
+    parser.add_argument("--storage", choices=['compact', 'memory', 'log'], default='compact',
+                        help="keep data in a compact in-memory table, a dict, or a persistent append-only log")
+    parser.add_argument("--storage-shards", type=int, default=16,
+                        help="independent shards of the compact and memory stores, 1 keeps a single table")
+    parser.add_argument("--compress-threshold", type=int, default=0,
+                        help="compress values of at least this many bytes in the compact store, 0 disables")
+    parser.add_argument("--data-dir", help="directory of the log storage, defaults to data_<port>")
+    parser.add_argument("--sync", choices=['group', 'always', 'none'], default='group',
+                        help="when log writes are fsynced: shared group commits, every write, or never")
+    parser.add_argument("--max-value-size", type=int, default=64 * 2**20, help="largest value accepted, in bytes")
+    parser.add_argument("--replicas", type=int, default=1, help="copies of every value, on the owner and its successors")
+    parser.add_argument("--write-quorum", type=int, default=1, help="copies stored before a PUT is acknowledged")
+    parser.add_argument("--read-quorum", type=int, default=1, help="replicas read by a GET, the newest value wins")
+    parser.add_argument("--read-policy", choices=['owner', 'round-robin', 'latency'], default='owner',
+                        help="which replicas serve GETs")
+    parser.add_argument("--rpc-offset", type=int, default=0,
+                        help="serve and send node-to-node requests with the binary protocol on port + offset, "
+                             "the same on every node, 0 keeps them on HTTP")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes sharing the port, each holding the keys of one stripe of the node's key space")
+    parser.add_argument("--rpc-workers", type=int, default=64, help="threads handling binary protocol requests")
+    parser.add_argument("--pool-size", type=int, default=10, help="kept-alive connections per peer")
+    parser.add_argument("--connect-timeout", type=float, default=2.0, help="seconds to wait for a peer connection")
+    parser.add_argument("--read-timeout", type=float, default=5.0, help="seconds to wait for a peer response")
+    parser.add_argument("--retries", type=int, default=1, help="retries of failed peer connection attempts")
+    parser.add_argument("--log-level", choices=['debug', 'info', 'warning', 'error'], default='info',
+                        help="debug also logs every request a node handles or forwards, with its trace ID")
+    args = parser.parse_args()
+    if args.vnodes < 1:
+        parser.error("a node needs at least one virtual node")
+    if not 0 <= args.hedge_percentile < 100:
+        parser.error("the hedge percentile must be between 0 and 100")
+    if not 1 <= args.write_quorum <= args.replicas or not 1 <= args.read_quorum <= args.replicas:
+        parser.error("quorums must be between 1 and the number of replicas")
+    if args.workers > 1 and (args.runtime != 'flask' or args.rpc_offset):
+        parser.error("worker processes serve HTTP with the Flask runtime only")
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.addFilter(TraceFilter())
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(trace)s] %(name)s: %(message)s'))
+    logging.basicConfig(level=args.log_level.upper(), handlers=[handler])
+    if args.log_level != 'debug':
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    port = args.port
+    hostname = args.host or socket.gethostname().split('.')[0]
     node_address = f"{hostname}:{port}"
-    node1 = Node(address=node_address) 
-    print(f"Initializing node with address: {node_address}", flush=True)
-    app.run(host="0.0.0.0", port=port)
+    if args.workers > 1:
+        workers = WorkerGroup(args.workers, port)
+        # workers are forked before any thread starts, each builds its own node
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        context = multiprocessing.get_context('fork')
+        for index in range(1, args.workers):
+            context.Process(target=serve_worker, args=(args, node_address, workers, index), daemon=True).start()
+        serve_worker(args, node_address, workers, 0)
+
+    node1 = create_node(args, node_address)
+    log.info("Initializing node with address: %s", node_address)
+    if args.rpc_offset:
+        rpc.RpcServer(node1.serve_rpc, port + args.rpc_offset, workers=args.rpc_workers).start()
+    if args.stabilize_interval > 0:
+        node1.start_maintenance()
+    if args.join:
+        threading.Thread(target=join_when_serving, args=(node1, args.join), daemon=True).start()
+    if args.runtime == 'asyncio':
+        from async_node import AsyncRuntime
+        AsyncRuntime(node1, connections=args.connections).run(port)
+    else:
+        app.run(host="0.0.0.0", port=port)
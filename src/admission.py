@@ -0,0 +1,172 @@
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from errors import DeadlineExceeded, Overloaded
+
+
+# bounded in-flight requests of one traffic class, with the requests waiting for a slot ordered by deadline
+class _Budget:
+
+    def __init__(self, name, limit, status):
+        self.name = name
+        self.limit = limit
+        self.status = status  # answered when the queue is full
+        self.in_flight = 0
+        self.queue = []  # heap of (deadline, sequence, _Waiter)
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.expired = 0
+        self.service_time = None  # exponentially weighted moving average, in seconds
+
+
+class _Waiter:
+
+    def __init__(self, deadline, wake, weight):
+        self.deadline = deadline
+        self.wake = wake
+        self.weight = weight
+        self.granted = False
+        self.abandoned = False
+
+
+# admission control of the node's requests: client and forwarded requests have separate in-flight limits, so
+# forwards of requests already admitted elsewhere are not starved by new client requests
+class AdmissionControl:
+
+    def __init__(self, client_limit=64, forwarded_limit=128, queue_size=256, service_alpha=0.2):
+        """
+        Requests beyond a limit wait for a slot in a queue of at most queue_size, the one with the earliest
+        deadline is admitted first. Requests finding the queue full are rejected at once, client requests with
+        429 and forwarded ones with 503, along with a Retry-After estimated from the recent service time.
+        A request of several keys, such as a batch, takes one slot per key, up to the whole limit.
+        """
+        self.lock = threading.Lock()
+        self.budgets = {False: _Budget('client', client_limit, 429), True: _Budget('forwarded', forwarded_limit, 503)}
+        self.queue_size = queue_size
+        self.service_alpha = service_alpha
+        self.sequence = itertools.count()
+
+    def weight(self, forwarded, weight):
+        """Slots a request of weight keys takes, a batch larger than the limit takes all of them."""
+        return min(max(weight, 1), self.budgets[forwarded].limit)
+
+    def _enter(self, forwarded, deadline, wake, weight):
+        """Take the slots or a place in the queue, returns the _Waiter when queued and None when admitted."""
+        budget = self.budgets[forwarded]
+        with self.lock:
+            if budget.in_flight + weight <= budget.limit and not budget.waiting:
+                budget.in_flight += weight
+                budget.admitted += 1
+                return None
+            if budget.waiting >= self.queue_size:
+                budget.rejected += 1
+                raise Overloaded(f"Too many {budget.name} requests, {budget.waiting} queued",
+                                 retry_after=self._retry_after(budget), status=budget.status)
+            waiter = _Waiter(deadline, wake, weight)
+            heapq.heappush(budget.queue, (deadline, next(self.sequence), waiter))
+            budget.waiting += 1
+            budget.queued += 1
+            return waiter
+
+    def _settle(self, forwarded, waiter):
+        """Called by a queued request once woken or out of time, raises DeadlineExceeded unless it got a slot."""
+        budget = self.budgets[forwarded]
+        with self.lock:
+            if waiter.granted:
+                return
+            # still queued, it is skipped when it comes up
+            waiter.abandoned = True
+            budget.waiting -= 1
+            budget.expired += 1
+        raise DeadlineExceeded("Deadline passed while waiting for admission")
+
+    def _retry_after(self, budget):
+        """Whole seconds until the queue ahead has likely drained, at least 1."""
+        if budget.service_time is None:
+            return 1
+        return max(1, math.ceil(budget.service_time * budget.waiting / budget.limit))
+
+    def admit(self, forwarded, deadline, weight=1):
+        """
+        Wait for weight slots until the monotonic deadline, raises Overloaded or DeadlineExceeded if they are not
+        free; weight is what weight() returned.
+        """
+        event = threading.Event()
+        waiter = self._enter(forwarded, deadline, event.set, weight)
+        if waiter is not None:
+            event.wait(max(deadline - time.monotonic(), 0))
+            self._settle(forwarded, waiter)
+
+    async def admit_async(self, forwarded, deadline, weight=1):
+        """admit for coroutines, the event loop runs other requests while this one is queued."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        wake = lambda: loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+        waiter = self._enter(forwarded, deadline, wake, weight)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(future, max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+            self._settle(forwarded, waiter)
+
+    def release(self, forwarded, elapsed, weight=1):
+        """
+        Free the slots of a request that ran for elapsed seconds, handing them to the queued requests due first;
+        the request due first waits for enough slots, later ones do not overtake it.
+        """
+        budget = self.budgets[forwarded]
+        with self.lock:
+            budget.service_time = elapsed if budget.service_time is None else \
+                budget.service_time + self.service_alpha * (elapsed - budget.service_time)
+            budget.in_flight -= weight
+            now = time.monotonic()
+            while budget.queue:
+                deadline, _, waiter = budget.queue[0]
+                if waiter.abandoned:
+                    heapq.heappop(budget.queue)
+                    continue
+                if deadline <= now:
+                    # out of time already, it gives up as soon as it is woken
+                    heapq.heappop(budget.queue)
+                    waiter.wake()
+                    continue
+                if budget.in_flight + waiter.weight > budget.limit:
+                    break
+                heapq.heappop(budget.queue)
+                waiter.granted = True
+                budget.waiting -= 1
+                budget.in_flight += waiter.weight
+                budget.admitted += 1
+                waiter.wake()
+
+    @contextmanager
+    def slot(self, forwarded, deadline, weight=1):
+        """Hold the slots of a request of weight keys while the block runs."""
+        weight = self.weight(forwarded, weight)
+        self.admit(forwarded, deadline, weight)
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(forwarded, time.monotonic() - start_time, weight)
+
+    def stats(self):
+        with self.lock:
+            return {budget.name: {
+                'limit': budget.limit,
+                'in_flight': budget.in_flight,
+                'queue_depth': budget.waiting,
+                'admitted': budget.admitted,
+                'queued': budget.queued,
+                'rejected': budget.rejected,
+                'expired': budget.expired,
+                'service_time_ewma': budget.service_time,
+            } for budget in self.budgets.values()} | {'queue_size': self.queue_size}
@@ -0,0 +1,555 @@
+import asyncio
+import contextvars
+import io
+import logging
+import os
+import time
+
+import aiohttp
+import requests
+from aiohttp import web
+
+from errors import (DeadlineExceeded, InvalidDeadline, LookupFailed, NotResponsible, Overloaded, QuorumNotReached,
+                    ValueTooLarge)
+from Node import (CACHE_NODE_HEADER, DIRECT_HEADER, FORWARDED_HEADER, STREAM_CHUNK, VERSION_HEADER, hash_value,
+                  pack_records, read_records)
+from ring import M
+from storage import DEFAULT_CONTENT_TYPE, LogStore, memory_stats, pack_value
+from tracing import HOPS_HEADER, TRACE_HEADER, pass_trace, trace_id
+
+log = logging.getLogger('chord.async')
+
+
+# releases the reply of a hedged request that lost the race
+def release_reply(task):
+    if not task.cancelled() and task.exception() is None:
+        task.result().release()
+
+
+# a peer that sheds a request answers 429 or 503 with a Retry-After header
+async def raise_if_shed(response):
+    if response.status in (429, 503) and 'Retry-After' in response.headers:
+        message = await response.text()
+        response.release()
+        raise Overloaded(message, retry_after=int(response.headers['Retry-After']))
+
+
+# serves the node API on an asyncio event loop, forwards are non-blocking so each one costs a coroutine, not a thread
+class AsyncRuntime:
+
+    def __init__(self, node, connections=1000):
+        """
+        node is the Node whose ring, stores and caches are served. Forwarding to the next hop runs on the event
+        loop over up to connections pooled connections; local work that may block, such as replication with a
+        write quorum or log fsyncs, runs in the loop's default thread pool.
+        """
+        self.node = node
+        self.connections = connections
+        self.session = None
+        # reads of the log storage go to disk, they run off the loop like other blocking work
+        self.disk_reads = isinstance(node.data_store, LogStore)
+
+    def application(self):
+        app = web.Application(client_max_size=self.node.max_value_size, middlewares=[self.observe])
+        app.add_routes([
+            web.post('/network', self.network_update),
+            web.get('/network', self.get_neighbours),
+            web.get('/topology', self.get_topology),
+            web.get('/find_successor/{key_hash}', self.find_successor),
+            web.post('/storage/_batch', self.batch_values),
+            web.put('/storage/{key}', self.admitted(self.put_value)),
+            web.get('/storage/{key}', self.admitted(self.get_value)),
+            web.get('/successor', self.get_successor),
+            web.get('/predecessor', self.get_predecessor),
+            web.get('/fingertable', self.get_finger_table),
+            web.get('/fingertable/detail', self.get_finger_table_detail),
+            web.get('/chord/info', self.chord_info),
+            web.post('/chord/notify', self.chord_notify),
+            web.post('/chord/forget', self.chord_forget),
+            web.get('/chord/transfer', self.get_range),
+            web.post('/chord/transfer', self.put_range),
+            web.post('/chord/release', self.release_range),
+            web.post('/chord/join', self.chord_join),
+            web.post('/chord/leave', self.chord_leave),
+            web.get('/stats/keyspace', self.get_keyspace_stats),
+            web.get('/stats/pool', self.get_pool_stats),
+            web.get('/stats/cache', self.get_cache_stats),
+            web.get('/stats/storage', self.get_storage_stats),
+            web.get('/stats/memory', self.get_memory_stats),
+            web.get('/stats/admission', self.get_admission_stats),
+            web.post('/cache/invalidate', self.invalidate_cache),
+            web.get('/metrics', self.get_metrics),
+            web.get('/helloworld', self.helloworld),
+        ])
+        app.on_startup.append(self.open_session)
+        app.on_cleanup.append(self.close_session)
+        return app
+
+    async def open_session(self, app):
+        connect_timeout, read_timeout = self.node.peers.timeout
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connections),
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+            auto_decompress=False)
+
+    async def close_session(self, app):
+        await self.session.close()
+
+    def run(self, port):
+        web.run_app(self.application(), host="0.0.0.0", port=port, access_log=None)
+
+    async def blocking(self, function, *args):
+        """Run local work that may block off the event loop, in the trace of the request."""
+        return await asyncio.get_running_loop().run_in_executor(None, contextvars.copy_context().run, function, *args)
+
+    @web.middleware
+    async def observe(self, request, handler):
+        """Continue the trace a request was sent with or start one, and count the request once answered."""
+        start_time = time.monotonic()
+        trace_id.set(request.headers.get(TRACE_HEADER) or os.urandom(8).hex())
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        try:
+            response = await handler(request)
+        except web.HTTPException as e:
+            self.node.observe_request(route, request.method, e.status, time.monotonic() - start_time)
+            raise
+        hops = None
+        if route == '/storage/{key}' and FORWARDED_HEADER not in request.headers:
+            hops = int(response.headers.get(HOPS_HEADER, 0))
+        self.node.observe_request(route, request.method, response.status, time.monotonic() - start_time, hops)
+        if not response.prepared:
+            response.headers.setdefault(TRACE_HEADER, trace_id.get())
+        return response
+
+    def timeout(self, deadline):
+        """Client timeout of a forward, it has to complete before the deadline."""
+        return aiohttp.ClientTimeout(total=self.node.remaining(deadline))
+
+    async def lookup(self, key_hash, deadline):
+        """Resolve the responsible node iteratively through /find_successor, returns (owner, hops)."""
+        node, done = self.node.find_successor(key_hash)
+        start, end = self.node.owner_range(key_hash) if done else (None, None)
+        hops = 0
+        while not done:
+            # a lookup never needs more hops than there are fingers
+            if hops > M:
+                raise LookupFailed(f"Lookup for {key_hash:040x} did not converge")
+            async with self.session.get(f"http://{node}/find_successor/{key_hash:040x}",
+                                        timeout=self.timeout(deadline)) as response:
+                response.raise_for_status()
+                reply = await response.json()
+            node, done = reply['node'], reply['done']
+            if done:
+                start, end = int(reply['start'], 16), int(reply['end'], 16)
+            hops += 1
+        self.node.locations.add(start, end, node)
+        return node, hops
+
+    async def route(self, key_hash, deadline):
+        """Pick where to send a request for the key hash, returns (node, direct)."""
+        owner = self.node.locations.get(key_hash)
+        if owner is not None:
+            return owner, True
+        if self.node.lookup_mode == 'iterative':
+            try:
+                owner, _ = await self.lookup(key_hash, deadline)
+                return owner, True
+            except LookupFailed as e:
+                # forwarding hop by hop still reaches the owner once the ring settles
+                log.warning("%s, forwarding hop by hop", e)
+                self.node.locations.invalidate(key_hash)
+        node, _ = self.node.find_successor(key_hash)
+        return node, False
+
+    async def stream_body(self, content):
+        """Pass a request body on chunk by chunk, enforcing the maximum value size."""
+        size = 0
+        async for chunk in content.iter_chunked(STREAM_CHUNK):
+            size += len(chunk)
+            if size > self.node.max_value_size:
+                raise ValueTooLarge(size)
+            yield chunk
+
+    async def network_update(self, request):
+        body = await request.json()
+        await self.blocking(self.node.update_successor_predecessor, body['nodes'], body.get('vnodes'))
+        return web.json_response({'message': 'Updated network'})
+
+    async def find_successor(self, request):
+        key_hash = int(request.match_info['key_hash'], 16)
+        node, done = self.node.find_successor(key_hash)
+        reply = {'node': node, 'done': done}
+        if done:
+            start, end = self.node.owner_range(key_hash)
+            reply.update({'start': f"{start:040x}", 'end': f"{end:040x}"})
+        return web.json_response(reply)
+
+    async def batch_values(self, request):
+        body = await request.json()
+        try:
+            # admitted by the batch itself, one slot per key
+            results = await self.blocking(self.node.batch, body.get('put', {}), body.get('get', []), request.headers)
+        except InvalidDeadline as e:
+            return web.Response(text=str(e), status=400)
+        except DeadlineExceeded as e:
+            return web.Response(text=str(e), status=504)
+        except Overloaded as e:
+            return web.Response(text=str(e), status=e.status, headers={'Retry-After': str(e.retry_after)})
+        return web.json_response(results)
+
+    def admitted(self, handler):
+        """Wrap a handler of PUTs or GETs in admission control, it is called with the request and its deadline."""
+        async def admit(request):
+            node = self.node
+            try:
+                deadline = node.deadline(request.headers)
+            except InvalidDeadline as e:
+                return web.Response(text=str(e), status=400)
+            if node.admission is None:
+                return await handler(request, deadline)
+            forwarded = FORWARDED_HEADER in request.headers
+            try:
+                await node.admission.admit_async(forwarded, deadline)
+            except Overloaded as e:
+                return web.Response(text=str(e), status=e.status, headers={'Retry-After': str(e.retry_after)})
+            except DeadlineExceeded as e:
+                return web.Response(text=str(e), status=504)
+            start_time = time.monotonic()
+            try:
+                return await handler(request, deadline)
+            finally:
+                node.admission.release(forwarded, time.monotonic() - start_time)
+        return admit
+
+    async def put_value(self, request, deadline):
+        node = self.node
+        key = request.match_info['key']
+        length = request.content_length
+        if length is not None and length > node.max_value_size:
+            return web.Response(text="Value too large", status=413)
+        headers = request.headers
+        content_type = headers.get('Content-Type') or DEFAULT_CONTENT_TYPE
+        key_hash = hash_value(key)
+
+        # replica copies and owned keys are stored here, the body is read whole
+        if node.stores_locally(key_hash, headers):
+            body = await request.read()
+            response_headers = {}
+            try:
+                stored = await self.blocking(node.put_locally, key, key_hash, body, headers, response_headers,
+                                             deadline)
+            except ValueTooLarge:
+                return web.Response(text="Value too large", status=413)
+            except QuorumNotReached as e:
+                return web.Response(text=str(e), status=503)
+            except DeadlineExceeded as e:
+                return web.Response(text=str(e), status=504)
+            return web.Response(text=stored, headers=response_headers)
+        if DIRECT_HEADER in headers:
+            return web.Response(text="Not responsible for key", status=421)
+        if node.values is not None:
+            node.values.invalidate(key_hash)
+
+        # small bodies are read whole so they can be resent, larger ones are streamed on to the next hop
+        small = length is not None and length <= STREAM_CHUNK
+        body = await request.read() if small else self.stream_body(request.content)
+        closest_node = None
+        response_headers = {}
+        try:
+            closest_node, forward_direct = await self.route(key_hash, deadline)
+            status, text = await self.forward_put(closest_node, key, body, content_type,
+                                                  node.forward_headers(headers, forward_direct, deadline),
+                                                  response_headers, deadline)
+            if status == 421:
+                node.locations.invalidate(key_hash)
+                # the owner changed since the lookup, fall back to recursive routing if the body can be resent
+                if small:
+                    closest_node, _ = node.find_successor(key_hash)
+                    status, text = await self.forward_put(closest_node, key, body, content_type,
+                                                          node.forward_headers(headers, False, deadline),
+                                                          response_headers, deadline)
+        except ValueTooLarge:
+            return web.Response(text="Value too large", status=413)
+        except (DeadlineExceeded, asyncio.TimeoutError) as e:
+            # the client timeout is what was left of the deadline
+            node.locations.invalidate(key_hash)
+            return web.Response(text=str(e) or "Deadline exceeded", status=504)
+        except Overloaded as e:
+            return web.Response(text=str(e), status=e.status, headers={'Retry-After': str(e.retry_after)})
+        except (aiohttp.ClientError, RuntimeError) as e:
+            log.warning("Error forwarding to %s: %s", closest_node, e)
+            node.locations.invalidate(key_hash)
+            return web.Response(text=str(e))
+        # a 421 left means a streamed body was used up, the client resends it
+        if status in (413, 421, 503, 504):
+            return web.Response(text=text, status=status)
+        return web.Response(text=text, headers=response_headers)
+
+    async def forward_put(self, closest_node, key, body, content_type, forward, response_headers, deadline):
+        """Send a PUT to the next hop, returns (status, text)."""
+        forward['Content-Type'] = content_type
+        async with self.session.put(f"http://{closest_node}/storage/{key}", data=body, headers=forward,
+                                    timeout=self.timeout(deadline)) as response:
+            await raise_if_shed(response)
+            self.node.learn_location(response, response_headers)
+            response_headers[HOPS_HEADER] = response.headers.get(HOPS_HEADER) or forward[HOPS_HEADER]
+            if TRACE_HEADER in response.headers:
+                response_headers[TRACE_HEADER] = response.headers[TRACE_HEADER]
+            return response.status, await response.text()
+
+    async def get_value(self, request, deadline):
+        node = self.node
+        key = request.match_info['key']
+        headers = request.headers
+        key_hash = hash_value(key)
+
+        # reads spread over the replicas contact other nodes and log reads go to disk, they run off the loop
+        response_headers = {}
+        try:
+            if node.replicas > 1 or self.disk_reads:
+                answered, value = await self.blocking(node.get_locally, key, key_hash, headers, response_headers)
+            else:
+                answered, value = node.get_locally(key, key_hash, headers, response_headers)
+        except NotResponsible:
+            return web.Response(text="Not responsible for key", status=421)
+        except QuorumNotReached as e:
+            return web.Response(text=str(e), status=503)
+        if answered:
+            if value is None:
+                return web.Response(text="Key not found", status=404, headers=response_headers)
+            body, content_type = value
+            return web.Response(body=body, headers=dict(response_headers, **{'Content-Type': content_type}))
+
+        # a fill is tagged before the request, so an invalidation arriving meanwhile drops it
+        fill_version = None
+        if node.values is not None and FORWARDED_HEADER not in headers:
+            fill_version = node.values.fill_version()
+        try:
+            # concurrent GETs of the key share one upstream request, a relayed stream is not shared; callers share
+            # the value and the owner learned with it, the trace and hops are passed back to the leader only
+            def fetch():
+                return self.fetch(key, key_hash, headers, deadline, response_headers, fill_version)
+
+            if node.flights is None:
+                reply = await fetch()
+            else:
+                reply = await node.flights.do_async(
+                    (key_hash, headers.get(CACHE_NODE_HEADER)), fetch,
+                    shareable=lambda result: not isinstance(result[1], aiohttp.ClientResponse), deadline=deadline)
+            return await self.answer(request, reply, response_headers)
+        except (DeadlineExceeded, asyncio.TimeoutError) as e:
+            # the client timeout is what was left of the deadline
+            node.locations.invalidate(key_hash)
+            return web.Response(text=str(e) or "Deadline exceeded", status=504)
+        except Overloaded as e:
+            return web.Response(text=str(e), status=e.status, headers={'Retry-After': str(e.retry_after)})
+        except (aiohttp.ClientError, RuntimeError) as e:
+            log.warning("Error during GET request for key %s: %s", key, e)
+            node.locations.invalidate(key_hash)
+            return web.Response(text="Key not found", status=404)
+
+    async def fetch(self, key, key_hash, headers, deadline, response_headers, fill_version=None):
+        """
+        Forward a GET towards the owner, returns (status, body, content_type, location). Small values and errors
+        are read whole and may be cached, a large value is the upstream response still to be relayed. The trace
+        and hops of the reply are passed to response_headers, the owner learned from it to location.
+        """
+        node = self.node
+        closest_node, forward_direct = await self.route(key_hash, deadline)
+        response = await self.hedged_get(key, key_hash, closest_node, forward_direct, headers, deadline)
+        if response.status == 421:
+            # the owner changed since the lookup, fall back to recursive routing
+            response.release()
+            node.locations.invalidate(key_hash)
+            closest_node, _ = node.find_successor(key_hash)
+            response = await self.hedged_get(key, key_hash, closest_node, False, headers, deadline)
+        location = {}
+        node.learn_location(response, location)
+        pass_trace(response, headers, response_headers)
+        content_type = response.headers.get('Content-Type', DEFAULT_CONTENT_TYPE)
+        length = response.content_length
+        if response.status == 200 and (length is None or length > STREAM_CHUNK):
+            return response.status, response, content_type, location
+        try:
+            body = await response.read()
+        finally:
+            response.release()
+        if response.status == 200 and fill_version is not None:
+            node.values.put(key_hash, pack_value(body, content_type), fill_version)
+        return response.status, body, content_type, location
+
+    async def hedged_get(self, key, key_hash, node, direct, headers, deadline):
+        """
+        Send a GET to node. If it has not answered within its hedge delay, or failed, the GET is also sent to an
+        alternate next hop; the first reply is returned and the other one is released once it arrives.
+        """
+        async def send(target, target_direct):
+            start_time = time.monotonic()
+            response = await self.session.get(f"http://{target}/storage/{key}", timeout=self.timeout(deadline),
+                                              headers=self.node.forward_headers(headers, target_direct, deadline))
+            # replies of this runtime feed the same latency estimates as those of the peer pool
+            self.node.peers._observe(target, time.monotonic() - start_time)
+            # a hop that sheds the request counts as failed, with hedging the alternate is tried at once
+            await raise_if_shed(response)
+            return response
+
+        # only the ingress hop hedges, so hedge traffic does not multiply with the length of the path
+        if self.node.hedges is None or FORWARDED_HEADER in headers:
+            return await send(node, direct)
+        tasks = {asyncio.ensure_future(send(node, direct)): node}
+        delay = self.node.peers.latency_percentile(node, self.node.hedge_percentile)
+        done, _ = await asyncio.wait(tasks, timeout=min(self.node.hedge_delay if delay is None else delay,
+                                                        self.node.remaining(deadline)))
+        if not done or next(iter(done)).exception() is not None:
+            alternate = self.node.alternate_hop(key_hash, node)
+            if alternate is not None:
+                self.node._count_hedge('sent')
+                tasks[asyncio.ensure_future(send(alternate, False))] = alternate
+
+        # replies that lose the race are released once they arrive
+        error = None
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=self.node.remaining(deadline),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise DeadlineExceeded(f"No reply from {', '.join(tasks.values())} within the deadline")
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if tasks[task] != node:
+                        self.node._count_hedge('won')
+                    return task.result()
+        finally:
+            for task in pending:
+                task.add_done_callback(release_reply)
+        raise error
+
+    async def answer(self, request, reply, response_headers):
+        """Answer a GET with the reply of fetch(), a large value is relayed as it arrives."""
+        status, body, content_type, location = reply
+        response_headers.update(location)
+        if status == 504:
+            return web.Response(text=body.decode('utf-8', 'replace'), status=504)
+        if status != 200:
+            return web.Response(text="Key not found", status=404, headers=response_headers)
+        headers = dict(response_headers, **{'Content-Type': content_type})
+        if not isinstance(body, aiohttp.ClientResponse):
+            return web.Response(body=body, headers=headers)
+
+        # large values are relayed as they arrive
+        try:
+            relayed = web.StreamResponse(headers=headers)
+            if body.content_length is not None:
+                relayed.content_length = body.content_length
+            await relayed.prepare(request)
+            async for chunk in body.content.iter_chunked(STREAM_CHUNK):
+                await relayed.write(chunk)
+            await relayed.write_eof()
+            return relayed
+        finally:
+            body.release()
+
+    async def get_successor(self, request):
+        return web.json_response({'successor': self.node.routing.successor})
+
+    async def get_predecessor(self, request):
+        return web.json_response({'predecessor': self.node.routing.predecessor})
+
+    async def get_neighbours(self, request):
+        return web.json_response(self.node.neighbour_addresses())
+
+    async def get_topology(self, request):
+        return web.json_response(self.node.topology())
+
+    async def get_finger_table(self, request):
+        return web.json_response({'fingertable': self.node.finger_addresses()})
+
+    async def get_finger_table_detail(self, request):
+        return web.json_response({'fingertable': self.node.finger_table_detail()})
+
+    async def chord_info(self, request):
+        if self.node.departed.is_set():
+            return web.json_response({'message': 'Left the ring'}, status=410)
+        return web.json_response({'members': self.node.neighbour_members()})
+
+    async def chord_notify(self, request):
+        if self.node.departed.is_set():
+            return web.json_response({'message': 'Left the ring'}, status=410)
+        await self.blocking(self.node.learn_members, [await request.json()])
+        return web.json_response({'members': self.node.neighbour_members()})
+
+    async def chord_forget(self, request):
+        await self.blocking(self.node.forget_member, (await request.json())['address'])
+        return web.json_response({'message': 'Forgot member'})
+
+    async def get_range(self, request):
+        node, vnodes = request.query['node'], int(request.query['vnodes'])
+        version = self.node.last_version
+        # the records are read and packed whole off the loop, range handoffs are rare
+        body = await self.blocking(lambda: b''.join(pack_records(
+            self.node.range_records(node, vnodes, int(request.query.get('since', 0))))))
+        return web.Response(body=body, headers={'Content-Type': 'application/octet-stream',
+                                                VERSION_HEADER: str(version)})
+
+    async def put_range(self, request):
+        # the records are parsed from the whole body, range handoffs are rare
+        body = await request.content.read()
+        stored = await self.blocking(self.node.store_records, read_records(io.BytesIO(body)))
+        return web.json_response({'stored': stored})
+
+    async def release_range(self, request):
+        member = await request.json()
+        released = await self.blocking(self.node.release_range, member['address'], member['vnodes'])
+        return web.json_response({'released': released})
+
+    async def chord_join(self, request):
+        try:
+            await self.blocking(self.node.join, (await request.json())['node'])
+        except requests.exceptions.RequestException as e:
+            return web.json_response({'message': f"Join failed: {e}"}, status=502)
+        return web.json_response({'message': 'Joined'})
+
+    async def chord_leave(self, request):
+        try:
+            handed = await self.blocking(self.node.leave)
+        except requests.exceptions.RequestException as e:
+            return web.json_response({'message': f"Leave failed: {e}"}, status=502)
+        return web.json_response({'message': 'Left the ring', 'handed_over': handed})
+
+    async def get_keyspace_stats(self, request):
+        return web.json_response(self.node.keyspace_stats())
+
+    async def get_pool_stats(self, request):
+        # forwards of this runtime use the aiohttp session, the pool serves replication and maintenance
+        return web.json_response(self.node.pool_stats())
+
+    async def get_cache_stats(self, request):
+        return web.json_response(self.node.cache_stats())
+
+    async def get_admission_stats(self, request):
+        return web.json_response(self.node.admission_stats())
+
+    async def get_storage_stats(self, request):
+        return web.json_response(self.node.storage_stats())
+
+    async def get_memory_stats(self, request):
+        # walks the whole store
+        return web.json_response(await self.blocking(memory_stats, self.node.data_store))
+
+    async def invalidate_cache(self, request):
+        if self.node.values is not None:
+            for key_hash in (await request.json())['keys']:
+                self.node.values.invalidate(int(key_hash, 16))
+        return web.json_response({'message': 'Invalidated'})
+
+    async def get_metrics(self, request):
+        return web.Response(body=self.node.metrics.render().encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+    async def helloworld(self, request):
+        return web.Response(text=self.node.address)
+
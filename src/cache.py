@@ -0,0 +1,328 @@
+import asyncio
+import bisect
+import threading
+import time
+from collections import OrderedDict
+
+from errors import DeadlineExceeded
+from ring import in_interval
+
+
+# bounded LRU of learned key hash ranges (start, end] -> owner address
+class LocationCache:
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # end -> (start, owner), least recently used first
+        self.ends = []  # sorted range ends, searched with bisect
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key_hash):
+        """Owner of the range containing key_hash, or None if no learned range covers it."""
+        with self.lock:
+            if self.ends:
+                end = self.ends[bisect.bisect_left(self.ends, key_hash) % len(self.ends)]
+                start, owner = self.entries[end]
+                if in_interval(key_hash, start, end):
+                    self.entries.move_to_end(end)
+                    self.hits += 1
+                    return owner
+            self.misses += 1
+            return None
+
+    def add(self, start, end, owner):
+        """Remember that owner is responsible for (start, end]."""
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            if end not in self.entries:
+                bisect.insort(self.ends, end)
+            self.entries[end] = (start, owner)
+            self.entries.move_to_end(end)
+
+            # evict the least recently used range
+            while len(self.entries) > self.capacity:
+                evicted, _ = self.entries.popitem(last=False)
+                del self.ends[bisect.bisect_left(self.ends, evicted)]
+
+    def invalidate(self, key_hash):
+        """Drop the range containing key_hash, e.g. after its owner answered it is not responsible."""
+        with self.lock:
+            if not self.ends:
+                return
+            index = bisect.bisect_left(self.ends, key_hash) % len(self.ends)
+            end = self.ends[index]
+            start, _ = self.entries[end]
+            if in_interval(key_hash, start, end):
+                del self.entries[end]
+                del self.ends[index]
+                self.invalidations += 1
+
+    def clear(self):
+        """Drop every learned range, used when ring membership changes."""
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.ends = []
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+            }
+
+
+# read-through cache of hot values at ingress nodes, bounded by total value size
+class ValueCache:
+
+    def __init__(self, max_bytes, ttl=5.0, invalidation_history=4096):
+        """
+        Entries expire ttl seconds after they are cached, a ttl of 0 keeps them until evicted or invalidated.
+        The last invalidation of up to invalidation_history keys is remembered to drop fills that raced it.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key_hash -> (value, expires), least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+        # every invalidation advances the version, a fill is tagged with the version it started at
+        self.version = 0
+        self.invalidated = OrderedDict()  # key_hash -> version of its last invalidation, oldest first
+        self.invalidation_history = invalidation_history
+        self.forgotten = 0  # newest version dropped from the history, fills older than it are not trusted
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_fills = 0
+
+    def get(self, key_hash):
+        """Cached value of key_hash, or None on a miss."""
+        with self.lock:
+            entry = self.entries.get(key_hash)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires and expires < time.monotonic():
+                self._remove(key_hash)
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key_hash)
+            self.hits += 1
+            return value
+
+    def fill_version(self):
+        """Version to tag a fill with, taken before its value is requested from the owner."""
+        with self.lock:
+            return self.version
+
+    def put(self, key_hash, value, version):
+        """
+        Cache a value fetched from its owner, evicting the least recently used values to make room. A fill
+        tagged with a version older than the last invalidation of the key may be stale and is dropped.
+        """
+        if len(value) > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else 0
+        with self.lock:
+            if max(self.invalidated.get(key_hash, 0), self.forgotten) > version:
+                self.stale_fills += 1
+                return
+            if key_hash in self.entries:
+                self._remove(key_hash)
+            self.entries[key_hash] = (value, expires)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                evicted = next(iter(self.entries))
+                self._remove(evicted)
+                self.evictions += 1
+
+    def invalidate(self, key_hash):
+        with self.lock:
+            self.version += 1
+            self.invalidated[key_hash] = self.version
+            self.invalidated.move_to_end(key_hash)
+            while len(self.invalidated) > self.invalidation_history:
+                _, version = self.invalidated.popitem(last=False)
+                self.forgotten = max(self.forgotten, version)
+            if key_hash in self.entries:
+                self._remove(key_hash)
+                self.invalidations += 1
+
+    def _remove(self, key_hash):
+        value, _ = self.entries.pop(key_hash)
+        self.size -= len(value)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'stale_fills': self.stale_fills,
+            }
+
+
+# nodes caching the values this node owns, so an overwrite can invalidate their copies; bounded, the readers of the
+# least recently read keys are evicted and have to be invalidated right away
+class ValueReaders:
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # key_hash -> addresses of its readers, least recently read first
+        self.lock = threading.Lock()
+
+    def add(self, key_hash, reader):
+        """Remember that reader caches key_hash, returns the (key_hash, readers) evicted to make room."""
+        with self.lock:
+            self.entries.setdefault(key_hash, set()).add(reader)
+            self.entries.move_to_end(key_hash)
+            evicted = []
+            while len(self.entries) > self.capacity:
+                evicted.append(self.entries.popitem(last=False))
+            return evicted
+
+    def pop(self, key_hash):
+        """Forget the readers of key_hash and return them."""
+        with self.lock:
+            return self.entries.pop(key_hash, set())
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# concurrent calls for the same key share the result of one call, the leader's, instead of each doing the work
+class SingleFlight:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}  # key -> _Flight of the call running for it
+        self.leaders = 0
+        self.coalesced = 0
+        self.unshared = 0
+
+    def do(self, key, function, shareable=None, deadline=None):
+        """
+        Run function, or wait for the call already running for key and return its result. A result for which
+        shareable returns False, such as a stream only one caller can read, is not shared and waiting callers
+        run function themselves. A waiting caller gives up with DeadlineExceeded once its own deadline passed.
+        """
+        flight, leader, _ = self._join(key)
+        if not leader:
+            if not flight.done.wait(_timeout(deadline)):
+                raise DeadlineExceeded("Deadline exceeded waiting for a coalesced request")
+            if self._shared(flight):
+                return flight.result
+            return function()
+
+        try:
+            flight.result = function()
+            flight.shared = shareable is None or shareable(flight.result)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            self._land(key, flight)
+
+    async def do_async(self, key, function, shareable=None, deadline=None):
+        """do() on an event loop, function returns an awaitable and waiting callers do not block the loop."""
+        flight, leader, waiter = self._join(key, asyncio.get_running_loop())
+        if not leader:
+            try:
+                await asyncio.wait_for(waiter, _timeout(deadline))
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded("Deadline exceeded waiting for a coalesced request") from None
+            if self._shared(flight):
+                return flight.result
+            return await function()
+
+        try:
+            flight.result = await function()
+            flight.shared = shareable is None or shareable(flight.result)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            self._land(key, flight)
+
+    def _join(self, key, loop=None):
+        """Returns (flight, leader, waiter), waiter is a future of loop set once the flight of another leader lands."""
+        waiter = None
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+                if loop is not None:
+                    waiter = loop.create_future()
+                    flight.waiters.append(waiter)
+        return flight, leader, waiter
+
+    def _shared(self, flight):
+        """Whether a waiting caller can use the result of a landed flight, raises its error."""
+        if flight.error is not None:
+            raise flight.error
+        if flight.shared:
+            return True
+        with self.lock:
+            self.unshared += 1
+        return False
+
+    def _land(self, key, flight):
+        with self.lock:
+            del self.flights[key]
+        flight.done.set()
+        # waiters on event loops are woken from the leader's thread or task
+        for waiter in flight.waiters:
+            waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+                'unshared': self.unshared,
+                'in_flight': len(self.flights),
+            }
+
+
+class _Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = []  # futures of callers waiting on an event loop
+        self.result = None
+        self.shared = False
+        self.error = None
+
+
+# seconds a caller waits until its monotonic deadline, None without one
+def _timeout(deadline):
+    return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+
+# completes the future of a caller waiting on an event loop, unless its task was cancelled meanwhile
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
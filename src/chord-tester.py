@@ -1,17 +1,31 @@
 #!/usr/bin/env python3
 # Test
 import argparse
-import http.client
-import json
+import itertools
 import random
 import textwrap
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from peers import PeerPool
 
 def arg_parser():
     parser = argparse.ArgumentParser(prog="client", description="DHT client")
 
     parser.add_argument("nodes", type=str, nargs="+",
             help="addresses (host:port) of nodes to test")
+    parser.add_argument("--stress", action="store_true",
+            help="run concurrent writers and readers on all nodes instead of the sequential checks")
+    parser.add_argument("--writers", type=str, default="16",
+            help="concurrent writer threads of the stress test, comma separated counts run one after the other")
+    parser.add_argument("--readers", type=str, default="16",
+            help="concurrent reader threads of the stress test, one count per writer count")
+    parser.add_argument("--keys", type=int, default=1000, help="keys the stress test writes and reads")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds each stress test runs")
+    parser.add_argument("--churn-interval", type=float, default=0.0,
+            help="seconds between ring updates sent to every node during the stress test, 0 disables them")
 
     return parser
 
@@ -65,6 +79,9 @@ class Lorem(object):
 
 lorem = Lorem()
 
+# keep-alive connections to the nodes, reused across all checks
+pool = PeerPool()
+
 def generate_pairs(count):
     pairs = {}
     for x in range(0, count):
@@ -74,43 +91,25 @@ def generate_pairs(count):
     return pairs
 
 def put_value(node, key, value):
-    conn = None
-    try:
-        conn = http.client.HTTPConnection(node)
-        conn.request("PUT", "/storage/"+key, value)
-        conn.getresponse()
-    finally:
-        if conn:
-            conn.close()
+    pool.put(node, "/storage/"+key, data=value.encode("utf-8"))
 
 def get_value_raw(node, key):
-    conn = None
-    try:
-        # Make request
-        conn = http.client.HTTPConnection(node)
-        conn.request("GET", "/storage/"+key)
-        resp = conn.getresponse()
-        status = resp.status
-        headers = resp.getheaders()
-        value = resp.read()
-
-        # Extract headers
-        contenttype = "text/plain"
-        for h, hv in headers:
-            if h.lower() == "Content-type".lower():
-                contenttype = hv
-
-        # Decode value, if text
-        if contenttype == "text/plain":
-            value = value.decode("utf-8")
-        elif contenttype.startswith("text/plain"):
-            # TODO: check charset
-            value = value.decode("utf-8")
-
-        return status, value, contenttype
-    finally:
-        if conn:
-            conn.close()
+    # Make request
+    resp = pool.get(node, "/storage/"+key)
+    status = resp.status_code
+    value = resp.content
+
+    # Extract headers
+    contenttype = resp.headers.get("Content-Type", "text/plain")
+
+    # Decode value, if text
+    if contenttype == "text/plain":
+        value = value.decode("utf-8")
+    elif contenttype.startswith("text/plain"):
+        # TODO: check charset
+        value = value.decode("utf-8")
+
+    return status, value, contenttype
 
 def get_value(node, key):
     status, value, contenttype = get_value_raw(node, key)
@@ -121,29 +120,191 @@ def get_value(node, key):
     return value
 
 def get_neighbours(node):
-    conn = http.client.HTTPConnection(node)
-    conn.request("GET", "/network")
-    resp = conn.getresponse()
-    if resp.status != 200:
+    try:
+        resp = pool.get(node, "/network")
+    except Exception:
+        return []
+    if resp.status_code != 200:
         neighbors = []
     else:
-        body = resp.read()
-        neighbors = json.loads(body)
-    conn.close()
+        neighbors = resp.json()
     return neighbors
 
 def walk_neighbours(start_nodes):
-    to_visit = start_nodes
-    visited = set()
-    while to_visit:
-        next_node = to_visit.pop()
-        visited.add(next_node)
-        neighbors = get_neighbours(next_node)
-        for neighbor in neighbors:
-            if neighbor not in visited:
-                to_visit.append(neighbor)
+    """Crawl the ring breadth first, the nodes found in one round are asked for their neighbours in parallel."""
+    visited = set(start_nodes)
+    to_visit = list(start_nodes)
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        while to_visit:
+            found = list(executor.map(get_neighbours, to_visit))
+            to_visit = []
+            for neighbors in found:
+                for neighbor in neighbors:
+                    if neighbor not in visited:
+                        visited.add(neighbor)
+                        to_visit.append(neighbor)
     return visited
 
+def get_topology(node):
+    try:
+        resp = pool.get(node, "/topology")
+    except Exception:
+        return None
+    return resp.json() if resp.status_code == 200 else None
+
+def check_topology(nodes):
+    print("Checking successors and predecessors ...")
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        topologies = dict(zip(nodes, executor.map(get_topology, nodes)))
+
+    answered = [topology for topology in topologies.values() if topology is not None]
+    inconsistent = 0
+    for node, topology in topologies.items():
+        if topology is None:
+            print("{}: NO TOPOLOGY".format(node))
+            continue
+        successor = topologies.get(topology['successor'])
+        if topology['successor'] is not None and (successor is None or successor['predecessor'] != node):
+            inconsistent += 1
+            print("{}: SUCCESSOR {} HAS PREDECESSOR {}".format(
+                node, topology['successor'], successor and successor['predecessor']))
+
+    fingers = sum(topology['fingers']['distinct'] for topology in answered) / max(len(answered), 1)
+    print("%d of %d nodes answered, %d successor links inconsistent, %.1f distinct fingers per node" % (
+            len(answered), len(nodes), inconsistent, fingers))
+
+def check_trace(nodes, requests_per_node=8):
+    print("Checking that forwarded requests keep the caller's trace ID ...")
+
+    forwarded = lost = 0
+    for node in nodes:
+        for _ in range(requests_per_node):
+            trace = uuid.uuid4().hex[:16]
+            try:
+                resp = pool.get(node, "/storage/"+str(uuid.uuid4()), headers={"X-Chord-Trace": trace})
+            except Exception as e:
+                print("{}: GET failed: {}".format(node, e))
+                continue
+            # the answering node reports the trace ID it worked under, only forwarded requests tell something
+            if int(resp.headers.get("X-Chord-Hops", 0)) == 0:
+                continue
+            forwarded += 1
+            if resp.headers.get("X-Chord-Trace") != trace:
+                lost += 1
+                print("{}: SENT TRACE {} ANSWERED UNDER {}".format(node, trace, resp.headers.get("X-Chord-Trace")))
+
+    print("%d forwarded GETs, %d lost the trace ID" % (forwarded, lost))
+
+def churn(pool, nodes, interval, stop, updates):
+    """Re-announce the node list so every node rebuilds its routing state while the stress test runs."""
+    while not stop.wait(interval):
+        for node in nodes:
+            try:
+                pool.post(node, "/network", json={'nodes': nodes})
+                next(updates)
+            except Exception as e:
+                print("Error updating ring at {}: {}".format(node, e))
+
+def stress_test(nodes, writers, readers, keys, duration, churn_interval=0.0):
+    print("Stress test: %d writers and %d readers on %d keys for %.0f seconds ..." % (
+            writers, readers, keys, duration))
+
+    stress_pool = PeerPool(pool_size=writers + readers)
+    key_names = [str(uuid.uuid4()) for _ in range(keys)]
+    writes = {key: [] for key in key_names}  # key -> [(start, end, value)], end is None if the PUT failed
+    reads = []  # (key, start, status, value)
+    lock = threading.Lock()
+    end_time = time.monotonic() + duration
+
+    def writer(index):
+        for sequence in itertools.count():
+            if time.monotonic() >= end_time:
+                break
+            key = random.choice(key_names)
+            value = "%d-%d %s" % (index, sequence, lorem.sentence())
+            start = time.monotonic()
+            try:
+                resp = stress_pool.put(random.choice(nodes), "/storage/"+key, data=value.encode("utf-8"))
+                end = time.monotonic() if resp.status_code == 200 else None
+            except Exception:
+                end = None
+            with lock:
+                writes[key].append((start, end, value))
+
+    def reader(index):
+        while time.monotonic() < end_time:
+            key = random.choice(key_names)
+            start = time.monotonic()
+            try:
+                resp = stress_pool.get(random.choice(nodes), "/storage/"+key)
+                status, value = resp.status_code, resp.content.decode("utf-8")
+            except Exception:
+                status, value = None, None
+            with lock:
+                reads.append((key, start, status, value))
+
+    stop, updates = threading.Event(), itertools.count()
+    if churn_interval > 0:
+        threading.Thread(target=churn, args=(stress_pool, nodes, churn_interval, stop, updates), daemon=True).start()
+    started = time.monotonic()
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    threads += [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    stop.set()
+
+    acknowledged = sum(end is not None for key_writes in writes.values() for _, end, _ in key_writes)
+    failed_writes = sum(len(key_writes) for key_writes in writes.values()) - acknowledged
+    print("%d PUTs acknowledged, %d failed; %d GETs; %.0f operations/s; %d ring updates" % (
+            acknowledged, failed_writes, len(reads), (acknowledged + failed_writes + len(reads)) / elapsed,
+            next(updates)))
+
+    # a read may return any value written to the key; it is stale if a newer write completed before it started,
+    # and a 404 is wrong once a write of the key completed before it started
+    mismatches = stale = missing = failed_reads = 0
+    for key, start, status, value in reads:
+        completed = [write for write in writes[key] if write[1] is not None and write[1] < start]
+        if status is None:
+            failed_reads += 1
+        elif status == 404:
+            missing += bool(completed)
+        elif value not in {written for _, _, written in writes[key]}:
+            mismatches += 1
+        elif any(write_start > end for write_start, _, _ in completed
+                 for _, end, written in writes[key] if written == value and end is not None):
+            stale += 1
+    total = max(len(reads), 1)
+    print("GETs during the run: %d mismatched (%.2f%%), %d stale (%.2f%%), %d 404 after a write (%.2f%%), %d failed" % (
+            mismatches, mismatches / total * 100, stale, stale / total * 100, missing, missing / total * 100,
+            failed_reads))
+
+    # last writer wins: once writers stop a key holds a write that no acknowledged write started after,
+    # a failed PUT may or may not have been applied
+    def final_check(key):
+        try:
+            resp = stress_pool.get(random.choice(nodes), "/storage/"+key)
+            status, value = resp.status_code, resp.content.decode("utf-8")
+        except Exception:
+            return 'failed'
+        last_start = max((start for start, end, _ in writes[key] if end is not None), default=None)
+        allowed = {value for _, end, value in writes[key] if end is None or last_start is None or end >= last_start}
+        if status == 404:
+            return 'ok' if last_start is None else '404'
+        if status != 200:
+            return 'failed'
+        return 'ok' if value in allowed else 'mismatch'
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        outcomes = list(executor.map(final_check, key_names))
+    print("Final values of %d keys: %d last writes, %d mismatched (%.2f%%), %d 404 (%.2f%%), %d failed" % (
+            keys, outcomes.count('ok'), outcomes.count('mismatch'), outcomes.count('mismatch') / keys * 100,
+            outcomes.count('404'), outcomes.count('404') / keys * 100, outcomes.count('failed')))
+    stress_pool.close()
+
 def simple_check(nodes):
     print("Simple put/get check, retreiving from same node ...")
 
@@ -228,12 +389,9 @@ def get_nonexistent_key(nodes):
     node = random.choice(nodes)
     print("%s -- GET /%s" % (node, key))
     try:
-        conn = http.client.HTTPConnection(node)
-        conn.request("GET", "/storage/"+key)
-        resp = conn.getresponse()
-        value = resp.read().strip()
-        conn.close()
-        print("Status: %s (expected 404)" % resp.status)
+        resp = pool.get(node, "/storage/"+key)
+        value = resp.content.strip()
+        print("Status: %s (expected 404)" % resp.status_code)
         print("Data  : %s" % value)
     except Exception as e:
         print("GET failed with exception:")
@@ -251,6 +409,22 @@ def main(args):
 
     print()
 
+    check_topology(nodes)
+    print()
+
+    check_trace(nodes)
+    print()
+
+    if args.stress:
+        writers = [int(count) for count in args.writers.split(",")]
+        readers = [int(count) for count in args.readers.split(",")]
+        if len(readers) != len(writers):
+            raise ValueError("--writers and --readers need the same number of counts")
+        for writer_count, reader_count in zip(writers, readers):
+            stress_test(nodes, writer_count, reader_count, args.keys, args.duration, args.churn_interval)
+            print()
+        return
+
     simple_check(nodes)
     print()
 
@@ -0,0 +1,173 @@
+import argparse
+import functools
+import json
+import os
+import shlex
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from peers import PeerPool
+
+NODE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Node.py")
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Start rings of Node.py processes on this machine and time how long "
+                                                 "they take to become ready")
+    parser.add_argument("--nodes", type=str, default="4", help="comma separated ring sizes, each started and torn down in turn")
+    parser.add_argument("--host", default="127.0.0.1", help="address the nodes announce and are polled at")
+    parser.add_argument("--base-port", type=int, default=5000,
+                        help="port of the first node, the others take the next ones; keep clear of --rpc-offset ports")
+    parser.add_argument("--cpus", type=str,
+                        help="pin node i to CPU i mod n of this comma separated list of n CPUs, 'all' for every CPU")
+    parser.add_argument("--node-args", type=str, default="", help="arguments for every Node.py, e.g. '--vnodes 4'")
+    parser.add_argument("--ready-timeout", type=float, default=30.0, help="seconds for every node to answer")
+    parser.add_argument("--log-dir", default="logs", help="directory of the node logs, node_<port>.log")
+    parser.add_argument("--hold", action="store_true",
+                        help="keep the last ring running until interrupted, its node list is printed as JSON")
+    parser.add_argument("--output", help="also write the startup times to this JSON file")
+    return parser
+
+
+def parse_cpus(cpus):
+    """CPUs to pin nodes to, None leaves them unpinned."""
+    if not cpus:
+        return None
+    if cpus == 'all':
+        return sorted(os.sched_getaffinity(0))
+    return [int(cpu) for cpu in cpus.split(',')]
+
+
+# Node.py processes on this machine that form one ring, started together and torn down together
+class LocalCluster:
+
+    def __init__(self, size, host="127.0.0.1", base_port=5000, cpus=None, node_args=(), log_dir="logs"):
+        """cpus is a list of CPUs the nodes are pinned to round-robin, or None."""
+        self.host = host
+        self.ports = [base_port + i for i in range(size)]
+        self.addresses = [f"{host}:{port}" for port in self.ports]
+        self.cpus = cpus
+        self.node_args = list(node_args)
+        self.log_dir = log_dir
+        self.processes = []
+        self.logs = []
+        self.pool = PeerPool(max_peers=max(size, 64), pool_size=1, connect_timeout=0.5, read_timeout=5.0, retries=0)
+        self.start_time = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """Spawn every node without waiting for any of them."""
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.start_time = time.monotonic()
+        for index, port in enumerate(self.ports):
+            pin = None
+            if self.cpus:
+                pin = functools.partial(os.sched_setaffinity, 0, {self.cpus[index % len(self.cpus)]})
+            log = open(os.path.join(self.log_dir, f"node_{port}.log"), 'w')
+            self.logs.append(log)
+            self.processes.append(subprocess.Popen(
+                [sys.executable, NODE_SCRIPT, str(port), '--host', self.host] + self.node_args,
+                stdout=log, stderr=subprocess.STDOUT, preexec_fn=pin))
+
+    def wait_ready(self, timeout=30.0):
+        """Poll every node in parallel until it answers /helloworld, returns the seconds from start to each answer."""
+        deadline = time.monotonic() + timeout
+        with ThreadPoolExecutor(max_workers=min(len(self.addresses), 64)) as executor:
+            return list(executor.map(functools.partial(self._wait_node, deadline=deadline),
+                                     self.addresses, self.processes))
+
+    def _wait_node(self, address, process, deadline):
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"Node {address} exited with status {process.returncode}, see {self.log_dir}")
+            try:
+                response = self.pool.get(address, "/helloworld", timeout=(0.5, 1.0))
+                if response.status_code == 200 and response.text == address:
+                    return time.monotonic() - self.start_time
+            except requests.exceptions.RequestException:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Node {address} did not answer within the ready timeout")
+            time.sleep(0.05)
+
+    def configure(self):
+        """Send the ring membership to every node at once."""
+        body = {'nodes': self.addresses}
+        with ThreadPoolExecutor(max_workers=min(len(self.addresses), 64)) as executor:
+            for response in executor.map(lambda address: self.pool.post(address, "/network", json=body),
+                                         self.addresses):
+                response.raise_for_status()
+
+    def stop(self, timeout=5.0):
+        """Terminate every node, those that do not exit within the timeout are killed."""
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            try:
+                process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        for log in self.logs:
+            log.close()
+        self.processes, self.logs = [], []
+        self.pool.close()
+
+
+def main(args):
+    sizes = [int(size) for size in args.nodes.split(',')]
+    cpus = parse_cpus(args.cpus)
+    node_args = shlex.split(args.node_args)
+
+    # a terminated launcher still tears its nodes down
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
+
+    results = []
+    print(f"{'nodes':>6} {'spawn s':>8} {'first s':>8} {'median s':>9} {'ready s':>8} {'configure s':>12} {'total s':>8}")
+    for index, size in enumerate(sizes):
+        with LocalCluster(size, host=args.host, base_port=args.base_port, cpus=cpus, node_args=node_args,
+                          log_dir=args.log_dir) as cluster:
+            cluster.start()
+            spawn = time.monotonic() - cluster.start_time
+            ready = cluster.wait_ready(args.ready_timeout)
+            configure_start = time.monotonic()
+            cluster.configure()
+            configure = time.monotonic() - configure_start
+            total = time.monotonic() - cluster.start_time
+
+            result = {'nodes': size, 'spawn_seconds': spawn, 'first_ready_seconds': min(ready),
+                      'median_ready_seconds': statistics.median(ready), 'ready_seconds': max(ready),
+                      'configure_seconds': configure, 'total_seconds': total}
+            results.append(result)
+            print(f"{size:>6} {spawn:>8.2f} {min(ready):>8.2f} {result['median_ready_seconds']:>9.2f} "
+                  f"{max(ready):>8.2f} {configure:>12.3f} {total:>8.2f}", flush=True)
+
+            if args.hold and index == len(sizes) - 1:
+                print(json.dumps(cluster.addresses), flush=True)
+                try:
+                    signal.pause()
+                except KeyboardInterrupt:
+                    pass
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    main(args)
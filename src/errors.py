@@ -0,0 +1,37 @@
+# raised when fewer replicas than the write quorum acknowledged a write
+class QuorumNotReached(Exception):
+    pass
+
+
+# raised when a PUT body exceeds the maximum value size
+class ValueTooLarge(Exception):
+    pass
+
+
+# raised when a request sent directly to an owner reaches a node that is not responsible
+class NotResponsible(Exception):
+    pass
+
+
+# raised when an iterative lookup takes more hops than a lookup can need, the ring is changing under it
+class LookupFailed(RuntimeError):
+    pass
+
+
+# raised when the time budget of a request ran out before it was answered
+class DeadlineExceeded(Exception):
+    pass
+
+
+# raised when the deadline header of a request is not a whole number of milliseconds
+class InvalidDeadline(ValueError):
+    pass
+
+
+# raised when a node sheds a request it has no capacity for, retry_after is a hint in seconds for the sender
+class Overloaded(Exception):
+
+    def __init__(self, message, retry_after=1, status=503):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status = status
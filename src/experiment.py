@@ -1,8 +1,21 @@
+import argparse
+import bisect
+import itertools
+import json
+import random
+import threading
 import time
-import requests
 import sys
 import matplotlib.pyplot as plt
+import numpy as np
+import requests
 import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+from peers import PeerPool
+
+# keep-alive connections to the nodes, shared by all measurements
+pool = PeerPool()
 
 
 def perform_put_requests(node_address, num_operations):
@@ -15,7 +28,7 @@ def perform_put_requests(node_address, num_operations):
         key = f'key-{i}'
         value = f'value-{i}'
         # PUT request
-        response = requests.put(f"http://{node_address}/storage/{key}", data=value)
+        response = pool.put(node_address, f"/storage/{key}", data=value)
         if response.status_code != 200:
             print(f"Failed PUT request for key: {key}")
         keys.append(key)
@@ -31,7 +44,7 @@ def perform_get_requests(node_address, keys):
     # Loop over all the keys from 'perform_put_requests'
     for key in keys:
         # GET request
-        response = requests.get(f"http://{node_address}/storage/{key}")
+        response = pool.get(node_address, f"/storage/{key}")
         if response.status_code != 200:
             print(f"Failed GET request for key: {key}")
     # Calculate time
@@ -101,9 +114,224 @@ def plot_results(node_counts, put_times, get_times, put_stdevs, get_stdevs):
     print("Plot saved as time_vs_nodes_plot.png")
 
 
+def load_arg_parser():
+    parser = argparse.ArgumentParser(prog="experiment.py load",
+                                     description="Generate load on the nodes and report throughput and latency percentiles")
+    parser.add_argument("nodes", nargs="+", help="addresses (host:port) of nodes to send requests to, picked at random")
+    parser.add_argument("--mode", choices=['closed', 'open'], default='closed',
+                        help="closed: each thread sends its next request once the last one is answered; "
+                             "open: requests are sent at a fixed rate, however long the answers take")
+    parser.add_argument("--concurrency", type=str, default="8",
+                        help="comma separated thread counts, one run each in closed mode; the largest bounds open mode")
+    parser.add_argument("--rate", type=str, default="100",
+                        help="comma separated requests per second of the open mode runs")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of every run")
+    parser.add_argument("--keys", type=int, default=1000, help="number of distinct keys")
+    parser.add_argument("--distribution", choices=['uniform', 'zipf', 'hotspot'], default='uniform',
+                        help="how keys are picked")
+    parser.add_argument("--zipf-exponent", type=float, default=0.99, help="skew of the zipf distribution")
+    parser.add_argument("--hot-fraction", type=float, default=0.01, help="fraction of the keys that are hot")
+    parser.add_argument("--hot-weight", type=float, default=0.9, help="fraction of the requests for the hot keys")
+    parser.add_argument("--value-size", type=str, default="100",
+                        help="bytes of the written values, or a range min-max to pick uniformly from")
+    parser.add_argument("--read-fraction", type=float, default=0.9, help="fraction of the requests that are GETs")
+    parser.add_argument("--no-preload", action="store_true", help="do not write every key before the runs")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the key, value size and node choices")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--plot", help="plot latency percentiles against throughput to this image file")
+    return parser
+
+
+def key_sampler(distribution, keys, zipf_exponent=0.99, hot_fraction=0.01, hot_weight=0.9):
+    """Function of a random.Random that returns the index of a key, drawn from the distribution."""
+    if distribution == 'zipf':
+        # key i is picked with a probability proportional to 1 / (i + 1)^s
+        cdf = np.cumsum(1.0 / np.arange(1, keys + 1) ** zipf_exponent)
+        cdf = (cdf / cdf[-1]).tolist()
+        return lambda rng: min(bisect.bisect_left(cdf, rng.random()), keys - 1)
+    if distribution == 'hotspot':
+        hot = min(max(int(keys * hot_fraction), 1), keys)
+        if hot == keys:
+            return lambda rng: rng.randrange(keys)
+        return lambda rng: rng.randrange(hot) if rng.random() < hot_weight else rng.randrange(hot, keys)
+    return lambda rng: rng.randrange(keys)
+
+
+def value_sizes(spec):
+    """(min, max) value size in bytes from "n" or "min-max"."""
+    low, _, high = spec.partition('-')
+    return int(low), int(high or low)
+
+
+# the requests of one run with their outcomes, shared by the threads sending them
+class LoadRecorder:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {'GET': [], 'PUT': []}  # seconds of the answered requests
+        self.errors = {'GET': 0, 'PUT': 0}  # failed requests and answers other than 200 and 404
+        self.misses = 0  # GETs answered with 404
+
+    def record(self, method, status, elapsed):
+        with self.lock:
+            if status is None or status not in (200, 404):
+                self.errors[method] += 1
+                return
+            if status == 404:
+                self.misses += 1
+            self.latencies[method].append(elapsed)
+
+    def summary(self, elapsed):
+        ops = sum(len(latencies) for latencies in self.latencies.values()) + sum(self.errors.values())
+        result = {'ops': ops, 'seconds': elapsed, 'throughput': ops / elapsed if elapsed > 0 else 0.0,
+                  'errors': sum(self.errors.values()), 'error_rate': sum(self.errors.values()) / ops if ops else 0.0,
+                  'misses': self.misses}
+        for method, latencies in self.latencies.items():
+            latencies = np.array(latencies) * 1000
+            count = len(latencies) + self.errors[method]
+            stats = {'count': count, 'errors': self.errors[method],
+                     'error_rate': self.errors[method] / count if count else 0.0}
+            if len(latencies):
+                p50, p95, p99, p999 = np.percentile(latencies, [50, 95, 99, 99.9])
+                stats.update({'mean_ms': float(latencies.mean()), 'p50_ms': float(p50), 'p95_ms': float(p95),
+                              'p99_ms': float(p99), 'p999_ms': float(p999)})
+            result[method] = stats
+        return result
+
+
+def load_operation(load_pool, nodes, args, sample_key, recorder):
+    """Function sending one random request, timed from scheduled or from when it is sent if that is None."""
+    low, high = value_sizes(args.value_size)
+    payload = random.Random(args.seed).randbytes(high)
+
+    def operation(rng, scheduled=None):
+        key = f"load-{sample_key(rng)}"
+        node = rng.choice(nodes)
+        start_time = time.perf_counter() if scheduled is None else scheduled
+        try:
+            if rng.random() < args.read_fraction:
+                method = 'GET'
+                status = load_pool.get(node, f"/storage/{key}").status_code
+            else:
+                method = 'PUT'
+                status = load_pool.put(node, f"/storage/{key}", data=payload[:rng.randint(low, high)]).status_code
+        except requests.exceptions.RequestException:
+            status = None
+        recorder.record(method, status, time.perf_counter() - start_time)
+    return operation
+
+
+def closed_loop(operation, concurrency, duration, seed):
+    """Every thread sends a request as soon as its last one was answered, returns the seconds the run took."""
+    start_time = time.perf_counter()
+    end_time = start_time + duration
+
+    def worker(index):
+        rng = random.Random(seed * 1000003 + index)
+        while time.perf_counter() < end_time:
+            operation(rng)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start_time
+
+
+def open_loop(operation, rate, concurrency, duration, seed):
+    """
+    Send requests at a fixed rate on up to concurrency threads, returns the seconds the run took. Latencies count
+    from when a request was due, so requests waiting for a free thread add to them instead of lowering the rate.
+    """
+    local = threading.local()
+    counter = itertools.count()
+
+    def send(scheduled):
+        if not hasattr(local, 'rng'):
+            local.rng = random.Random(seed * 1000003 + next(counter))
+        operation(local.rng, scheduled)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for index in range(int(rate * duration)):
+            scheduled = start_time + index / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, scheduled)
+    return time.perf_counter() - start_time
+
+
+def run_load(args):
+    nodes = args.nodes
+    concurrencies = [int(count) for count in args.concurrency.split(',')]
+    rates = [float(rate) for rate in args.rate.split(',')]
+    load_pool = PeerPool(pool_size=max(concurrencies))
+    sample_key = key_sampler(args.distribution, args.keys, args.zipf_exponent, args.hot_fraction, args.hot_weight)
+
+    if not args.no_preload:
+        print(f"Writing {args.keys} keys...")
+        value = b'x' * value_sizes(args.value_size)[0]
+        with ThreadPoolExecutor(max_workers=max(concurrencies)) as executor:
+            list(executor.map(lambda i: load_pool.put(nodes[i % len(nodes)], f"/storage/load-{i}", data=value),
+                              range(args.keys)))
+
+    levels = [(count, None) for count in concurrencies] if args.mode == 'closed' else \
+        [(max(concurrencies), rate) for rate in rates]
+    results = []
+    print(f"{'threads':>7} {'rate':>7} {'ops/s':>8} {'errors':>7} "
+          f"{'GET p50':>8} {'p95':>7} {'p99':>7} {'p999':>7} {'PUT p50':>8} {'p99':>7} (ms)")
+    for concurrency, rate in levels:
+        recorder = LoadRecorder()
+        operation = load_operation(load_pool, nodes, args, sample_key, recorder)
+        if rate is None:
+            elapsed = closed_loop(operation, concurrency, args.duration, args.seed)
+        else:
+            elapsed = open_loop(operation, rate, concurrency, args.duration, args.seed)
+        result = dict({'mode': args.mode, 'concurrency': concurrency, 'rate': rate,
+                       'distribution': args.distribution, 'read_fraction': args.read_fraction,
+                       'value_size': args.value_size}, **recorder.summary(elapsed))
+        results.append(result)
+        get, put = result['GET'], result['PUT']
+        print(f"{concurrency:>7} {rate or '-':>7} {result['throughput']:>8.0f} {result['errors']:>7} "
+              f"{get.get('p50_ms', 0):>8.2f} {get.get('p95_ms', 0):>7.2f} {get.get('p99_ms', 0):>7.2f} "
+              f"{get.get('p999_ms', 0):>7.2f} {put.get('p50_ms', 0):>8.2f} {put.get('p99_ms', 0):>7.2f}", flush=True)
+    load_pool.close()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.plot:
+        plot_load_results(results, args.plot)
+
+
+def plot_load_results(results, filename):
+    """Plots GET and PUT latency percentiles vs. the throughput of every run."""
+    throughputs = [result['throughput'] for result in results]
+    for method, color in (('GET', 'b'), ('PUT', 'r')):
+        for percentile, style in (('p50_ms', '-o'), ('p99_ms', '--s'), ('p999_ms', ':^')):
+            latencies = [result[method].get(percentile) for result in results]
+            if None not in latencies:
+                plt.plot(throughputs, latencies, color + style, label=f"{method} {percentile[:-3]}")
+    plt.xlabel("Throughput (requests/s)")
+    plt.ylabel("Latency (ms)")
+    plt.yscale('log')
+    plt.title("Latency Percentiles vs. Throughput")
+    plt.legend()
+    plt.grid(True)
+    plt.savefig(filename)
+    print(f"Plot saved as {filename}")
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "load":
+        run_load(load_arg_parser().parse_args(sys.argv[2:]))
+        sys.exit(0)
+
     if len(sys.argv) < 3:
         print("Usage: python experiment.py <node1> <node2> ...")
+        print("       python experiment.py load <node1> <node2> ... [options], see load --help")
         sys.exit(1)
 
     node_addresses = sys.argv[1:-1]
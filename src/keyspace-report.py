@@ -0,0 +1,34 @@
+import argparse
+import json
+
+from peers import PeerPool
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Report the keyspace fraction and stored keys of every node")
+    parser.add_argument("nodes", type=str, help="JSON list of node addresses, e.g. '[\"c6-5:6258\", \"c6-4:54341\"]'")
+    return parser
+
+
+def main(args):
+    pool = PeerPool()
+    nodes = json.loads(args.nodes)
+    reports = [pool.get(node, "/stats/keyspace").json() for node in nodes]
+    total_keys = sum(report['keys'] for report in reports) or 1
+    ideal = 1 / len(reports)
+
+    print(f"{'node':<24} {'vnodes':>6} {'keyspace':>9} {'keys':>8} {'key share':>9}")
+    for report in sorted(reports, key=lambda report: report['fraction'], reverse=True):
+        print(f"{report['address']:<24} {report['vnodes']:>6} {report['fraction']:>9.2%} "
+              f"{report['keys']:>8} {report['keys'] / total_keys:>9.2%}")
+
+    # skew is the largest share relative to an even split, 1.0 is a perfectly even ring
+    largest = max(report['fraction'] for report in reports)
+    print(f"keyspace skew: {largest / ideal:.2f}x of an even split")
+    pool.close()
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    main(args)
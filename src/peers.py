@@ -0,0 +1,120 @@
+import statistics
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# pooled keep-alive HTTP connections to other nodes, shared by all request threads
+class PeerPool:
+
+    def __init__(self, pool_size=10, max_peers=64, connect_timeout=2.0, read_timeout=5.0,
+                 retries=1, backoff=0.05, latency_alpha=0.2):
+        """
+        pool_size is the number of kept-alive connections per peer and max_peers the number of
+        peers with an open pool. Only failed connection attempts are retried, with backoff.
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(total=retries, connect=retries, read=0, status=0, other=0,
+                      backoff_factor=backoff, raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=max_peers, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+
+        # per peer request, error and timeout counters
+        self.lock = threading.Lock()
+        self.counters = {}
+
+        # exponentially weighted moving averages of the response time of each peer and of its deviation, in seconds
+        self.latency_alpha = latency_alpha
+        self.latencies = {}
+        self.deviations = {}
+
+    def request(self, method, peer, path, **kwargs):
+        """Send a request to http://<peer><path> over a pooled connection."""
+        kwargs.setdefault('timeout', self.timeout)
+        start_time = time.monotonic()
+        try:
+            response = self.session.request(method, f"http://{peer}{path}", **kwargs)
+        except requests.exceptions.Timeout:
+            self._count(peer, 'timeouts')
+            raise
+        except requests.exceptions.RequestException:
+            self._count(peer, 'errors')
+            raise
+        self._count(peer, 'requests')
+        self._observe(peer, time.monotonic() - start_time)
+        return response
+
+    def get(self, peer, path, **kwargs):
+        return self.request('GET', peer, path, **kwargs)
+
+    def put(self, peer, path, **kwargs):
+        return self.request('PUT', peer, path, **kwargs)
+
+    def post(self, peer, path, **kwargs):
+        return self.request('POST', peer, path, **kwargs)
+
+    def _count(self, peer, counter):
+        with self.lock:
+            counters = self.counters.setdefault(peer, {'requests': 0, 'errors': 0, 'timeouts': 0})
+            counters[counter] += 1
+
+    def _observe(self, peer, elapsed):
+        with self.lock:
+            previous = self.latencies.get(peer)
+            if previous is None:
+                self.latencies[peer] = elapsed
+                self.deviations[peer] = elapsed / 2
+                return
+            self.deviations[peer] += self.latency_alpha * (abs(elapsed - previous) - self.deviations[peer])
+            self.latencies[peer] = previous + self.latency_alpha * (elapsed - previous)
+
+    def latency(self, peer):
+        """Smoothed response time of a peer, None before the first response."""
+        return self.latencies.get(peer)
+
+    def latency_percentile(self, peer, percentile):
+        """
+        Estimated response time percentile of a peer from its smoothed mean and deviation, assuming roughly normal
+        response times. None before the first response.
+        """
+        with self.lock:
+            mean, deviation = self.latencies.get(peer), self.deviations.get(peer)
+        if mean is None:
+            return None
+        # the standard deviation of a normal distribution is sqrt(pi / 2) times its mean absolute deviation
+        z = statistics.NormalDist().inv_cdf(percentile / 100)
+        return max(mean + z * 1.2533 * deviation, 0.0)
+
+    def stats(self):
+        """Counters and opened connections per peer."""
+        with self.lock:
+            peers = {peer: dict(counters) for peer, counters in self.counters.items()}
+            for peer, latency in self.latencies.items():
+                entry = peers.setdefault(peer, {'requests': 0, 'errors': 0, 'timeouts': 0})
+                entry['latency_ewma'] = latency
+                entry['latency_deviation'] = self.deviations[peer]
+
+        # connections opened by urllib3, reused connections are not counted again
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            peer = f"{pool.host}:{pool.port}"
+            entry = peers.setdefault(peer, {'requests': 0, 'errors': 0, 'timeouts': 0})
+            entry['connections_opened'] = pool.num_connections
+            entry['idle_connections'] = sum(1 for conn in pool.pool.queue if conn is not None) if pool.pool else 0
+
+        return {
+            'pool_size': self.adapter._pool_maxsize,
+            'connect_timeout': self.timeout[0],
+            'read_timeout': self.timeout[1],
+            'peers': peers,
+        }
+
+    def close(self):
+        self.session.close()
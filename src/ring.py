@@ -0,0 +1,92 @@
+import bisect
+from collections import namedtuple
+
+M = 160  # number of bits in the identifier space due to SHA-1 hashing
+RING_SIZE = 2**M
+
+# finger i of node n: the successor of start = (n + 2^i) mod 2^m, with its precomputed ID
+Finger = namedtuple('Finger', ['start', 'node_id', 'address'])
+
+# routing state of a node, built whole and published in one assignment so readers never see a partly updated ring;
+# members maps address -> number of virtual nodes and finger_tables virtual node ID -> its fingers, neither changes
+Routing = namedtuple('Routing', ['epoch', 'members', 'ring', 'finger_tables',
+                                 'successor', 'successor_id', 'predecessor', 'predecessor_id'])
+
+
+def in_interval(value, start, end):
+    """Check if value lies in the circular interval (start, end]."""
+    if start < end:
+        return start < value <= end
+    # the interval wraps past zero, or covers the whole ring when start == end
+    return value > start or value <= end
+
+
+def in_open_interval(value, start, end):
+    """Check if value lies in the circular interval (start, end)."""
+    if start < end:
+        return start < value < end
+    return (value > start or value < end) and value != start
+
+
+# sorted index of the ring members, built once per membership change
+class Ring:
+
+    def __init__(self, entries):
+        """Build the index from (node ID, address) pairs, an address may appear once per virtual node."""
+        entries = sorted(entries)
+        self.ids = [node_id for node_id, _ in entries]
+        self.addresses = [address for _, address in entries]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def successor_index(self, key_hash):
+        """Index of the first node whose ID is equal to or follows key_hash on the ring."""
+        return bisect.bisect_left(self.ids, key_hash) % len(self.ids)
+
+    def successor(self, key_hash):
+        """Address of the node responsible for key_hash."""
+        return self.addresses[self.successor_index(key_hash)]
+
+    def predecessor(self, node_id):
+        """Address of the member whose ID precedes node_id on the ring."""
+        return self.addresses[self.successor_index(node_id) - 1]
+
+    def replicas(self, key_hash, count):
+        """The responsible node for key_hash followed by its successors, count distinct addresses at most."""
+        index = self.successor_index(key_hash)
+        replicas = []
+        for step in range(len(self.ids)):
+            address = self.addresses[(index + step) % len(self.ids)]
+            if address not in replicas:
+                replicas.append(address)
+                if len(replicas) == count:
+                    break
+        return replicas
+
+    def finger(self, start):
+        """Finger table entry for the given start."""
+        index = self.successor_index(start)
+        return Finger(start, self.ids[index], self.addresses[index])
+
+    def arc(self, key_hash):
+        """Key hash range (start, end] of the virtual node responsible for key_hash."""
+        index = self.successor_index(key_hash)
+        return self.ids[index - 1], self.ids[index]
+
+    def ownership(self):
+        """Fraction of the key space each address is responsible for, summed over its virtual nodes."""
+        fractions = {}
+        for index, address in enumerate(self.addresses):
+            # a single member covers the whole ring
+            length = (self.ids[index] - self.ids[index - 1]) % RING_SIZE or RING_SIZE
+            fractions[address] = fractions.get(address, 0) + length / RING_SIZE
+        return fractions
+
+    def neighbours(self, node_id):
+        """Return ((successor, id), (predecessor, id)) of the member with the given ID."""
+        index = self.successor_index(node_id)
+        next_index = (index + 1) % len(self.ids)
+        prev_index = (index - 1) % len(self.ids)
+        return ((self.addresses[next_index], self.ids[next_index]),
+                (self.addresses[prev_index], self.ids[prev_index]))
@@ -0,0 +1,86 @@
+import argparse
+import contextlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server
+
+import Node
+import rpc
+from peers import PeerPool
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Compare per-hop latency and messages per second of HTTP and the binary protocol")
+    parser.add_argument("--port", type=int, default=47000, help="HTTP port of the benchmarked node")
+    parser.add_argument("--rpc-offset", type=int, default=1, help="the binary protocol listens on port + offset")
+    parser.add_argument("--requests", type=int, default=2000, help="sequential requests per latency measurement")
+    parser.add_argument("--threads", type=int, default=16, help="concurrent callers for the throughput measurement")
+    parser.add_argument("--value-size", type=int, default=64, help="bytes of the value that is read")
+    return parser
+
+
+def latency(call, count):
+    """Per-call latencies in microseconds, sorted."""
+    samples = []
+    for _ in range(count):
+        start_time = time.perf_counter()
+        call()
+        samples.append((time.perf_counter() - start_time) * 1e6)
+    return sorted(samples)
+
+
+def throughput(call, count, threads):
+    """Calls per second with threads concurrent callers."""
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(lambda _: call(), range(count)))
+    return count / (time.perf_counter() - start_time)
+
+
+def main(args):
+    address = f"127.0.0.1:{args.port}"
+    headers = {Node.FORWARDED_HEADER: '1'}
+    key = "benchmark-key"
+
+    # a single node answering both transports, its request logging is discarded
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        key_hash = Node.hash_value(key)
+        node = Node.Node(address, stabilize_interval=0)
+        node.put(key, os.urandom(args.value_size), headers={})
+        Node.node1 = node
+        server = make_server("127.0.0.1", args.port, Node.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        rpc.RpcServer(node.serve_rpc, args.port + args.rpc_offset).start()
+
+        peers = PeerPool(pool_size=args.threads)
+        client = rpc.RpcClient(args.rpc_offset)
+        calls = {
+            ('http', 'get'): lambda: peers.get(address, f"/storage/{key}", headers=headers).content,
+            ('binary', 'get'): lambda: client.storage('GET', address, key, headers=headers).content,
+            ('http', 'lookup'): lambda: peers.get(address, f"/find_successor/{key_hash:040x}").json(),
+            ('binary', 'lookup'): lambda: client.lookup(address, key_hash),
+        }
+        results = {}
+        for (transport, operation), call in calls.items():
+            call()  # open the connection first
+            samples = latency(call, args.requests)
+            rate = throughput(call, args.requests, args.threads)
+            results[transport, operation] = (samples, rate)
+        server.shutdown()
+
+    print(f"{'transport':<10} {'request':<8} {'mean us':>9} {'p50 us':>9} {'p99 us':>9} {'msgs/s':>9}")
+    for (transport, operation), (samples, rate) in results.items():
+        mean = sum(samples) / len(samples)
+        p50, p99 = samples[len(samples) // 2], samples[int(len(samples) * 0.99)]
+        print(f"{transport:<10} {operation:<8} {mean:>9.0f} {p50:>9.0f} {p99:>9.0f} {rate:>9.0f}")
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    main(args)
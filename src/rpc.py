@@ -0,0 +1,281 @@
+import itertools
+import logging
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import requests
+
+# every frame: length of the body that follows, request ID, then the operation of a request or the status of a reply
+FRAME = struct.Struct('>IIH')
+
+# operations, replies use HTTP status codes so both transports are handled alike
+LOOKUP = 1
+PUT = 2
+GET = 3
+RANGE = 4
+OP_NAMES = {LOOKUP: 'lookup', PUT: 'put', GET: 'get', RANGE: 'range'}
+
+KEY = struct.Struct('>H')
+LOOKUP_REPLY = struct.Struct('>?20s20s')
+RANGE_REQUEST = struct.Struct('>HQ')
+
+log = logging.getLogger('chord.rpc')
+
+
+def pack_headers(headers):
+    """Encode header name/value pairs as a count followed by length-prefixed names and values."""
+    parts = [bytes([len(headers)])]
+    for name, value in headers.items():
+        name, value = name.encode(), str(value).encode()
+        parts += [bytes([len(name)]), name, KEY.pack(len(value)), value]
+    return b''.join(parts)
+
+
+def unpack_headers(data, offset=0):
+    """Decode a header block, returns (headers, offset after the block)."""
+    headers = {}
+    count = data[offset]
+    offset += 1
+    for _ in range(count):
+        name_length = data[offset]
+        name = bytes(data[offset + 1:offset + 1 + name_length]).decode()
+        offset += 1 + name_length
+        value_length, = KEY.unpack_from(data, offset)
+        headers[name] = bytes(data[offset + KEY.size:offset + KEY.size + value_length]).decode()
+        offset += KEY.size + value_length
+    return headers, offset
+
+
+def pack_key(key):
+    key = key.encode()
+    return KEY.pack(len(key)) + key
+
+
+def unpack_key(data, offset=0):
+    length, = KEY.unpack_from(data, offset)
+    start = offset + KEY.size
+    return bytes(data[start:start + length]).decode(), start + length
+
+
+def read_frame(reader):
+    """Read one frame, returns (request_id, code, body) or None once the connection is closed."""
+    header = reader.read(FRAME.size)
+    if len(header) < FRAME.size:
+        return None
+    length, request_id, code = FRAME.unpack(header)
+    body = reader.read(length)
+    if len(body) < length:
+        return None
+    return request_id, code, body
+
+
+# reply to a storage request sent over the binary protocol, with the parts of requests.Response the node uses
+class RpcResponse:
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self.headers.setdefault('Content-Length', str(len(content)))
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode(errors='replace')
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} from binary protocol", response=self)
+
+    def close(self):
+        pass
+
+
+# one persistent connection to a peer, calls from any thread are pipelined on it and matched by request ID
+class _Connection:
+
+    def __init__(self, address, connect_timeout):
+        self.sock = socket.create_connection(address, timeout=connect_timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+        self.send_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.pending = {}  # request ID -> Future of (status, body)
+        self.closed = False
+        threading.Thread(target=self._read_replies, daemon=True).start()
+
+    def call(self, op, body, timeout):
+        request_id = next(self.request_ids) & 0xFFFFFFFF
+        future = Future()
+        self.pending[request_id] = future
+        try:
+            with self.send_lock:
+                self.sock.sendall(FRAME.pack(len(body), request_id, op) + body)
+            return future.result(timeout)
+        except FutureTimeout:
+            # checked first, it is an OSError since Python 3.11 but leaves the connection usable
+            raise requests.exceptions.ReadTimeout(f"No reply to request {request_id} within {timeout} seconds")
+        except OSError as e:
+            self.close()
+            raise requests.exceptions.ConnectionError(e)
+        finally:
+            self.pending.pop(request_id, None)
+
+    def _read_replies(self):
+        try:
+            while True:
+                frame = read_frame(self.reader)
+                if frame is None:
+                    break
+                request_id, status, body = frame
+                future = self.pending.pop(request_id, None)
+                if future is not None:
+                    future.set_result((status, body))
+        except OSError:
+            pass
+        self.close()
+
+    def close(self):
+        self.closed = True
+        for future in list(self.pending.values()):
+            if not future.done():
+                future.set_exception(requests.exceptions.ConnectionError("Connection closed"))
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+# node-to-node calls over the binary protocol, failures raise the requests exceptions the HTTP transport raises
+class RpcClient:
+
+    def __init__(self, port_offset, peers=None, connect_timeout=2.0, read_timeout=5.0):
+        """
+        Every node listens for the binary protocol on its HTTP port + port_offset. Calls are counted and timed
+        in peers, the PeerPool of the HTTP requests, so its statistics and latency estimates cover both.
+        """
+        self.port_offset = port_offset
+        self.peers = peers
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.lock = threading.Lock()
+        self.connections = {}
+
+    def _connection(self, peer):
+        with self.lock:
+            connection = self.connections.get(peer)
+            if connection is None or connection.closed:
+                host, port = peer.rsplit(':', 1)
+                try:
+                    connection = _Connection((host, int(port) + self.port_offset), self.connect_timeout)
+                except OSError as e:
+                    raise requests.exceptions.ConnectionError(e)
+                self.connections[peer] = connection
+            return connection
+
+    def call(self, peer, op, body, timeout=None):
+        """Send one request and wait up to timeout seconds for its reply, returns (status, reply headers, reply data)."""
+        start_time = time.monotonic()
+        try:
+            status, reply = self._connection(peer).call(op, body, timeout or self.read_timeout)
+        except requests.exceptions.Timeout:
+            self._count(peer, 'timeouts')
+            raise
+        except requests.exceptions.ConnectionError:
+            self._count(peer, 'errors')
+            raise
+        self._count(peer, 'requests')
+        if self.peers is not None:
+            self.peers._observe(peer, time.monotonic() - start_time)
+        headers, offset = unpack_headers(reply)
+        return status, headers, reply[offset:]
+
+    def _count(self, peer, counter):
+        if self.peers is not None:
+            self.peers._count(peer, counter)
+
+    def lookup(self, peer, key_hash, timeout=None):
+        """One routing step at peer, returns the reply of /find_successor."""
+        status, _, data = self.call(peer, LOOKUP, key_hash.to_bytes(20, 'big'), timeout)
+        if status != 200:
+            raise requests.exceptions.HTTPError(f"{status} from binary protocol lookup")
+        done, start, end = LOOKUP_REPLY.unpack_from(data)
+        reply = {'node': data[LOOKUP_REPLY.size:].decode(), 'done': done}
+        if done:
+            reply.update({'start': start.hex(), 'end': end.hex()})
+        return reply
+
+    def storage(self, method, peer, key, body=None, headers=None, timeout=None):
+        """PUT or GET a key at peer, returns an RpcResponse."""
+        request = pack_key(key) + pack_headers(headers or {})
+        if method == 'PUT':
+            request += body
+        status, reply_headers, data = self.call(peer, PUT if method == 'PUT' else GET, request, timeout)
+        return RpcResponse(status, reply_headers, data)
+
+    def range(self, peer, node, vnodes, since=0):
+        """The range records node takes over from peer, returns (records, reply headers)."""
+        status, reply_headers, data = self.call(peer, RANGE, pack_key(node) + RANGE_REQUEST.pack(vnodes, since))
+        if status != 200:
+            raise requests.exceptions.HTTPError(f"{status} from binary protocol range transfer")
+        return data, reply_headers
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections.values():
+                connection.close()
+            self.connections.clear()
+
+
+# serves the binary protocol, requests of a connection are handled concurrently and replied to as they complete
+class RpcServer:
+
+    def __init__(self, handler, port, workers=32):
+        """handler(op, body) returns (status, reply headers, reply data) for a request frame."""
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.sock = socket.create_server(("0.0.0.0", port))
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def serve_forever(self):
+        while True:
+            connection, _ = self.sock.accept()
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._serve_connection, args=(connection,), daemon=True).start()
+
+    def _serve_connection(self, connection):
+        reader = connection.makefile('rb')
+        send_lock = threading.Lock()
+        try:
+            while True:
+                frame = read_frame(reader)
+                if frame is None:
+                    break
+                self.executor.submit(self._handle, connection, send_lock, *frame)
+        except OSError:
+            pass
+        finally:
+            reader.close()
+            connection.close()
+
+    def _handle(self, connection, send_lock, request_id, op, body):
+        try:
+            status, headers, data = self.handler(op, memoryview(body))
+        except Exception as e:
+            log.error("Error handling binary protocol request %s: %s", op, e)
+            status, headers, data = 500, {}, str(e).encode()
+        reply = pack_headers(headers) + data
+        try:
+            with send_lock:
+                connection.sendall(FRAME.pack(len(reply), request_id, status) + reply)
+        except OSError:
+            pass
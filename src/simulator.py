@@ -0,0 +1,241 @@
+import argparse
+import bisect
+import csv
+import json
+import random
+import time
+
+import numpy as np
+import requests
+
+import rpc
+from Node import Node, hash_value, vnode_names
+from peers import PeerPool
+from ring import M, RING_SIZE, Ring, Routing
+
+# port of every simulated member address, addresses only have to be unique
+PORT = 5000
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Simulate Chord rings in one process to measure routing at scale")
+    parser.add_argument("--nodes", type=str, default="10,100,1000,10000,100000",
+                        help="comma separated ring sizes to simulate")
+    parser.add_argument("--vnodes", type=int, default=1, help="virtual nodes of every member")
+    parser.add_argument("--lookups", type=int, default=1000, help="lookups of random keys from random members per ring")
+    parser.add_argument("--keys", type=int, default=100000, help="keys assigned to owners for the per-node load")
+    parser.add_argument("--latency", type=float, default=0.001, help="mean one-way latency of a link, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="standard deviation of the link latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="probability that a message is lost")
+    parser.add_argument("--dead-fraction", type=float, default=0.0,
+                        help="fraction of members that crashed but are still in the routing tables of the others")
+    parser.add_argument("--timeout", type=float, default=1.0, help="seconds a lost message costs its sender")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random ring, keys and failures")
+    parser.add_argument("--json", help="write the results to this JSON file")
+    parser.add_argument("--csv", help="write the results to this CSV file")
+    return parser
+
+
+# in-memory stand-in for the binary protocol client: requests go straight to the serve_rpc of the target Node,
+# with injected link latency and message loss counted on a simulated clock
+class MemoryTransport(rpc.RpcClient):
+
+    def __init__(self, ring, latency=0.0, jitter=0.0, failure_rate=0.0, timeout=1.0, rng=None):
+        super().__init__(port_offset=0)
+        self.ring = ring
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.timeout = timeout
+        self.rng = rng or random.Random()
+        self.elapsed = 0.0  # simulated seconds spent waiting on links
+        self.messages = {}  # address -> requests it received
+
+    def call(self, peer, op, body, timeout=None):
+        """Deliver one request and its reply, returns (status, reply headers, reply data)."""
+        if peer in self.ring.dead or self.rng.random() < self.failure_rate:
+            self.elapsed += timeout or self.timeout
+            raise requests.exceptions.ConnectionError(f"Message to {peer} lost")
+        self.elapsed += sum(max(self.rng.gauss(self.latency, self.jitter), 0) for _ in range(2))
+        self.messages[peer] = self.messages.get(peer, 0) + 1
+        return self.ring.node(peer).serve_rpc(op, memoryview(body))
+
+    def close(self):
+        pass
+
+
+# the members of a simulated ring; their Node is created the first time a request reaches them,
+# so large rings only pay for the members that lookups visit
+class SimulatedRing:
+
+    def __init__(self, size, vnodes=1, dead_fraction=0.0, rng=None, **link):
+        """link holds the latency, jitter, failure_rate and timeout of the MemoryTransport between members."""
+        rng = rng or random.Random()
+        self.vnodes = vnodes
+        self.addresses = [f"sim-{i}:{PORT}" for i in range(size)]
+        self.members = {address: vnodes for address in self.addresses}
+        self.node_ids = {address: sorted(hash_value(name) for name in vnode_names(address, vnodes))
+                         for address in self.addresses}
+        self.ring = Ring((node_id, address) for address, node_ids in self.node_ids.items() for node_id in node_ids)
+        # successor and predecessor are the neighbouring members, ordered by the ID of their address
+        self.neighbours = Ring((hash_value(address), address) for address in self.addresses)
+        self.dead = set(rng.sample(self.addresses, int(size * dead_fraction)))
+        self.transport = MemoryTransport(self, rng=rng, **link)
+        self.peers = PeerPool()
+        self.nodes = {}
+        self.build_seconds = 0.0  # spent building the routing state of the created nodes
+
+    def node(self, address):
+        """The Node of a member, created with its routing state on first use."""
+        node = self.nodes.get(address)
+        if node is None:
+            node = Node(address, lookup_mode='iterative', peers=self.peers, vnodes=self.vnodes, location_cache_size=0,
+                        stabilize_interval=0, rpc_client=self.transport, hedge_percentile=0)
+            start_time = time.perf_counter()
+            node.routing = self.routing(address, node.node_ids)
+            self.build_seconds += time.perf_counter() - start_time
+            self.nodes[address] = node
+        return node
+
+    def routing(self, address, node_ids):
+        """
+        Routing state of a member. Its finger tables keep the first of every run of fingers with the same successor,
+        routing only looks at distinct fingers so the next hops are those of the full tables.
+        """
+        finger_tables = {vnode_id: self.fingers(vnode_id) for vnode_id in node_ids}
+        (successor, successor_id), (predecessor, predecessor_id) = self.neighbours.neighbours(hash_value(address))
+        return Routing(1, self.members, self.ring, finger_tables, successor, successor_id, predecessor, predecessor_id)
+
+    def fingers(self, vnode_id):
+        fingers = []
+        i = 0
+        while i < M:
+            finger = self.ring.finger((vnode_id + 2**i) % RING_SIZE)
+            fingers.append(finger)
+            # every finger whose start is no further than this successor points to it
+            i = max(((finger.node_id - vnode_id) % RING_SIZE).bit_length(), i + 1)
+        return fingers
+
+
+def key_owners(ring, key_hashes):
+    """Ring index of the owner of every key hash, found with a search over the top 64 bits of the IDs."""
+    ids = np.array([node_id >> (M - 64) for node_id in ring.ids], dtype=np.uint64)
+    keys = np.array([key_hash >> (M - 64) for key_hash in key_hashes], dtype=np.uint64)
+    owners = np.searchsorted(ids, keys, side='left')
+    # keys sharing their top bits with a node ID are placed exactly
+    for index in np.nonzero(ids[owners % len(ids)] == keys)[0]:
+        owners[index] = bisect.bisect_left(ring.ids, key_hashes[index])
+    return owners % len(ids)
+
+
+def load_stats(simulated, key_hashes):
+    """Key space share, keys and routing requests per member, as (mean, max) pairs."""
+    ring = simulated.ring
+    index = {address: i for i, address in enumerate(simulated.addresses)}
+    member = np.array([index[address] for address in ring.addresses])
+
+    # share of the key space of every virtual node, the arc from the ID before it
+    ids = np.array([node_id / RING_SIZE for node_id in ring.ids])
+    arcs = np.diff(ids, prepend=ids[-1] - 1.0)
+    shares = np.bincount(member, weights=arcs, minlength=len(index))
+    keys = np.bincount(member[key_owners(ring, key_hashes)], minlength=len(index))
+    messages = np.zeros(len(index))
+    for address, count in simulated.transport.messages.items():
+        messages[index[address]] = count
+    return {'share': (shares.mean(), shares.max()), 'keys': (keys.mean(), keys.max()),
+            'messages': (messages.mean(), messages.max())}
+
+
+def rebuild_time(simulated):
+    """Seconds a Node takes to rebuild its full routing state from the member list, the cost of a membership change."""
+    node = Node(simulated.addresses[0], peers=simulated.peers, vnodes=simulated.vnodes, stabilize_interval=0,
+                hedge_percentile=0)
+    start_time = time.perf_counter()
+    with node.membership_lock:
+        node.rebuild_ring(simulated.members)
+    return time.perf_counter() - start_time
+
+
+def simulate(size, args, key_hashes):
+    rng = random.Random(args.seed)
+    start_time = time.perf_counter()
+    simulated = SimulatedRing(size, vnodes=args.vnodes, dead_fraction=args.dead_fraction, rng=rng,
+                              latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                              timeout=args.timeout)
+    setup_seconds = time.perf_counter() - start_time
+
+    alive = [address for address in simulated.addresses if address not in simulated.dead]
+    transport = simulated.transport
+    hops, latencies, failed = [], [], 0
+    for _ in range(args.lookups):
+        key_hash = rng.getrandbits(M)
+        transport.elapsed = 0.0
+        try:
+            owner, count = simulated.node(rng.choice(alive)).lookup(key_hash)
+        except (requests.exceptions.RequestException, RuntimeError):
+            failed += 1
+            continue
+        if owner != simulated.ring.successor(key_hash):
+            failed += 1
+            continue
+        hops.append(count)
+        latencies.append(transport.elapsed * 1000)
+
+    hops, latencies = np.array(hops or [0]), np.array(latencies or [0.0])
+    load = load_stats(simulated, key_hashes)
+    return {
+        'nodes': size,
+        'vnodes': args.vnodes,
+        'lookups': args.lookups,
+        'success_rate': (args.lookups - failed) / args.lookups if args.lookups else 1.0,
+        'hops_mean': hops.mean(),
+        'hops_p50': np.percentile(hops, 50),
+        'hops_p99': np.percentile(hops, 99),
+        'hops_max': int(hops.max()),
+        'latency_mean_ms': latencies.mean(),
+        'latency_p99_ms': np.percentile(latencies, 99),
+        'setup_seconds': setup_seconds,
+        'nodes_created': len(simulated.nodes),
+        'routing_build_ms': simulated.build_seconds / max(len(simulated.nodes), 1) * 1000,
+        'rebuild_seconds': rebuild_time(simulated),
+        'share_mean': load['share'][0],
+        'share_max': load['share'][1],
+        'keys_mean': load['keys'][0],
+        'keys_max': int(load['keys'][1]),
+        'messages_mean': load['messages'][0],
+        'messages_max': int(load['messages'][1]),
+        'elapsed_seconds': time.perf_counter() - start_time,
+    }
+
+
+def main(args):
+    sizes = [int(size) for size in args.nodes.split(',')]
+    key_hashes = [hash_value(f"key-{i}") for i in range(args.keys)]
+
+    results = []
+    print(f"{'nodes':>7} {'success':>8} {'hops':>6} {'p99':>5} {'ms':>7} {'build ms':>9} {'rebuild s':>10} "
+          f"{'max/mean keys':>14} {'max/mean msgs':>14} {'seconds':>8}")
+    for size in sizes:
+        result = {name: float(value) if isinstance(value, np.floating) else value
+                  for name, value in simulate(size, args, key_hashes).items()}
+        results.append(result)
+        print(f"{size:>7} {result['success_rate']:>8.3f} {result['hops_mean']:>6.2f} {result['hops_p99']:>5.0f} "
+              f"{result['latency_mean_ms']:>7.2f} {result['routing_build_ms']:>9.3f} {result['rebuild_seconds']:>10.3f} "
+              f"{result['keys_max'] / max(result['keys_mean'], 1e-9):>14.2f} "
+              f"{result['messages_max'] / max(result['messages_mean'], 1e-9):>14.2f} {result['elapsed_seconds']:>8.2f}",
+              flush=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    main(args)
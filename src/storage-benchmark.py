@@ -0,0 +1,99 @@
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import CompactStore, LogStore
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Measure write throughput, memory per entry and recovery time of the "
+                                                 "storage backends")
+    parser.add_argument("--records", type=int, default=20000, help="number of records to write")
+    parser.add_argument("--value-size", type=int, default=512, help="bytes per value")
+    parser.add_argument("--threads", type=int, default=16, help="concurrent writers")
+    parser.add_argument("--sync", nargs="+", default=['none', 'group', 'always'], help="log sync modes to compare")
+    parser.add_argument("--dir", help="directory for the segment files, a temporary directory by default")
+    return parser
+
+
+def key_hashes(count):
+    return [int(hashlib.sha1(f"key-{i}".encode()).hexdigest(), 16) for i in range(count)]
+
+
+def write_all(store, keys, value, threads):
+    """Write every key from a pool of writer threads, returns the elapsed time."""
+    def write(key_hash):
+        store[key_hash] = value
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(write, keys))
+    return time.time() - start_time
+
+
+def entry_bytes(factory, keys, value_size):
+    """Bytes per entry of a store, counting the key and value objects a node creates for every write."""
+    tracemalloc.start()
+    store = factory()
+    for key_hash in keys:
+        store[int.from_bytes(key_hash.to_bytes(20, 'big'), 'big')] = b'x' * value_size
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / len(keys)
+
+
+def remove_hints(directory):
+    for name in os.listdir(directory):
+        if name.endswith('.hint'):
+            os.remove(os.path.join(directory, name))
+
+
+def main(args):
+    keys = key_hashes(args.records)
+    value = b'x' * args.value_size
+    base_dir = args.dir or tempfile.mkdtemp(prefix="storage-benchmark-")
+
+    # in-memory stores as the baseline
+    elapsed = write_all({}, keys, value, args.threads)
+    print(f"memory: {args.records / elapsed:.0f} writes/s")
+    elapsed = write_all(CompactStore(), keys, value, args.threads)
+    print(f"compact: {args.records / elapsed:.0f} writes/s")
+    memory, compact = entry_bytes(dict, keys, args.value_size), entry_bytes(CompactStore, keys, args.value_size)
+    print(f"memory: {memory:.0f} bytes/entry, compact: {compact:.0f} bytes/entry ({memory / compact:.2f}x fewer)")
+
+    for sync in args.sync:
+        directory = os.path.join(base_dir, sync)
+        shutil.rmtree(directory, ignore_errors=True)
+
+        store = LogStore(directory, sync=sync)
+        elapsed = write_all(store, keys, value, args.threads)
+        store.close()
+        print(f"log ({sync}): {args.records / elapsed:.0f} writes/s")
+
+        # startup from the hint files, then by scanning the segments themselves
+        start_time = time.time()
+        store = LogStore(directory, sync=sync)
+        hinted = time.time() - start_time
+        assert len(store) == args.records
+        store.close()
+
+        remove_hints(directory)
+        start_time = time.time()
+        store = LogStore(directory, sync=sync)
+        scanned = time.time() - start_time
+        store.close()
+        print(f"log ({sync}): recovery {hinted * 1000:.1f} ms with hints, {scanned * 1000:.1f} ms scanning segments")
+
+    if not args.dir:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    main(args)
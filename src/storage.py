@@ -0,0 +1,565 @@
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from collections.abc import MutableMapping
+
+# record header: key digest, flags, value length, crc32 of the value
+HEADER = struct.Struct('>20sBII')
+# hint entry: key digest, flags, value offset, value length
+HINT = struct.Struct('>20sBQI')
+
+PUT = 0
+TOMBSTONE = 1
+
+# stored values carry a version and their content type: 8-byte version, 2-byte length, content type, value bytes
+VALUE_HEADER = struct.Struct('>QH')
+DEFAULT_CONTENT_TYPE = 'text/plain'
+
+log = logging.getLogger('chord.storage')
+
+
+def pack_value(data, content_type=DEFAULT_CONTENT_TYPE, version=0):
+    """Prefix the value bytes with their version and content type, the default type is stored as an empty string."""
+    encoded = b'' if content_type == DEFAULT_CONTENT_TYPE else content_type.encode('latin-1')
+    return VALUE_HEADER.pack(version, len(encoded)) + encoded + data
+
+
+def unpack_value(blob):
+    """Split a stored value into (data, content_type)."""
+    _, length = VALUE_HEADER.unpack_from(blob)
+    end = VALUE_HEADER.size + length
+    content_type = blob[VALUE_HEADER.size:end].decode('latin-1') if length else DEFAULT_CONTENT_TYPE
+    return blob[end:], content_type
+
+
+def value_version(blob):
+    """Version a stored value was written with, newer writes have higher versions."""
+    return VALUE_HEADER.unpack_from(blob)[0]
+
+
+def segment_name(segment):
+    return f"segment-{segment:08d}.log"
+
+
+def hint_name(segment):
+    return f"segment-{segment:08d}.hint"
+
+
+# append-only segment log with an in-memory key hash -> offset index, used in place of the data_store dict
+class LogStore(MutableMapping):
+
+    def __init__(self, directory, sync='group', commit_interval=0.0, segment_bytes=64 * 2**20,
+                 compact_interval=30.0, compact_ratio=0.5):
+        """
+        sync is 'group' (writers wait for a shared fsync, writes arriving during one fsync are
+        covered by the next, optionally delayed by commit_interval seconds to grow the groups),
+        'always' (fsync every write) or 'none' (leave flushing to the OS). Sealed segments with
+        at least compact_ratio garbage are rewritten every compact_interval seconds.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.sync = sync
+        self.commit_interval = commit_interval
+        self.segment_bytes = segment_bytes
+        self.compact_interval = compact_interval
+        self.compact_ratio = compact_ratio
+
+        self.index = {}  # key_hash -> (segment, value offset, value length)
+        self.fds = {}  # segment -> file descriptor
+        self.sizes = {}  # segment -> bytes written
+        self.live = {}  # segment -> bytes of records still referenced by the index
+        self.reading = {}  # file descriptor -> reads in progress on it
+        self.retired = set()  # descriptors of compacted segments still being read, closed by their last reader
+        self.lock = threading.Lock()
+        self.closed = False
+        self.stop_event = threading.Event()
+
+        # group commit state
+        self.commit_cond = threading.Condition()
+        self.written_seq = 0
+        self.synced_seq = 0
+
+        self.recover()
+
+        self.threads = [threading.Thread(target=self._compact_loop, daemon=True)]
+        if self.sync == 'group':
+            self.threads.append(threading.Thread(target=self._commit_loop, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    # startup
+
+    def recover(self):
+        """Rebuild the index from the hint files, or by scanning the segments that have none."""
+        segments = sorted(int(name[8:16]) for name in os.listdir(self.directory)
+                          if name.startswith('segment-') and name.endswith('.log'))
+        for segment in segments:
+            self.fds[segment] = os.open(self._path(segment_name(segment)), os.O_RDWR)
+            self.sizes[segment] = os.fstat(self.fds[segment]).st_size
+            self.live[segment] = 0
+            if os.path.exists(self._path(hint_name(segment))):
+                entries = self._scan_hints(segment)
+            else:
+                entries = self._scan_segment(segment)
+            for key, flags, offset, length in entries:
+                self._apply(int.from_bytes(key, 'big'), flags, segment, offset, length)
+
+        # writes continue in a fresh segment, sealed segments are never appended to
+        self.active = (segments[-1] + 1) if segments else 1
+        self.fds[self.active] = os.open(self._path(segment_name(self.active)), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.sizes[self.active] = 0
+        self.live[self.active] = 0
+        log.info("Recovered %s keys from %s segments in %s", len(self.index), len(segments), self.directory)
+
+    def _scan_hints(self, segment):
+        with open(self._path(hint_name(segment)), 'rb') as f:
+            data = f.read()
+        for position in range(0, len(data) - len(data) % HINT.size, HINT.size):
+            yield HINT.unpack_from(data, position)
+
+    def _scan_segment(self, segment):
+        """Walk the records of a segment through mmap, stopping at a torn or corrupt tail."""
+        size = self.sizes[segment]
+        if size == 0:
+            return
+        with mmap.mmap(self.fds[segment], size, access=mmap.ACCESS_READ) as data:
+            position = 0
+            while position + HEADER.size <= size:
+                key, flags, length, crc = HEADER.unpack_from(data, position)
+                offset = position + HEADER.size
+                if offset + length > size or zlib.crc32(data[offset:offset + length]) != crc:
+                    log.warning("Truncating %s at a corrupt record at %s", segment_name(segment), position)
+                    os.ftruncate(self.fds[segment], position)
+                    self.sizes[segment] = position
+                    return
+                yield key, flags, offset, length
+                position = offset + length
+
+    def _apply(self, key_hash, flags, segment, offset, length):
+        """Point the index at a record, the record it replaces becomes garbage."""
+        old = self.index.pop(key_hash, None)
+        if old is not None:
+            self.live[old[0]] -= HEADER.size + old[2]
+        if flags == PUT:
+            self.index[key_hash] = (segment, offset, length)
+            self.live[segment] += HEADER.size + length
+
+    # reads and writes
+
+    def __getitem__(self, key_hash):
+        with self.lock:
+            segment, offset, length = self.index[key_hash]
+            fd = self.fds[segment]
+            self.reading[fd] = self.reading.get(fd, 0) + 1
+        try:
+            return os.pread(fd, length, offset)
+        finally:
+            with self.lock:
+                self.reading[fd] -= 1
+                if not self.reading[fd]:
+                    del self.reading[fd]
+                    if fd in self.retired:
+                        self.retired.remove(fd)
+                        os.close(fd)
+
+    def __setitem__(self, key_hash, value):
+        self._write(key_hash, PUT, bytes(value))
+
+    def __delitem__(self, key_hash):
+        if key_hash not in self.index:
+            raise KeyError(key_hash)
+        self._write(key_hash, TOMBSTONE, b'')
+
+    def __contains__(self, key_hash):
+        return key_hash in self.index
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def __len__(self):
+        return len(self.index)
+
+    def _write(self, key_hash, flags, data):
+        with self.lock:
+            self._append(key_hash, flags, data)
+            if self.sync == 'always':
+                os.fsync(self.fds[self.active])
+            self.written_seq += 1
+            seq = self.written_seq
+            if self.sizes[self.active] >= self.segment_bytes:
+                self._roll()
+
+        # group commit: wait until a shared fsync covers this write
+        if self.sync == 'group':
+            with self.commit_cond:
+                self.commit_cond.notify_all()
+                while self.synced_seq < seq and not self.closed:
+                    self.commit_cond.wait()
+
+    def _append(self, key_hash, flags, data):
+        """Append a record to the active segment, called with the lock held."""
+        record = HEADER.pack(key_hash.to_bytes(20, 'big'), flags, len(data), zlib.crc32(data)) + data
+        offset = self.sizes[self.active] + HEADER.size
+        os.write(self.fds[self.active], record)
+        self.sizes[self.active] += len(record)
+        self._apply(key_hash, flags, self.active, offset, len(data))
+
+    def _roll(self):
+        """Seal the active segment and start a new one, called with the lock held."""
+        os.fsync(self.fds[self.active])
+        self.active += 1
+        self.fds[self.active] = os.open(self._path(segment_name(self.active)), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.sizes[self.active] = 0
+        self.live[self.active] = 0
+
+    def _commit_loop(self):
+        while True:
+            with self.commit_cond:
+                while self.synced_seq == self.written_seq and not self.closed:
+                    self.commit_cond.wait()
+                if self.closed:
+                    return
+            # let concurrent writers join this group before syncing
+            if self.commit_interval:
+                self.stop_event.wait(self.commit_interval)
+            with self.lock:
+                seq = self.written_seq
+                fd = self.fds[self.active]
+            os.fsync(fd)
+            with self.commit_cond:
+                self.synced_seq = max(self.synced_seq, seq)
+                self.commit_cond.notify_all()
+
+    # compaction
+
+    def _compact_loop(self):
+        while not self.closed:
+            self.stop_event.wait(self.compact_interval)
+            if self.closed:
+                return
+            self.compact()
+
+    def compact(self):
+        """Rewrite the live records of mostly-garbage sealed segments and delete them, then write missing hints."""
+        with self.lock:
+            sealed = sorted(segment for segment in self.fds if segment != self.active)
+        for segment in sealed:
+            size = self.sizes[segment]
+            if size and 1 - self.live[segment] / size >= self.compact_ratio:
+                self._compact_segment(segment, oldest=segment == sealed[0])
+        with self.lock:
+            sealed = sorted(segment for segment in self.fds if segment != self.active)
+        for segment in sealed:
+            if not os.path.exists(self._path(hint_name(segment))):
+                self.write_hints(segment)
+
+    def _compact_segment(self, segment, oldest):
+        compacted = 0
+        for key, flags, offset, length in list(self._scan_segment(segment)):
+            key_hash = int.from_bytes(key, 'big')
+            with self.lock:
+                if flags == PUT and self.index.get(key_hash) == (segment, offset, length):
+                    self._append(key_hash, PUT, os.pread(self.fds[segment], length, offset))
+                    compacted += 1
+                elif flags == TOMBSTONE and not oldest and key_hash not in self.index:
+                    # an older segment may still hold a value for the key, keep it deleted
+                    self._append(key_hash, TOMBSTONE, b'')
+                else:
+                    continue
+                # moved records count towards the active segment's size like any write
+                if self.sizes[self.active] >= self.segment_bytes:
+                    self._roll()
+        with self.lock:
+            os.fsync(self.fds[self.active])
+            fd = self.fds.pop(segment)
+            del self.sizes[segment]
+            del self.live[segment]
+            # reads that looked the segment up before it was dropped still use its descriptor
+            if fd in self.reading:
+                self.retired.add(fd)
+            else:
+                os.close(fd)
+        for name in (segment_name(segment), hint_name(segment)):
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+        log.info("Compacted %s, %s live records moved", segment_name(segment), compacted)
+
+    def write_hints(self, segment):
+        """Write the hint file of a sealed segment, so startup can skip reading its values."""
+        path = self._path(hint_name(segment))
+        with open(path + '.tmp', 'wb') as f:
+            for key, flags, offset, length in self._scan_segment(segment):
+                f.write(HINT.pack(key, flags, offset, length))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def stats(self):
+        with self.lock:
+            total = sum(self.sizes.values())
+            return {
+                'keys': len(self.index),
+                'segments': len(self.fds),
+                'bytes': total,
+                'garbage_bytes': total - sum(self.live.values()),
+                'sync': self.sync,
+            }
+
+    def close(self):
+        """Flush, stop the background threads and seal every segment with a hint file."""
+        with self.lock:
+            os.fsync(self.fds[self.active])
+        with self.commit_cond:
+            self.closed = True
+            self.commit_cond.notify_all()
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        for segment in sorted(self.fds):
+            if self.sizes[segment] == 0:
+                os.remove(self._path(segment_name(segment)))
+            elif not os.path.exists(self._path(hint_name(segment))):
+                self.write_hints(segment)
+        for fd in list(self.fds.values()) + list(self.retired):
+            os.close(fd)
+
+
+# open-addressing index over dense arrays of 20-byte key digests and value locations, values packed into one arena
+class CompactStore(MutableMapping):
+
+    EMPTY = -1
+    DELETED = -2
+    COMPRESSED = 1 << 31  # flag bit of a value length, the value is zlib-compressed
+    LENGTH = COMPRESSED - 1
+
+    def __init__(self, capacity=1024, compress_threshold=0, max_load=0.7):
+        """Values of at least compress_threshold bytes are zlib-compressed, 0 disables compression."""
+        self.compress_threshold = compress_threshold
+        self.max_load = max_load
+        self.lock = threading.RLock()
+        # entry i: key digest at digests[20 * i:20 * i + 20], its value at arena[offsets[i]:][:lengths[i]]
+        self.digests = bytearray()
+        self.offsets = array('Q')
+        self.lengths = array('I')
+        self.count = 0
+        self._allocate(capacity)
+        self.arena = bytearray()
+        self.garbage = 0  # arena bytes no longer referenced by the table
+
+    def _allocate(self, capacity):
+        """Start an empty index of capacity slots, each the number of an entry, EMPTY or DELETED."""
+        self.capacity = capacity
+        self.slots = array('i', [self.EMPTY]) * capacity
+        self.tombstones = 0
+
+    def _slot(self, digest):
+        """Slot holding the digest, or the first free slot to insert it at."""
+        mask = self.capacity - 1
+        slot = int.from_bytes(digest[:8], 'big') & mask
+        free = None
+        while True:
+            entry = self.slots[slot]
+            if entry == self.EMPTY:
+                return slot if free is None else free
+            if entry == self.DELETED:
+                if free is None:
+                    free = slot
+            elif self.digests[entry * 20:entry * 20 + 20] == digest:
+                return slot
+            slot = (slot + 1) & mask
+
+    def __getitem__(self, key_hash):
+        digest = key_hash.to_bytes(20, 'big')
+        with self.lock:
+            entry = self.slots[self._slot(digest)]
+            if entry < 0:
+                raise KeyError(key_hash)
+            offset, length = self.offsets[entry], self.lengths[entry]
+            value = bytes(self.arena[offset:offset + (length & self.LENGTH)])
+        return zlib.decompress(value) if length & self.COMPRESSED else value
+
+    def __setitem__(self, key_hash, value):
+        length = len(value)
+        if self.compress_threshold and len(value) >= self.compress_threshold:
+            compressed = zlib.compress(value)
+            if len(compressed) < len(value):
+                value = compressed
+                length = len(value) | self.COMPRESSED
+        digest = key_hash.to_bytes(20, 'big')
+        with self.lock:
+            if (self.count + self.tombstones + 1) > self.capacity * self.max_load:
+                self._resize(self.capacity * 2 if self.count * 2 > self.capacity * self.max_load else self.capacity)
+            slot = self._slot(digest)
+            entry = self.slots[slot]
+            if entry >= 0:
+                self.garbage += self.lengths[entry] & self.LENGTH
+                self.offsets[entry] = len(self.arena)
+                self.lengths[entry] = length
+            else:
+                if entry == self.DELETED:
+                    self.tombstones -= 1
+                self.slots[slot] = len(self.lengths)
+                self.digests += digest
+                self.offsets.append(len(self.arena))
+                self.lengths.append(length)
+                self.count += 1
+            self.arena += value
+            if self.garbage > 2**20 and self.garbage > len(self.arena) // 2:
+                self._compact_arena()
+
+    def __delitem__(self, key_hash):
+        digest = key_hash.to_bytes(20, 'big')
+        with self.lock:
+            slot = self._slot(digest)
+            entry = self.slots[slot]
+            if entry < 0:
+                raise KeyError(key_hash)
+            # the entry stays in the dense arrays until the next resize
+            self.garbage += self.lengths[entry] & self.LENGTH
+            self.slots[slot] = self.DELETED
+            self.count -= 1
+            self.tombstones += 1
+
+    def __contains__(self, key_hash):
+        digest = key_hash.to_bytes(20, 'big')
+        with self.lock:
+            return self.slots[self._slot(digest)] >= 0
+
+    def __iter__(self):
+        with self.lock:
+            keys = [int.from_bytes(self.digests[entry * 20:entry * 20 + 20], 'big')
+                    for entry in self.slots if entry >= 0]
+        return iter(keys)
+
+    def __len__(self):
+        return self.count
+
+    def _resize(self, capacity):
+        """Rehash every live entry into a new index, dropping tombstones and deleted entries."""
+        live = [entry for entry in self.slots if entry >= 0]
+        digests, offsets, lengths = self.digests, self.offsets, self.lengths
+        self.digests, self.offsets, self.lengths = bytearray(), array('Q'), array('I')
+        self._allocate(capacity)
+        for entry in live:
+            digest = bytes(digests[entry * 20:entry * 20 + 20])
+            self.slots[self._slot(digest)] = len(self.lengths)
+            self.digests += digest
+            self.offsets.append(offsets[entry])
+            self.lengths.append(lengths[entry])
+
+    def _compact_arena(self):
+        """Copy the live values into a fresh arena."""
+        arena = bytearray()
+        for entry in self.slots:
+            if entry >= 0:
+                offset, length = self.offsets[entry], self.lengths[entry] & self.LENGTH
+                self.offsets[entry] = len(arena)
+                arena += self.arena[offset:offset + length]
+        self.arena = arena
+        self.garbage = 0
+
+    def memory_stats(self):
+        with self.lock:
+            table = self.slots.itemsize * len(self.slots) + len(self.digests) \
+                + self.offsets.itemsize * len(self.offsets) + self.lengths.itemsize * len(self.lengths)
+            total = table + len(self.arena)
+            return {
+                'backend': 'compact',
+                'keys': self.count,
+                'capacity': self.capacity,
+                'table_bytes': table,
+                'arena_bytes': len(self.arena),
+                'garbage_bytes': self.garbage,
+                'total_bytes': total,
+                'bytes_per_entry': total / self.count if self.count else 0,
+            }
+
+
+# a store split by key hash into independent shards, each locked on its own, so writers of different keys rarely wait
+class ShardedStore(MutableMapping):
+
+    def __init__(self, factory, shards=16):
+        """factory() creates the backend of one shard, such as a dict or a CompactStore."""
+        self.shards = [factory() for _ in range(shards)]
+
+    def _shard(self, key_hash):
+        return self.shards[key_hash % len(self.shards)]
+
+    def __getitem__(self, key_hash):
+        return self._shard(key_hash)[key_hash]
+
+    def __setitem__(self, key_hash, value):
+        self._shard(key_hash)[key_hash] = value
+
+    def __delitem__(self, key_hash):
+        del self._shard(key_hash)[key_hash]
+
+    def __contains__(self, key_hash):
+        return key_hash in self._shard(key_hash)
+
+    def get(self, key_hash, default=None):
+        return self._shard(key_hash).get(key_hash, default)
+
+    def __iter__(self):
+        for shard in self.shards:
+            yield from list(shard)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def stats(self):
+        return {'keys': len(self), 'shards': len(self.shards)}
+
+    def memory_stats(self):
+        shards = [memory_stats(shard) for shard in self.shards]
+        keys = sum(shard['keys'] for shard in shards)
+        total = sum(shard['total_bytes'] for shard in shards)
+        return {
+            'backend': f"sharded {shards[0]['backend']}",
+            'shards': len(shards),
+            'keys': keys,
+            'total_bytes': total,
+            'bytes_per_entry': total / keys if keys else 0,
+        }
+
+
+def stored_bytes(store):
+    """Bytes a store holds when they are known without walking every value, otherwise None."""
+    if isinstance(store, ShardedStore):
+        sizes = [stored_bytes(shard) for shard in store.shards]
+        return None if None in sizes else sum(sizes)
+    if isinstance(store, CompactStore):
+        return store.memory_stats()['total_bytes']
+    if isinstance(store, LogStore):
+        return store.stats()['bytes']
+    return None
+
+
+def memory_stats(store):
+    """Approximate memory use of a data store, per entry as well as in total."""
+    if hasattr(store, 'memory_stats'):
+        return store.memory_stats()
+    if isinstance(store, LogStore):
+        # values live on disk, only the index is held in memory
+        index = store.index
+        total = sys.getsizeof(index) + sum(sys.getsizeof(key) + sys.getsizeof(location)
+                                           for key, location in list(index.items()))
+        backend = 'log'
+    else:
+        total = sys.getsizeof(store) + sum(sys.getsizeof(key) + sys.getsizeof(value)
+                                           for key, value in list(store.items()))
+        backend = 'dict'
+    return {
+        'backend': backend,
+        'keys': len(store),
+        'total_bytes': total,
+        'bytes_per_entry': total / len(store) if len(store) else 0,
+    }
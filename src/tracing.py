@@ -0,0 +1,32 @@
+import contextvars
+import logging
+
+# forwards a request took so far; on responses, the forwards it took to reach the node that answered it
+HOPS_HEADER = 'X-Chord-Hops'
+# ID of the client request a request belongs to, passed on by every hop and logged with its messages
+TRACE_HEADER = 'X-Chord-Trace'
+
+# trace ID of the request the current thread or task works on, shared by both runtimes
+trace_id = contextvars.ContextVar('trace_id', default='-')
+
+
+# forwards a request took before it reached this node
+def hop_count(headers):
+    return int(headers.get(HOPS_HEADER, 0))
+
+
+# the node that answers a request does not report hops, the node that forwarded it there reports the count it sent;
+# the trace ID the answering node worked under is passed back with them, so callers can check it was kept
+def pass_trace(response, headers, response_headers):
+    if response_headers is not None:
+        response_headers[HOPS_HEADER] = response.headers.get(HOPS_HEADER) or str(hop_count(headers) + 1)
+        if TRACE_HEADER in response.headers:
+            response_headers[TRACE_HEADER] = response.headers[TRACE_HEADER]
+
+
+# adds the trace ID of the request being worked on to log records
+class TraceFilter(logging.Filter):
+
+    def filter(self, record):
+        record.trace = trace_id.get()
+        return True
@@ -0,0 +1,104 @@
+import argparse
+import json
+import multiprocessing
+import shlex
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from cluster import LocalCluster
+from experiment import LoadRecorder, closed_loop, key_sampler, load_operation, value_sizes
+from peers import PeerPool
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description="Measure the throughput of one node as its number of worker "
+                                                 "processes grows")
+    parser.add_argument("--workers", type=str, default="1,2,4,8",
+                        help="comma separated worker counts, a node is started and torn down for each")
+    parser.add_argument("--host", default="127.0.0.1", help="address the node announces and is loaded at")
+    parser.add_argument("--port", type=int, default=5000, help="port of the node")
+    parser.add_argument("--node-args", type=str, default="", help="further arguments for Node.py")
+    parser.add_argument("--clients", type=int, default=4,
+                        help="client processes sending requests, so the load generator is not bound to one core")
+    parser.add_argument("--threads", type=int, default=8, help="closed-loop threads of every client process")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of every run")
+    parser.add_argument("--keys", type=int, default=10000, help="number of distinct keys, written before every run")
+    parser.add_argument("--value-size", type=str, default="100",
+                        help="bytes of the written values, or a range min-max to pick uniformly from")
+    parser.add_argument("--read-fraction", type=float, default=0.9, help="fraction of the requests that are GETs")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the key and value size choices")
+    parser.add_argument("--ready-timeout", type=float, default=30.0, help="seconds for the node to answer")
+    parser.add_argument("--log-dir", default="logs", help="directory of the node logs")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    return parser
+
+
+def client(args, nodes, index):
+    """Closed-loop load from one process, returns (latencies, errors, misses, seconds)."""
+    load_pool = PeerPool(pool_size=args.threads)
+    recorder = LoadRecorder()
+    sample_key = key_sampler('uniform', args.keys)
+    operation = load_operation(load_pool, nodes, args, sample_key, recorder)
+    elapsed = closed_loop(operation, args.threads, args.duration, args.seed * 1000 + index)
+    load_pool.close()
+    return recorder.latencies, recorder.errors, recorder.misses, elapsed
+
+
+def preload(nodes, keys, value_size, threads):
+    value = b'x' * value_size
+    load_pool = PeerPool(pool_size=threads)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for response in executor.map(lambda i: load_pool.put(nodes[0], f"/storage/load-{i}", data=value),
+                                     range(keys)):
+            response.raise_for_status()
+    load_pool.close()
+
+
+def measure(args, count, clients):
+    node_args = shlex.split(args.node_args) + ['--workers', str(count)]
+    with LocalCluster(1, host=args.host, base_port=args.port, node_args=node_args,
+                      log_dir=args.log_dir) as cluster:
+        cluster.start()
+        cluster.wait_ready(args.ready_timeout)
+        cluster.configure()
+        preload(cluster.addresses, args.keys, value_sizes(args.value_size)[0], args.threads)
+        runs = clients.starmap(client, [(args, cluster.addresses, index) for index in range(args.clients)])
+
+    # the clients' requests are merged, the run lasted as long as the slowest client
+    recorder = LoadRecorder()
+    for latencies, errors, misses, _ in runs:
+        for method in recorder.latencies:
+            recorder.latencies[method] += latencies[method]
+            recorder.errors[method] += errors[method]
+        recorder.misses += misses
+    return dict({'workers': count}, **recorder.summary(max(elapsed for *_, elapsed in runs)))
+
+
+def main(args):
+    counts = [int(count) for count in args.workers.split(',')]
+
+    # a terminated benchmark still tears its node down
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
+
+    results = []
+    print(f"{'workers':>7} {'ops/s':>8} {'speedup':>8} {'errors':>7} {'GET p50':>8} {'p99':>7} {'PUT p50':>8} {'p99':>7} (ms)")
+    with multiprocessing.get_context('fork').Pool(args.clients) as clients:
+        for count in counts:
+            result = measure(args, count, clients)
+            result['speedup'] = result['throughput'] / results[0]['throughput'] if results else 1.0
+            results.append(result)
+            get, put = result['GET'], result['PUT']
+            print(f"{count:>7} {result['throughput']:>8.0f} {result['speedup']:>8.2f} {result['errors']:>7} "
+                  f"{get.get('p50_ms', 0):>8.2f} {get.get('p99_ms', 0):>7.2f} "
+                  f"{put.get('p50_ms', 0):>8.2f} {put.get('p99_ms', 0):>7.2f}", flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    main(args)
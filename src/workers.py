@@ -0,0 +1,85 @@
+import json
+import multiprocessing
+import socket
+
+# set on requests one worker of a node sends another, the receiving worker handles them itself
+WORKER_HEADER = 'X-Chord-Worker'
+
+
+# ring membership shared by the workers of a node: a worker that changes it publishes it here, the others rebuild
+# their routing state from it before their next request; changes are applied under the lock to the members last
+# published, so concurrent changes on different workers are merged instead of replacing each other
+class SharedMembership:
+
+    def __init__(self, capacity=2**20):
+        """capacity is the largest membership in bytes of JSON, about 40 bytes per member."""
+        self.lock = multiprocessing.Lock()
+        self.epoch = multiprocessing.RawValue('Q', 0)
+        self.length = multiprocessing.RawValue('Q', 0)
+        self.buffer = multiprocessing.RawArray('B', capacity)
+
+    def publish(self, members):
+        """Replace the membership, address -> number of virtual nodes, returns its epoch."""
+        with self.lock:
+            self._write(members)
+            return self.epoch.value
+
+    def read(self):
+        """The current (epoch, members)."""
+        with self.lock:
+            return self.epoch.value, self._members()
+
+    def update(self, change, initial):
+        """
+        Publish change(members) of the current members, or of initial if none were published yet, unless it returns
+        None. Returns (epoch, members, changed).
+        """
+        with self.lock:
+            members = self._members() if self.epoch.value else dict(initial)
+            changed = change(members)
+            if changed is None:
+                return self.epoch.value, members, False
+            self._write(changed)
+            return self.epoch.value, changed, True
+
+    def _members(self):
+        return json.loads(bytes(memoryview(self.buffer).cast('B')[:self.length.value]))
+
+    def _write(self, members):
+        data = json.dumps(members).encode()
+        if len(data) > len(self.buffer):
+            raise ValueError(f"Membership of {len(data)} bytes does not fit in {len(self.buffer)}")
+        memoryview(self.buffer).cast('B')[:len(data)] = data
+        self.length.value = len(data)
+        self.epoch.value += 1
+
+
+# the worker processes of one node: they accept connections from a shared listening socket, and worker i holds the
+# keys whose hash is i modulo the number of workers; requests for other keys are passed to their worker
+class WorkerGroup:
+
+    def __init__(self, count, port):
+        """Bind the shared socket on port and a private socket per worker, call before forking the workers."""
+        self.count = count
+        self.index = 0  # of the worker this process runs, set once forked
+        self.listener = socket.create_server(("0.0.0.0", port), backlog=1024)
+        # accepting is non-blocking, a worker that lost the race for a connection goes back to waiting
+        self.listener.setblocking(False)
+        self.private = [socket.create_server(("127.0.0.1", 0), backlog=1024) for _ in range(count)]
+        self.addresses = [f"127.0.0.1:{sock.getsockname()[1]}" for sock in self.private]
+        self.membership = SharedMembership()
+
+    def stripe(self, key_hash):
+        """Index of the worker holding the key hash."""
+        return key_hash % self.count
+
+    def holds(self, key_hash):
+        return self.stripe(key_hash) == self.index
+
+    def address(self, key_hash):
+        """Private address of the worker holding the key hash."""
+        return self.addresses[self.stripe(key_hash)]
+
+    def others(self):
+        """Private addresses of the other workers."""
+        return [address for index, address in enumerate(self.addresses) if index != self.index]